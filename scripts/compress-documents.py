@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Compress the documents already stored in the xcap table (or in all the
+shards), using the compression_threshold and compression_level settings from
+the [Database] section of config.ini. With --decompress the documents are
+stored as plain XML again, which must be done before compress_documents is
+turned off.
+
+The rows are processed in batches of increasing id while the server is
+running. A row is only updated if its etag did not change since it was read,
+a document written meanwhile is already stored as configured by the server.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from application.process import process
+
+from xcap.dbutil import BlockingConnection, encode_document, decode_document, make_binary
+
+
+def recompress(uri, options, config):
+    database = BlockingConnection(uri)
+    select_query = "SELECT id, etag, doc FROM %s WHERE id > %%(last)s ORDER BY id LIMIT %d" % (config.xcap_table, options.batch_size)
+    update_query = "UPDATE %s SET doc = %%(doc)s WHERE id = %%(id)s AND etag = %%(etag)s" % config.xcap_table
+    statistics = dict(rows=0, updated=0, bytes_before=0, bytes_after=0)
+    last = 0
+    while True:
+        rows = database.query(select_query, {'last': last})
+        if not rows:
+            break
+        for id, etag, data in rows:
+            data = str(data)
+            document = decode_document(data)
+            if options.decompress:
+                new_data = document
+            else:
+                new_data = encode_document(document, config.compression_threshold, config.compression_level)
+            statistics['rows'] += 1
+            statistics['bytes_before'] += len(data)
+            statistics['bytes_after'] += len(new_data)
+            if new_data != data:
+                if new_data is not document:
+                    new_data = make_binary(database.schema, new_data)
+                database.query(update_query, {'id': id, 'etag': etag, 'doc': new_data})
+                statistics['updated'] += 1
+            last = id
+        database.commit()
+        if options.pause:
+            time.sleep(options.pause)
+    database.connection.close()
+    return statistics
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--config-dir", dest="config_dir", default="/etc/openxcap", help="directory containing config.ini (%default)")
+    parser.add_option("--batch-size", dest="batch_size", type="int", default=500, help="number of rows processed in a transaction (%default)")
+    parser.add_option("--pause", dest="pause", type="float", default=0.1, help="seconds to wait between batches (%default)")
+    parser.add_option("--decompress", dest="decompress", action="store_true", default=False, help="store all the documents uncompressed")
+    options, args = parser.parse_args()
+
+    process.system_config_directory = options.config_dir
+
+    from xcap.interfaces.backend.database import Config
+    if not Config.compress_documents and not options.decompress:
+        print "note: compress_documents is not enabled, the server will store new documents uncompressed"
+    if Config.storage_shard_uris:
+        uris = [shard.split('=', 1)[1] for shard in Config.storage_shard_uris]
+    else:
+        uris = [Config.storage_db_uri]
+    for uri in uris:
+        statistics = recompress(uri, options, Config)
+        print "%s: %d rows, %d updated, %d bytes before, %d bytes after" % (uri.split('@', 1)[-1], statistics['rows'], statistics['updated'], statistics['bytes_before'], statistics['bytes_after'])
+    sys.exit(0)
@@ -21,3 +21,12 @@ CREATE TABLE `xcap` (
   PRIMARY KEY  (`id`),
   UNIQUE KEY `udd_xcap` (`username`,`domain`,`doc_type`,`doc_uri`)
 ) ENGINE=InnoDB;
+
+-- Only needed when the documents are sharded (see storage_shard_uris), in the
+-- database given by storage_db_uri
+CREATE TABLE `xcap_shard_map` (
+  `username` varchar(66) NOT NULL,
+  `domain` varchar(128) NOT NULL,
+  `shard` varchar(64) NOT NULL,
+  PRIMARY KEY  (`username`,`domain`)
+) ENGINE=InnoDB;
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Move users between the storage shards configured with storage_shard_uris.
+
+  shard-rebalance.py move alice@example.com shard2
+      Moves the documents of a user to the given shard and records the move in
+      the shard map.
+
+  shard-rebalance.py pin shard1,shard2,shard3
+      Run before changing the list of shards: adds shard map entries for all
+      the users whose shard would change with the new list of shard names, so
+      that they stay where they are once the servers use the new list.
+
+  shard-rebalance.py rebalance
+      Run after changing the list of shards: moves the users found in the
+      shard map to the shard they belong to according to the hash and removes
+      their shard map entries.
+
+The servers are not stopped. A user is moved by copying the documents with
+their etags to the target shard and updating the shard map. Until the cached
+shard map entries expire (shard_map_ttl seconds), some servers may still write
+to the source shard, so after waiting for them to expire the documents changed
+on the source in the meantime are copied again, unless they were changed on the
+target as well (in which case the target wins). Only then the documents are
+deleted from the source shard. rebalance moves the users in batches of
+--batch-size users, which share a single wait.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from application.process import process
+
+from xcap.dbutil import BlockingConnection, shard_for_user
+
+
+class Rebalancer(object):
+
+    def __init__(self, options):
+        from xcap.interfaces.backend.database import Config
+        self.options = options
+        self.table = Config.xcap_table
+        self.map_table = Config.shard_map_table
+        self.map_ttl = Config.shard_map_ttl
+        self.uris = {}
+        self.names = []
+        for shard in Config.storage_shard_uris:
+            name, uri = shard.split('=', 1)
+            self.names.append(name)
+            self.uris[name] = uri
+        if not self.names:
+            sys.exit("No shards are configured in storage_shard_uris")
+        self.main = BlockingConnection(Config.storage_db_uri)
+        self.databases = {}
+
+    def database(self, name):
+        try:
+            return self.databases[name]
+        except KeyError:
+            database = self.databases[name] = BlockingConnection(self.uris[name])
+            return database
+
+    def mapped_shard(self, username, domain):
+        rows = self.main.query("SELECT shard FROM %s WHERE username = %%(username)s AND domain = %%(domain)s" % self.map_table,
+                               {'username': username, 'domain': domain})
+        return rows and rows[0][0] or None
+
+    def shard_of(self, username, domain):
+        return self.mapped_shard(username, domain) or shard_for_user(username, domain, self.names)
+
+    def set_mapping(self, username, domain, shard):
+        params = {'username': username, 'domain': domain, 'shard': shard}
+        self.main.query("DELETE FROM %s WHERE username = %%(username)s AND domain = %%(domain)s" % self.map_table, params)
+        if shard is not None:
+            self.main.query("INSERT INTO %s (username, domain, shard) VALUES (%%(username)s, %%(domain)s, %%(shard)s)" % self.map_table, params)
+        self.main.commit()
+
+    def documents(self, database, username, domain):
+        rows = database.query("SELECT doc_type, doc_uri, etag, doc FROM %s WHERE username = %%(username)s AND domain = %%(domain)s" % self.table,
+                              {'username': username, 'domain': domain})
+        return dict(((doc_type, doc_uri), (etag, doc)) for doc_type, doc_uri, etag, doc in rows)
+
+    def delete_document(self, database, username, domain, key):
+        database.query("""DELETE FROM %s WHERE username = %%(username)s AND domain = %%(domain)s
+                          AND doc_type = %%(doc_type)s AND doc_uri = %%(doc_uri)s""" % self.table,
+                       {'username': username, 'domain': domain, 'doc_type': key[0], 'doc_uri': key[1]})
+
+    def insert_document(self, database, username, domain, key, etag, doc):
+        database.query("""INSERT INTO %s (username, domain, doc_type, doc_uri, etag, doc)
+                          VALUES (%%(username)s, %%(domain)s, %%(doc_type)s, %%(doc_uri)s, %%(etag)s, %%(doc)s)""" % self.table,
+                       {'username': username, 'domain': domain, 'doc_type': key[0], 'doc_uri': key[1], 'etag': etag, 'doc': doc})
+
+    def move(self, username, domain, target):
+        self.move_batch([(username, domain, target)])
+
+    def move_batch(self, moves):
+        """Move the users of moves, a list of (username, domain, target shard)
+        tuples, waiting only once for the shard map caches to expire."""
+        copies = []
+        for username, domain, target in moves:
+            copy = self._copy(username, domain, target)
+            if copy is not None:
+                copies.append(copy)
+        if not copies:
+            return
+        print "copied the documents of %d users, waiting for the shard map caches to expire" % len(copies)
+        time.sleep(self.map_ttl + self.options.grace)
+        for copy in copies:
+            self._finish(*copy)
+
+    def _copy(self, username, domain, target):
+        """Copy the documents of a user to the target shard and map the user
+        to it. Return what _finish needs or None if the user is already there."""
+        if target not in self.uris:
+            sys.exit("Unknown shard %r" % target)
+        source_name = self.shard_of(username, domain)
+        if source_name == target:
+            print "%s@%s is already on %s" % (username, domain, target)
+            return None
+        source, destination = self.database(source_name), self.database(target)
+        copied = self.documents(source, username, domain)
+        destination.query("DELETE FROM %s WHERE username = %%(username)s AND domain = %%(domain)s" % self.table, {'username': username, 'domain': domain})
+        for key, (etag, doc) in copied.iteritems():
+            self.insert_document(destination, username, domain, key, etag, doc)
+        destination.commit()
+        self.set_mapping(username, domain, target)
+        print "%s@%s: copied %d documents from %s to %s" % (username, domain, len(copied), source_name, target)
+        return (username, domain, source_name, target, copied)
+
+    def _finish(self, username, domain, source_name, target, copied):
+        """Copy the changes made on the source by the servers that were still
+        using the old mapping and delete the documents from the source."""
+        source, destination = self.database(source_name), self.database(target)
+        current = self.documents(source, username, domain)
+        moved = self.documents(destination, username, domain)
+        for key in set(copied) | set(current):
+            old, new = copied.get(key), current.get(key)
+            if (old and old[0]) == (new and new[0]):
+                continue
+            if (moved.get(key) and moved[key][0]) != (old and old[0]):
+                print "%s@%s: document %s/%s was changed on both shards, keeping the one on %s" % (username, domain, key[0], key[1], target)
+                continue
+            self.delete_document(destination, username, domain, key)
+            if new is not None:
+                self.insert_document(destination, username, domain, key, new[0], new[1])
+        destination.commit()
+        source.query("DELETE FROM %s WHERE username = %%(username)s AND domain = %%(domain)s" % self.table, {'username': username, 'domain': domain})
+        source.commit()
+        print "%s@%s: moved from %s to %s" % (username, domain, source_name, target)
+
+    def pin(self, new_names):
+        count = 0
+        for name in self.names:
+            for username, domain in self.database(name).query("SELECT DISTINCT username, domain FROM %s" % self.table):
+                if self.mapped_shard(username, domain) is None and shard_for_user(username, domain, new_names) != name:
+                    self.set_mapping(username, domain, name)
+                    count += 1
+        print "pinned %d users to their current shard" % count
+
+    def rebalance(self):
+        count = 0
+        batch = []
+        for username, domain, shard in self.main.query("SELECT username, domain, shard FROM %s" % self.map_table):
+            if self.options.limit and count >= self.options.limit:
+                break
+            target = shard_for_user(username, domain, self.names)
+            if shard != target:
+                batch.append((username, domain, target))
+                count += 1
+                if len(batch) >= self.options.batch_size:
+                    self._rebalance_batch(batch)
+                    batch = []
+            else:
+                # the user is already on the shard given by the hash, so the entry can go
+                self.set_mapping(username, domain, None)
+        self._rebalance_batch(batch)
+        print "moved %d users" % count
+
+    def _rebalance_batch(self, batch):
+        self.move_batch(batch)
+        # the users are now on the shard given by the hash, so the entries can go
+        for username, domain, target in batch:
+            self.set_mapping(username, domain, None)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] move user@domain shard | pin shard[,shard...] | rebalance")
+    parser.add_option("--config-dir", dest="config_dir", default="/etc/openxcap", help="directory containing config.ini (%default)")
+    parser.add_option("--grace", dest="grace", type="int", default=5, help="seconds to wait after shard_map_ttl before copying the late changes (%default)")
+    parser.add_option("--limit", dest="limit", type="int", default=0, help="maximum number of users moved by rebalance, 0 for no limit (%default)")
+    parser.add_option("--batch-size", dest="batch_size", type="int", default=100, help="number of users moved by rebalance for every wait for the shard map caches (%default)")
+    options, args = parser.parse_args()
+
+    process.system_config_directory = options.config_dir
+
+    rebalancer = Rebalancer(options)
+    if args[:1] == ['move'] and len(args) == 3 and '@' in args[1]:
+        username, domain = args[1].split('@', 1)
+        rebalancer.move(username, domain, args[2])
+    elif args[:1] == ['pin'] and len(args) == 2:
+        rebalancer.pin(args[1].split(','))
+    elif args == ['rebalance']:
+        rebalancer.rebalance()
+    else:
+        parser.error("invalid command")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Benchmark a storage backend by writing documents directly to it, bypassing
+HTTP, authentication and validation. The backend and its settings are read
+from config.ini, like the server does.
+
+With --users=1 all requests write the same document, which measures the
+behaviour of the backend under contention. The effect of write batching is
+measured by running the benchmark with --batch-delay=0 and with a delay of a
+few milliseconds.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from application.process import process
+from twisted.internet import defer
+
+
+DOCUMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<root xmlns="test-app">
+%s
+</root>"""
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p/100.0))]
+
+
+class Benchmark(object):
+
+    def __init__(self, storage, options):
+        from xcap.uri import XCAPUri
+        self.storage = storage
+        self.options = options
+        self.uris = [XCAPUri('http://localhost/xcap-root', '/test-app/users/sip:bench%d@example.com/index.xml' % i, {}) for i in xrange(options.users)]
+        self.document = DOCUMENT % (('<el att="%s"/>\n' % ('x' * 64)) * max(1, options.size/80))
+        self.latencies = []
+        self.errors = 0
+        self.remaining = options.requests
+
+    def check_etag(self, etag, exists=True):
+        pass
+
+    def request(self, uri):
+        if self.options.mode == 'get':
+            return self.storage.get_document(uri, self.check_etag)
+        elif self.options.mode == 'delete':
+            return self.storage.delete_document(uri, self.check_etag)
+        else:
+            return self.storage.put_document(uri, self.document, self.check_etag)
+
+    @defer.inlineCallbacks
+    def worker(self, index):
+        while self.remaining > 0:
+            self.remaining -= 1
+            uri = self.uris[(self.remaining + index) % len(self.uris)]
+            start = time.time()
+            try:
+                yield self.request(uri)
+            except Exception:
+                self.errors += 1
+            self.latencies.append(time.time() - start)
+
+    def run(self):
+        self.start_time = time.time()
+        self.start_cpu = time.clock()
+        workers = [self.worker(i) for i in xrange(self.options.concurrency)]
+        return defer.DeferredList(workers).addCallback(self.report)
+
+    def report(self, result):
+        elapsed = time.time() - self.start_time
+        cpu = time.clock() - self.start_cpu
+        latencies = self.latencies
+        print "%d %s requests in %.3f seconds (%.1f requests/s), %d errors" % (len(latencies), self.options.mode, elapsed, len(latencies)/elapsed, self.errors)
+        print "cpu: %.3f seconds, %.3fms per request" % (cpu, cpu*1000/max(1, len(latencies)))
+        print "latency: p50 %.2fms, p99 %.2fms, max %.2fms" % (percentile(latencies, 50)*1000, percentile(latencies, 99)*1000, max(latencies or [0])*1000)
+        statistics = getattr(self.storage, 'statistics', None)
+        if statistics:
+            print "storage statistics: %s" % ', '.join('%s=%s' % item for item in sorted(statistics.items()))
+            if statistics.get('requests') and 'transactions' in statistics:
+                print "retries: %d, queries per write: %.2f" % (statistics['transactions'] - statistics['requests'], float(statistics['queries']) / statistics['requests'])
+            if statistics.get('document_bytes'):
+                saved = statistics['document_bytes'] - statistics['stored_bytes']
+                print "stored %d of %d document bytes, %d saved (%.1f%%)" % (statistics['stored_bytes'], statistics['document_bytes'], saved, saved*100.0/statistics['document_bytes'])
+        write_locks = getattr(self.storage, 'write_locks', None)
+        if write_locks is not None:
+            print "write locks: %d waits for %d writes, most contended: %s" % (write_locks.statistics['waits'], write_locks.statistics['operations'],
+                                                                             ', '.join('%s (%d)' % ('/'.join(map(str, key)), waits) for waits, key in write_locks.most_contended(3)) or 'none')
+        read_conn = getattr(self.storage, 'read_conn', None)
+        if read_conn is not None:
+            print "replica statistics: %s" % ', '.join('%s=%s' % item for item in sorted(read_conn.statistics.items()))
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--config-dir", dest="config_dir", default="/etc/openxcap", help="directory containing config.ini (%default)")
+    parser.add_option("--backend", dest="backend", default="Database", help="backend module to benchmark (%default)")
+    parser.add_option("--mode", dest="mode", default="put", choices=["put", "get", "delete"], help="put, get or delete (%default)")
+    parser.add_option("--requests", dest="requests", type="int", default=1000, help="total number of requests (%default)")
+    parser.add_option("--concurrency", dest="concurrency", type="int", default=20, help="number of requests in progress at any time (%default)")
+    parser.add_option("--users", dest="users", type="int", default=1, help="number of distinct users/documents (%default)")
+    parser.add_option("--size", dest="size", type="int", default=1024, help="approximate document size in bytes (%default)")
+    parser.add_option("--compress", dest="compress", action="store_true", default=None, help="enable document compression (database backends)")
+    parser.add_option("--no-compress", dest="compress", action="store_false", help="disable document compression (database backends)")
+    parser.add_option("--batch-delay", dest="batch_delay", type="int", default=None, help="write batching delay in milliseconds, 0 disables batching (database backends)")
+    parser.add_option("--batch-size", dest="batch_size", type="int", default=None, help="maximum number of writes in a batch (database backends)")
+    parser.add_option("--no-write-locks", dest="serialize_writes", action="store_false", default=None, help="let the writes of the same document race (database backends)")
+    options, args = parser.parse_args()
+
+    process.system_config_directory = options.config_dir
+
+    from twisted.internet import reactor
+    backend = __import__('xcap.interfaces.backend.%s' % options.backend.lower(), globals(), locals(), [''])
+    # only loaded by the backends based on the database backend
+    database = sys.modules.get('xcap.interfaces.backend.database')
+    if database is not None:
+        if options.compress is not None:
+            database.Config.compress_documents = options.compress
+        if options.batch_delay is not None:
+            database.Config.write_batch_delay = options.batch_delay
+        if options.batch_size is not None:
+            database.Config.write_batch_size = options.batch_size
+        if options.serialize_writes is not None:
+            database.Config.serialize_writes = options.serialize_writes
+    storage = backend.Storage()
+
+    def stop(result):
+        reactor.stop()
+        return result
+
+    # give the backend a moment to establish its connections
+    reactor.callLater(1, lambda: Benchmark(storage, options).run().addBoth(stop))
+    reactor.run()
+    sys.exit(0)
+
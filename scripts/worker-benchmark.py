@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Measure how much the validation of large documents delays the reactor,
+with the validation done in the reactor thread (--pool=none) or in a pool of
+threads or processes. Resource-lists documents of the given size are PUT
+through the application, without storing them, while a timer that should
+fire every millisecond measures how late the reactor runs it.
+
+The application settings are read from config.ini, like the server does.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from application.process import process
+from twisted.internet import defer, reactor, task
+
+
+ENTRY = '    <entry uri="sip:user%d@example.com"><display-name>User %d</display-name></entry>\n'
+
+DOCUMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists">
+  <list name="friends">
+%s  </list>
+</resource-lists>"""
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p/100.0))]
+
+
+class NullStorage(object):
+    """Accepts the documents without storing them"""
+
+    def put_document(self, uri, document, check_etag):
+        from xcap.interfaces.backend import StatusResponse
+        return defer.succeed(StatusResponse(200, 'etag'))
+
+
+class Benchmark(object):
+
+    interval = 0.001
+
+    def __init__(self, application, options):
+        from xcap.appusage import namespaces
+        from xcap.uri import XCAPUri
+        self.application = application
+        self.options = options
+        self.uri = XCAPUri('http://localhost/xcap-root', '/resource-lists/users/sip:bench@example.com/index', namespaces)
+        entries = max(1, options.size / len(ENTRY % (0, 0)))
+        self.document = DOCUMENT % ''.join(ENTRY % (i, i) for i in xrange(entries))
+        self.latencies = []
+        self.lateness = []
+        self.errors = 0
+        self.remaining = options.uploads
+
+    def check_etag(self, etag, exists=True):
+        pass
+
+    def tick(self):
+        now = time.time()
+        self.lateness.append(max(0.0, now - self.last_tick - self.interval))
+        self.last_tick = now
+
+    @defer.inlineCallbacks
+    def worker(self):
+        while self.remaining > 0:
+            self.remaining -= 1
+            start = time.time()
+            try:
+                # started from the reactor, as a request would be, so that the
+                # timer runs between the uploads done in the reactor thread
+                yield task.deferLater(reactor, 0, self.application.put_document, self.uri, self.document, self.check_etag)
+            except Exception:
+                self.errors += 1
+            self.latencies.append(time.time() - start)
+
+    def run(self):
+        self.last_tick = time.time()
+        self.timer = task.LoopingCall(self.tick)
+        self.timer.start(self.interval, now=False)
+        self.start_time = time.time()
+        workers = [self.worker() for i in xrange(self.options.concurrency)]
+        return defer.DeferredList(workers).addCallback(self.report)
+
+    def report(self, result):
+        from xcap.workers import get_worker_pool
+        self.timer.stop()
+        elapsed = time.time() - self.start_time
+        latencies = self.latencies
+        lateness = self.lateness
+        print "%d uploads of %d bytes in %.3f seconds (%.1f uploads/s), %d errors" % (len(latencies), len(self.document), elapsed, len(latencies)/elapsed, self.errors)
+        print "upload latency: p50 %.2fms, p99 %.2fms, max %.2fms" % (percentile(latencies, 50)*1000, percentile(latencies, 99)*1000, max(latencies or [0])*1000)
+        print "reactor lateness: p50 %.2fms, p99 %.2fms, max %.2fms" % (percentile(lateness, 50)*1000, percentile(lateness, 99)*1000, max(lateness or [0])*1000)
+        pool = get_worker_pool()
+        if pool is not None:
+            print "pool statistics: %s, average wait %.2fms" % (', '.join('%s=%s' % item for item in sorted(pool.statistics.items())), pool.average_wait_time*1000)
+            for worker, statistics in sorted(pool.worker_statistics.items()):
+                print "  %s: %d tasks, %.1fms average, %.1fms max" % (worker, statistics['tasks'], statistics['time']*1000/statistics['tasks'], statistics['max_time']*1000)
+        for stage, statistics in self.application.validation_statistics.items():
+            print "validation %s: %d times, %.1fms average, %.1fms max" % (stage, statistics['count'], statistics['time']*1000/statistics['count'], statistics['max_time']*1000)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--config-dir", dest="config_dir", default="/etc/openxcap", help="directory containing config.ini (%default)")
+    parser.add_option("--pool", dest="pool", default="thread", choices=["none", "thread", "process"], help="none, thread or process (%default)")
+    parser.add_option("--workers", dest="workers", type="int", default=4, help="number of workers in the pool (%default)")
+    parser.add_option("--uploads", dest="uploads", type="int", default=20, help="total number of uploads (%default)")
+    parser.add_option("--concurrency", dest="concurrency", type="int", default=4, help="number of uploads in progress at any time (%default)")
+    parser.add_option("--size", dest="size", type="int", default=1024*1024, help="approximate document size in bytes (%default)")
+    options, args = parser.parse_args()
+
+    process.system_config_directory = options.config_dir
+
+    from xcap import workers
+    if options.pool == 'none':
+        workers.Config.count = 0
+    else:
+        workers.Config.type = options.pool
+        workers.Config.count = options.workers
+        workers.Config.size_threshold = 0
+    from xcap.appusage import applications, setup_applications
+    setup_applications()
+    application = applications['resource-lists']
+    application.storage = NullStorage()
+
+    def stop(result):
+        reactor.stop()
+        return result
+
+    reactor.callWhenRunning(lambda: Benchmark(application, options).run().addBoth(stop))
+    reactor.run()
+    sys.exit(0)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Compare the offset based attribute PUT and DELETE of xcap.element with the
+lxml implementation they replaced, which parsed the document, changed the
+tree and serialized it again. The document is a resource-lists document with
+the given number of entries and the attribute of an entry in the middle of
+the list is changed.
+
+The element is located like the server does it: in the lxml tree of the
+document (--locate=tree, when the document isn't in the parsed document
+cache), with an ElementIndex (--locate=index, when the elements are indexed)
+or with the SAX locator (--locate=sax).
+
+Besides the time per operation, the size of the part of the document changed
+by each implementation is reported.
+"""
+
+import time
+from cStringIO import StringIO
+from optparse import OptionParser
+
+from lxml import etree
+
+
+NAMESPACE = 'urn:ietf:params:xml:ns:resource-lists'
+
+DOCUMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists"
+                xmlns:cp="urn:ietf:params:xml:ns:common-policy">
+  <list name="friends">
+%s
+  </list>
+</resource-lists>
+"""
+
+ENTRY = """    <entry uri='sip:user%d@example.com'>
+      <display-name>User %d</display-name>
+    </entry>"""
+
+
+def lxml_put_attribute(document, xpath, name, value):
+    xml_doc = etree.parse(StringIO(document))
+    elem = xml_doc.xpath(xpath, namespaces={'default': NAMESPACE})[0]
+    elem.set(name, value)
+    return etree.tostring(xml_doc, encoding='UTF-8', xml_declaration=True)
+
+def lxml_delete_attribute(document, xpath, name):
+    xml_doc = etree.parse(StringIO(document))
+    elem = xml_doc.xpath(xpath, namespaces={'default': NAMESPACE})[0]
+    del elem.attrib[name]
+    return etree.tostring(xml_doc, encoding='UTF-8', xml_declaration=True)
+
+def changed_bytes(old, new):
+    """The size of the part of new that differs from old"""
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-suffix-1] == new[-suffix-1]:
+        suffix += 1
+    return len(new) - prefix - suffix
+
+def measure(repeat, function, *args):
+    start = time.time()
+    for i in xrange(repeat):
+        result = function(*args)
+    return result, (time.time() - start) * 1000.0 / repeat
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--entries", dest="entries", type="int", default=1000, help="number of entries in the document (%default)")
+    parser.add_option("--repeat", dest="repeat", type="int", default=20, help="number of times each operation is run (%default)")
+    parser.add_option("--locate", dest="locate", type="choice", choices=('tree', 'index', 'sax'), default='tree',
+                      help="how the element is located: tree, index or sax (%default)")
+    options, args = parser.parse_args()
+
+    from xcap import element
+    from xcap.cache import ParsedDocument
+    from xcap.xpath import parse_node_selector
+
+    document = DOCUMENT % '\n'.join(ENTRY % (i, i) for i in xrange(options.entries))
+    target = options.entries / 2
+    selector = '/resource-lists/list[@name="friends"]/entry[@uri="sip:user%d@example.com"]' % target
+    xpath = '/default:resource-lists/default:list[@name="friends"]/default:entry[@uri="sip:user%d@example.com"]' % target
+    element_selector = parse_node_selector(selector, NAMESPACE)[0]
+    if options.locate == 'index':
+        index = element.ElementIndex(document)
+        locate = lambda element_selector: index.find(element_selector)[0]
+    elif options.locate == 'tree':
+        # a new ParsedDocument for every request, as for a document that just changed
+        locate = lambda element_selector: ParsedDocument(document).find_start(element_selector, xpath, {'default': NAMESPACE})
+    else:
+        locate = lambda element_selector: element.find(document, element_selector)[0]
+
+    def offset_put_attribute(document, element_selector, name, value):
+        return element.put_attribute(document, element_selector, name, value, locate(element_selector))[0]
+
+    def offset_delete_attribute(document, element_selector, name):
+        return element.delete_attribute(document, element_selector, name, locate(element_selector))
+
+    print "document of %d bytes, %d entries" % (len(document), options.entries)
+    print "%-24s %10s %10s %14s %14s" % ('operation', 'lxml ms', 'offsets ms', 'lxml changed', 'offsets changed')
+    uri = 'sip:user%d@example.com' % target
+    for operation, lxml_args, offset_args in [('PUT new attribute', (lxml_put_attribute, xpath, 'display', 'Friend "%d"' % target),
+                                                                     (offset_put_attribute, element_selector, 'display', 'Friend "%d"' % target)),
+                                              ('PUT existing attribute', (lxml_put_attribute, xpath, 'uri', uri),
+                                                                          (offset_put_attribute, element_selector, 'uri', uri)),
+                                              ('DELETE attribute', (lxml_delete_attribute, xpath, 'uri'),
+                                                                    (offset_delete_attribute, element_selector, 'uri'))]:
+        lxml_result, lxml_time = measure(options.repeat, lxml_args[0], document, *lxml_args[1:])
+        offset_result, offset_time = measure(options.repeat, offset_args[0], document, *offset_args[1:])
+        print "%-24s %10.3f %10.3f %14d %14d" % (operation, lxml_time, offset_time,
+                                                 changed_bytes(document, lxml_result), changed_bytes(document, offset_result))
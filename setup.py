@@ -36,7 +36,7 @@ solution.""",
         "Programming Language :: Python",
       ],
       packages = find_packages('xcap'),
-      scripts  = ['openxcap'],
+      scripts  = ['openxcap', 'openxcap-dump', 'openxcap-load'],
       package_data = {'xcap.appusage': ['xml-schemas/*']},
       )
 
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Tests of the validation of the documents loaded from an archive, which are
+not stored at an XCAP URI"""
+
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xcap.archive import Record, validate_batch
+
+entry_ref = '<entry-ref ref="resource-lists/users/sip:alice@example.com/index/~~/resource-lists/list%5b@name=%22x%22%5d/entry%5b@uri=%22sip:y@example.com%22%5d"/>'
+external = '<external anchor="http://xcap.other.com/xcap-root/resource-lists/users/sip:bob@other.com/index/~~/resource-lists/list%5b@name=%22x%22%5d"/>'
+
+resource_lists_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists">
+  <list name="friends">
+    <entry uri="sip:bob@example.com"/>
+    """ + entry_ref.replace('%', '%%') + """
+    """ + external.replace('%', '%%') + """
+    %s
+  </list>
+  %s
+</resource-lists>"""
+
+pres_rules_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<cr:ruleset xmlns="urn:ietf:params:xml:ns:pres-rules" xmlns:cr="urn:ietf:params:xml:ns:common-policy"
+            xmlns:ocp="urn:oma:xml:xdm:common-policy">
+  <cr:rule id="a">
+    <cr:conditions>
+      <ocp:external-list><ocp:entry anc="http://xcap.other.com/xcap-root/resource-lists/users/sip:bob@other.com/index/~~/resource-lists/list%%5b@name=%%22x%%22%%5d"/></ocp:external-list>
+      %s
+    </cr:conditions>
+    <cr:actions><sub-handling>allow</sub-handling></cr:actions>
+  </cr:rule>
+</cr:ruleset>"""
+
+
+class ValidateBatchTest(unittest.TestCase):
+
+    def validate(self, application_id, document):
+        record = Record('alice', 'example.com', application_id, 'index', 'etag', document)
+        valid, invalid = validate_batch([record])
+        return [error for record, error in invalid]
+
+    def test_resource_lists(self):
+        # the references can't be checked without the URI the document is stored at
+        self.assertEqual(self.validate('resource-lists', resource_lists_xml % ('', '')), [])
+
+    def test_resource_lists_not_unique(self):
+        for children, lists in [('', '<list name="friends"/>'),
+                                ('<entry uri="sip:bob@example.com"/>', ''),
+                                (entry_ref, ''), (external, '')]:
+            [error] = self.validate('resource-lists', resource_lists_xml % (children, lists))
+            self.assert_('<uniqueness-failure' in error, error)
+
+    def test_pres_rules(self):
+        self.assertEqual(self.validate('pres-rules', pres_rules_xml % ''), [])
+        [error] = self.validate('pres-rules', pres_rules_xml % '<ocp:external-list/>')
+        self.assert_('Complex rules are not allowed' in error, error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -59,11 +59,46 @@ class AttributeTest(XCAPTest):
                  '/resource-lists/list[@name="friends"]/@some-attribute', status=409)
 
         # fails GET(PUT(x))==x test. must be rejected in the server
-        #self.put('resource-lists', 'coworkers', '/resource-lists/list[@name="friends"]/@name', status=409)
+        r = self.put('resource-lists', 'coworkers', '/resource-lists/list[@name="friends"]/@name', status=409)
+        self.assertInBody(r, '<cannot-insert')
+        self.assertDocument('resource-lists', resource_list_xml)
 
-        # XXX parent's selector becomes invalid
-        r = self.client._put('resource-lists', 'coworkers', '/resource-lists/list[@name="friends"]/@name')
-        self.assertStatus(r, 200)
+        self.put('resource-lists', 'friends', '/resource-lists/list[@name="friends"]/@name', status=200)
+
+
+# the attributes are replaced, added and removed in the document as it was put
+test_app_xml = """<?xml version='1.0' encoding='UTF-8'?>
+<root xmlns="test-app">
+<el1 att="first"  other = 'x'>text</el1>
+<el1 att="second" empty=""/>
+<!-- comment -->
+<el2 att="first"/>
+</root>"""
+
+class SplicedAttributeTest(XCAPTest):
+
+    def test_put_new(self):
+        self.put('test-app', test_app_xml)
+        self.put('test-app', 'value', '/root/el2/@new', status=201)
+        self.put('test-app', 'other', '/root/el2/@new', status=200)
+        self.assertDocument('test-app', test_app_xml.replace('<el2 att="first"/>', '<el2 att="first" new="other"/>'))
+
+    def test_put_existing(self):
+        self.put('test-app', test_app_xml)
+        self.put('test-app', 'a<b', '/root/el1[@att="first"]/@other', status=200)
+        self.assertDocument('test-app', test_app_xml.replace("  other = 'x'", ' other="a&lt;b"'))
+
+    def test_delete_empty(self):
+        self.put('test-app', test_app_xml)
+        self.delete('test-app', '/root/el1[@att="second"]/@empty', status=200)
+        self.delete('test-app', '/root/el1[@att="second"]/@empty', status=404)
+        self.assertDocument('test-app', test_app_xml.replace(' empty=""', ''))
+
+    def test_put_not_utf8(self):
+        self.put('test-app', test_app_xml)
+        r = self.put('test-app', 'caf\xe9', '/root/el2/@new', status=409)
+        self.assertInBody(r, '<not-xml-att-value')
+        self.assertDocument('test-app', test_app_xml)
 
 if __name__ == '__main__':
     runSuiteFromModule()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Tests of the storage backends and of the database helpers they use that
+don't need a database server: the memory backend, the SQLite driver and
+the locks and shard selection of xcap.dbutil."""
+
+import os
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import defer
+
+from xcap import sqlitedb
+from xcap.dbutil import BlockingConnection, KeyedLock, Replica, ReplicaPool, shard_for_user, encode_document, decode_document
+from xcap.interfaces.backend import memory, StatusResponse, stale_replica_read
+from xcap.uri import XCAPUri
+
+xcap_root = 'http://xcap.example.com/xcap-root'
+
+def make_uri(user='alice@example.com', application='resource-lists', document='index'):
+    return XCAPUri(xcap_root, '/%s/users/sip:%s/%s' % (application, user, document), {})
+
+def no_check(etag, exists=True):
+    pass
+
+def result(d):
+    """Return the result of a deferred that already fired, raising its error"""
+    results = []
+    d.addBoth(results.append)
+    if hasattr(results[0], 'raiseException'):
+        results[0].raiseException()
+    return results[0]
+
+
+class MemoryStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = memory.Storage()
+        self.storage.users.clear()
+
+    def tearDown(self):
+        self.storage.users.clear()
+
+    def test_documents(self):
+        uri = make_uri()
+        self.assertEqual(result(self.storage.get_document(uri, no_check)).code, 404)
+        response = result(self.storage.put_document(uri, '<resource-lists/>', no_check))
+        self.assertEqual(response.code, 201)
+        etag = response.etag
+        response = result(self.storage.put_document(uri, '<resource-lists>changed</resource-lists>', no_check))
+        self.assertEqual((response.code, response.old_etag), (200, etag))
+        etag = response.etag
+        response = result(self.storage.get_document(uri, no_check))
+        self.assertEqual((response.code, response.etag, response.data), (200, etag, '<resource-lists>changed</resource-lists>'))
+        response = result(self.storage.delete_document(uri, no_check))
+        self.assertEqual((response.code, response.old_etag), (200, etag))
+        self.assertEqual(result(self.storage.delete_document(uri, no_check)).code, 404)
+        self.assertEqual(self.storage.users, {})
+
+    def test_check_etag(self):
+        uri = make_uri()
+        class EtagError(Exception): pass
+        checked = []
+        def check_etag(etag, exists=True):
+            checked.append((etag, exists))
+            raise EtagError
+        self.assertRaises(EtagError, result, self.storage.put_document(uri, '<resource-lists/>', check_etag))
+        self.assertEqual(checked, [(None, False)])
+        self.assertEqual(result(self.storage.get_document(uri, no_check)).code, 404)
+        etag = result(self.storage.put_document(uri, '<resource-lists/>', no_check)).etag
+        for operation in (self.storage.get_document, self.storage.delete_document):
+            self.assertRaises(EtagError, result, operation(uri, check_etag))
+        self.assertEqual(checked[1:], [(etag, True), (etag, True)])
+        self.assertEqual(result(self.storage.get_document(uri, no_check)).etag, etag)
+
+    def test_pres_rules(self):
+        result(self.storage.put_document(make_uri(application='pres-rules', document='rules.xml'), '<ruleset/>', no_check))
+        response = result(self.storage.get_document(make_uri(application='org.openmobilealliance.pres-rules'), no_check))
+        self.assertEqual(response.data, '<ruleset/>')
+
+    def test_users(self):
+        for user in ('alice@example.com', 'bob@example.com'):
+            for application in ('resource-lists', 'rls-services'):
+                result(self.storage.put_document(make_uri(user, application), '<%s/>' % application, no_check))
+        documents = result(self.storage.get_documents_list(make_uri()))
+        self.assertEqual(sorted(documents), ['resource-lists', 'rls-services'])
+        self.assertEqual(documents['resource-lists'][0][0], 'index')
+        result(self.storage.delete_documents(make_uri()))
+        self.assertEqual(result(self.storage.get_documents_list(make_uri())), {})
+        self.assertEqual(result(self.storage.get_document(make_uri('bob@example.com'), no_check)).code, 200)
+
+    def test_watchers(self):
+        watchers = [dict(id='sip:bob@example.com', status='allow', online='true')]
+        self.storage.set_watchers('alice', 'example.com', watchers)
+        self.assertEqual(result(self.storage.get_watchers(make_uri())), watchers)
+        self.assertEqual(result(self.storage.get_watchers(make_uri('bob@example.com'))), [])
+
+    def test_snapshot(self):
+        result(self.storage.put_document(make_uri(), '<resource-lists/>', no_check))
+        self.storage.set_watchers('alice', 'example.com', [dict(id='sip:bob@example.com', status='allow', online='true')])
+        filename = tempfile.mktemp()
+        try:
+            self.storage.save_snapshot(filename)
+            users = self.storage.users
+            self.storage.users = {}
+            self.storage.load_snapshot(filename)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.assertEqual(self.storage.users.keys(), users.keys())
+        record = self.storage.users[('alice', 'example.com')]
+        self.assertEqual(record.documents, users[('alice', 'example.com')].documents)
+        self.assertEqual(record.watchers, users[('alice', 'example.com')].watchers)
+
+
+class SQLiteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = tempfile.mktemp()
+        self.connection = BlockingConnection('sqlite://%s' % self.filename)
+
+    def tearDown(self):
+        self.connection.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+    def test_translate(self):
+        self.assertEqual(sqlitedb.translate('SELECT %(a)s, %s, \'%%\''), "SELECT :a, ?, '%'")
+
+    def test_documents(self):
+        query = """INSERT INTO xcap (username, domain, doc_type, etag, doc, doc_uri)
+                   VALUES (%(username)s, %(domain)s, %(doc_type)s, %(etag)s, %(document)s, %(document_path)s)"""
+        document = '<resource-lists>%s</resource-lists>' % ('<entry uri="sip:bob@example.com"/>' * 100)
+        stored_document = sqlitedb.Binary(encode_document(document, 1024))
+        rows = [dict(username='user%d' % i, domain='example.com', doc_type=4, etag='etag%d' % i,
+                     document=stored_document, document_path='index') for i in xrange(10)]
+        self.connection.executemany(query, rows)
+        self.connection.commit()
+        self.assertEqual(self.connection.query("SELECT COUNT(*) FROM xcap"), [(10, )])
+        result = list(self.connection.iterate("SELECT username, doc FROM xcap WHERE domain = %(domain)s ORDER BY id",
+                                              dict(domain='example.com'), size=3))
+        self.assertEqual([row[0] for row in result], ['user%d' % i for i in xrange(10)])
+        self.assertEqual(decode_document(result[0][1]), document)
+
+    def test_rollback(self):
+        self.connection.query("INSERT INTO subscriber (username, domain, password) VALUES ('alice', 'example.com', 'secret')")
+        self.connection.rollback()
+        self.assertEqual(self.connection.query("SELECT COUNT(*) FROM subscriber"), [(0, )])
+
+
+class InteractionPool(object):
+    """A connection pool running the interactions right away, without a database"""
+
+    dbapi = sqlitedb
+
+    def __init__(self):
+        self.interactions = 0
+
+    def runInteraction(self, interaction, *args, **kw):
+        self.interactions += 1
+        return defer.maybeDeferred(interaction, None, *args, **kw)
+
+    def close(self):
+        pass
+
+
+class ResponseError(Exception):
+    """An error with an HTTP response, like those raised by the etag checks"""
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.response = StatusResponse(code)
+
+
+class ReplicaPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ReplicaPool([], stale=stale_replica_read)
+        self.replica = Replica('sqlite://replica', InteractionPool())
+        self.pool.replicas.append(self.replica)
+        self.primary = InteractionPool()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def read(self, response):
+        def interaction(trans):
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return self.pool.runInteraction(self.primary, interaction)
+
+    def test_conditional_get(self):
+        # a 304 for an If-None-Match poll is answered by the replica alone
+        self.assertRaises(ResponseError, result, self.read(ResponseError(304)))
+        self.assertEqual(result(self.read(StatusResponse(200, 'etag', '<resource-lists/>'))).code, 200)
+        self.assertEqual(result(self.read({'resource-lists': [('index', 'etag')]})), {'resource-lists': [('index', 'etag')]})
+        self.assertEqual((self.replica.pool.interactions, self.primary.interactions), (3, 0))
+        self.assertEqual(self.pool.statistics['fallbacks'], 0)
+
+    def test_stale(self):
+        # the replica may not have the document or the etag of an If-Match yet
+        self.assertRaises(ResponseError, result, self.read(ResponseError(412)))
+        self.assertEqual(result(self.read(StatusResponse(404))).code, 404)
+        self.assertEqual(result(self.read({})), {})
+        self.assertEqual((self.replica.pool.interactions, self.primary.interactions), (3, 3))
+        self.assertEqual(self.pool.statistics['fallbacks'], 3)
+        self.assert_(self.replica.healthy)
+
+    def test_replica_error(self):
+        self.assertRaises(sqlitedb.OperationalError, result, self.read(sqlitedb.OperationalError('disk I/O error')))
+        self.assertEqual(self.primary.interactions, 1)
+        self.assertFalse(self.replica.healthy)
+        self.assertEqual(self.pool.choose(), None)
+
+
+class KeyedLockTest(unittest.TestCase):
+
+    def test_serialized(self):
+        lock = KeyedLock()
+        calls = []
+        first = defer.Deferred()
+        d1 = lock.run('alice', lambda: first)
+        d2 = lock.run('alice', calls.append, 'second')
+        d3 = lock.run('bob', calls.append, 'other')
+        self.assertEqual(calls, ['other'])
+        first.callback(None)
+        self.assertEqual(calls, ['other', 'second'])
+        self.assertEqual(lock.statistics, dict(operations=3, waits=1))
+        self.assertEqual(lock.most_contended(), [(1, 'alice')])
+        # the locks of the keys are dropped once they are released
+        self.assertEqual(lock.locks, {})
+
+    def test_failure(self):
+        lock = KeyedLock()
+        d = lock.run('alice', lambda: defer.fail(ValueError()))
+        self.assertRaises(ValueError, result, d)
+        self.assertEqual(result(lock.run('alice', lambda: 'done')), 'done')
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_stable(self):
+        names = ['a', 'b', 'c']
+        users = [('user%d' % i, 'example.com') for i in xrange(200)]
+        shards = [shard_for_user(username, domain, names) for username, domain in users]
+        self.assertEqual(set(shards), set(names))
+        # the order of the shards doesn't matter
+        self.assertEqual(shards, [shard_for_user(username, domain, names[::-1]) for username, domain in users])
+        # removing a shard only moves its users
+        for (username, domain), shard in zip(users, shards):
+            if shard != 'c':
+                self.assertEqual(shard_for_user(username, domain, ['a', 'b']), shard)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Tests of the in-process caches, with the memory backend as the storage and
+the servers sharing it simulated by invalidation buses on a loopback transport."""
+
+import os
+import sys
+import time
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xcap.cache import LRUCache, CachingStorage, CredentialsCache, WatchersCache, ParsedDocumentCache, ValidationCache
+from xcap.interfaces.backend import memory
+from xcap.interfaces.invalidation import InvalidationBus, LoopbackTransport
+from xcap.uri import XCAPUri
+from xcap.xpath import parse_node_selector
+
+xcap_root = 'http://xcap.example.com/xcap-root'
+
+def make_uri(user='alice@example.com', application='resource-lists', document='index'):
+    return XCAPUri(xcap_root, '/%s/users/sip:%s/%s' % (application, user, document), {})
+
+def no_check(etag, exists=True):
+    pass
+
+def result(d):
+    """Return the result of a deferred that already fired, raising its error"""
+    results = []
+    d.addBoth(results.append)
+    if hasattr(results[0], 'raiseException'):
+        results[0].raiseException()
+    return results[0]
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evictions(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.set(key, key.upper())
+        cache.get('a')
+        cache.set('d', 'D')
+        self.assertEqual(sorted(cache.keys()), ['a', 'c', 'd'])
+        self.assertEqual(cache.statistics['evictions'], 1)
+
+    def test_sizes(self):
+        cache = LRUCache(10)
+        cache.set('a', 'aaaaaa', 6)
+        cache.set('b', 'bbbbbb', 6)
+        self.assertEqual((cache.keys(), cache.size), (['b'], 6))
+        # an entry larger than the cache is not stored and drops the old value
+        cache.set('b', 'b' * 20, 20)
+        self.assertEqual((len(cache), cache.size), (0, 0))
+        cache.set('a', 'aaaaaa', 6)
+        self.assertEqual(cache.pop('a'), 'aaaaaa')
+        self.assertEqual(cache.pop('a', 'x'), 'x')
+        self.assertEqual(cache.size, 0)
+
+    def test_clear(self):
+        cache = LRUCache(10)
+        cache.set('a', 'A')
+        cache.clear()
+        self.assertEqual((len(cache), cache.size, cache.get('a')), (0, 0, None))
+        cache.set('b', 'B')
+        self.assertEqual(cache.get('b'), 'B')
+
+
+class CachingStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = memory.Storage()
+        self.storage.users.clear()
+        self.buses = []
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.stop()
+        self.storage.users.clear()
+
+    def new_bus(self):
+        bus = InvalidationBus(LoopbackTransport('test-cache'))
+        self.buses.append(bus)
+        return bus
+
+    def test_hits(self):
+        cache = CachingStorage(self.storage, 1000)
+        uri = make_uri()
+        self.assertEqual(result(cache.get_document(uri, no_check)).code, 404)
+        etag = result(cache.put_document(uri, '<resource-lists/>', no_check)).etag
+        for i in xrange(3):
+            response = result(cache.get_document(uri, no_check))
+            self.assertEqual((response.code, response.etag, response.data), (200, etag, '<resource-lists/>'))
+        self.assertEqual(cache.statistics['hits'], 2)
+        self.assertEqual(cache.statistics['misses'], 2)
+        self.assertEqual(cache.statistics['size'], len('<resource-lists/>'))
+
+    def test_check_etag(self):
+        cache = CachingStorage(self.storage, 1000)
+        uri = make_uri()
+        result(cache.put_document(uri, '<resource-lists/>', no_check))
+        class EtagError(Exception): pass
+        def check_etag(etag, exists=True):
+            raise EtagError(etag)
+        for i in xrange(2):
+            # the etag of a cached document is checked as well
+            self.assertRaises(EtagError, result, cache.get_document(uri, check_etag))
+        self.assertEqual(cache.statistics['hits'], 1)
+
+    def test_writes(self):
+        cache = CachingStorage(self.storage, 1000)
+        uri = make_uri()
+        result(cache.put_document(uri, '<resource-lists/>', no_check))
+        result(cache.get_document(uri, no_check))
+        result(cache.put_document(uri, '<resource-lists>changed</resource-lists>', no_check))
+        self.assertEqual(result(cache.get_document(uri, no_check)).data, '<resource-lists>changed</resource-lists>')
+        result(cache.delete_document(uri, no_check))
+        self.assertEqual(result(cache.get_document(uri, no_check)).code, 404)
+
+    def test_pres_rules(self):
+        # both AUIDs are stored as the same document
+        cache = CachingStorage(self.storage, 1000)
+        uri = make_uri(application='pres-rules')
+        oma_uri = make_uri(application='org.openmobilealliance.pres-rules')
+        result(cache.put_document(uri, '<ruleset/>', no_check))
+        result(cache.get_document(oma_uri, no_check))
+        result(cache.put_document(uri, '<ruleset>changed</ruleset>', no_check))
+        self.assertEqual(result(cache.get_document(oma_uri, no_check)).data, '<ruleset>changed</ruleset>')
+
+    def test_max_age(self):
+        cache = CachingStorage(self.storage, 1000, max_age=60)
+        uri = make_uri()
+        result(cache.put_document(uri, '<resource-lists/>', no_check))
+        result(cache.get_document(uri, no_check))
+        # a change that this server didn't learn about
+        self.storage.users[('alice', 'example.com')].documents[('resource-lists', 'index')] = ('etag', '<resource-lists>changed</resource-lists>')
+        self.assertEqual(result(cache.get_document(uri, no_check)).data, '<resource-lists/>')
+        app_key = cache._application_key(uri)
+        cached = cache.documents.get(app_key)
+        for path, (etag, document, timestamp) in cached.items():
+            cached[path] = (etag, document, timestamp - 61)
+        self.assertEqual(result(cache.get_document(uri, no_check)).data, '<resource-lists>changed</resource-lists>')
+
+    def test_invalidation(self):
+        cache = CachingStorage(self.storage, 1000, bus=self.new_bus())
+        other_cache = CachingStorage(self.storage, 1000, bus=self.new_bus())
+        uri = make_uri()
+        result(cache.put_document(uri, '<resource-lists/>', no_check))
+        result(other_cache.get_document(uri, no_check))
+        result(cache.put_document(uri, '<resource-lists>changed</resource-lists>', no_check))
+        self.assertEqual(result(other_cache.get_document(uri, no_check)).data, '<resource-lists>changed</resource-lists>')
+        result(other_cache.get_document(uri, no_check))
+        result(cache.delete_documents(uri))
+        self.assertEqual(result(other_cache.get_document(uri, no_check)).code, 404)
+
+    def test_failed_writes_are_not_published(self):
+        cache = CachingStorage(self.storage, 1000, bus=self.new_bus())
+        other_bus = self.new_bus()
+        result(cache.delete_document(make_uri(), no_check))
+        self.assertEqual(other_bus.statistics['received'], 0)
+
+
+class CredentialsCacheTest(unittest.TestCase):
+
+    def test_ttl(self):
+        cache = CredentialsCache(10, 60, 30)
+        cache.set('alice', 'example.com', 'secret')
+        cache.set('bob', 'example.com', None)
+        self.assertEqual(cache.get('alice', 'example.com'), 'secret')
+        self.assertEqual(cache.get('bob', 'example.com'), None)
+        self.assertRaises(KeyError, cache.get, 'carol', 'example.com')
+        secret, expires = cache.entries.get(('alice', 'example.com'))
+        self.assert_(59 < expires - time.time() <= 60)
+        secret, expires = cache.entries.get(('bob', 'example.com'))
+        self.assert_(29 < expires - time.time() <= 30)
+        cache.entries.set(('alice', 'example.com'), ('secret', time.time() - 1))
+        self.assertRaises(KeyError, cache.get, 'alice', 'example.com')
+
+    def test_no_negative_ttl(self):
+        cache = CredentialsCache(10, 60, 0)
+        cache.set('bob', 'example.com', None)
+        self.assertRaises(KeyError, cache.get, 'bob', 'example.com')
+
+
+class WatchersCacheTest(unittest.TestCase):
+
+    def test_ttl(self):
+        cache = WatchersCache(10, 5)
+        cache.set('alice', 'example.com', '<watchers/>')
+        self.assertEqual(cache.get('alice', 'example.com'), '<watchers/>')
+        cache.entries.set(('alice', 'example.com'), ('<watchers/>', time.time() - 1))
+        self.assertEqual(cache.get('alice', 'example.com'), None)
+
+    def test_invalidation(self):
+        bus = InvalidationBus(LoopbackTransport('test-watchers'))
+        other_bus = InvalidationBus(LoopbackTransport('test-watchers'))
+        try:
+            cache = WatchersCache(10, 5, bus)
+            other_cache = WatchersCache(10, 5, other_bus)
+            for watchers_cache in (cache, other_cache):
+                watchers_cache.set('alice', 'example.com', '<watchers/>')
+                watchers_cache.set('bob', 'example.com', '<watchers/>')
+            cache.invalidate('alice', 'example.com')
+            for watchers_cache in (cache, other_cache):
+                self.assertEqual(watchers_cache.get('alice', 'example.com'), None)
+                self.assertEqual(watchers_cache.get('bob', 'example.com'), '<watchers/>')
+            bus.publish('watchers', '*')
+            self.assertEqual(other_cache.get('bob', 'example.com'), None)
+        finally:
+            bus.stop()
+            other_bus.stop()
+
+
+class ParsedDocumentCacheTest(unittest.TestCase):
+
+    document = '<root><a id="1"/><a id="2"><b/></a></root>'
+
+    def test_etags(self):
+        cache = ParsedDocumentCache(1000)
+        parsed = cache.get('key', 'etag', self.document)
+        self.assert_(cache.get('key', 'etag', self.document) is parsed)
+        self.assert_(cache.get('key', 'other etag', self.document) is not parsed)
+        self.assertEqual(cache.statistics['hits'], 1)
+
+    def test_size(self):
+        cache = ParsedDocumentCache(len(self.document) * 2)
+        for etag in ('1', '2', '3'):
+            cache.get('key', etag, self.document)
+        self.assertEqual(len(cache.documents), 2)
+
+    def test_find(self):
+        for index_elements in (False, True):
+            parsed = ParsedDocumentCache(1000, index_elements).get('key', 'etag', self.document)
+            selector = parse_node_selector('/root/a[@id="2"]/b')[0]
+            start = self.document.index('<b/>')
+            ancestors = []
+            self.assertEqual(parsed.find_start(selector, '/root/a[@id="2"]/b', {}, ancestors), start)
+            self.assertEqual(ancestors, [0, self.document.index('<a id="2">')])
+            self.assertEqual(parsed.find(selector)[0], start)
+            # the second time from the remembered location
+            self.assertEqual(parsed.find_start(selector, '/root/a[@id="2"]/b', {}), start)
+            self.assertEqual(parsed.find_start(parse_node_selector('/root/c')[0], '/root/c', {}), None)
+
+
+class ValidationCacheTest(unittest.TestCase):
+
+    def test_keys(self):
+        cache = ValidationCache(10)
+        cache.set(cache.key('resource-lists', '<resource-lists/>'), True)
+        self.assertEqual(cache.get(cache.key('resource-lists', '<resource-lists/>')), True)
+        self.assertEqual(cache.get(cache.key('rls-services', '<resource-lists/>')), None)
+        self.assertEqual(cache.get(cache.key('resource-lists', '<resource-lists />')), None)
+
+    def test_failures(self):
+        error = ValueError('not valid')
+        cache = ValidationCache(10)
+        cache.set(cache.key('resource-lists', '<x/>'), error)
+        self.assertEqual(cache.get(cache.key('resource-lists', '<x/>')), None)
+        cache = ValidationCache(10, cache_failures=True)
+        cache.set(cache.key('resource-lists', '<x/>'), error)
+        self.assert_(cache.get(cache.key('resource-lists', '<x/>')) is error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Tests of xcap.element that don't need a running server: the single pass
+element PUT and the element index, which must agree with the locators that
+parse the whole document."""
+
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xcap import element
+from xcap.xpath import parse_node_selector
+
+resource_lists_ns = 'urn:ietf:params:xml:ns:resource-lists'
+
+
+class InsertPointTest(unittest.TestCase):
+    """The new element is inserted after the last child of its kind, even when
+    that child is an empty element tag with the name of its parent."""
+
+    def check_insert(self, document, selector, element_str, expected, namespace=None):
+        element_selector = parse_node_selector(selector, namespace)[0]
+        for put in (element.put, element.put_element):
+            new_document, created = put(document, element_selector, element_str)
+            self.assertEqual(new_document, expected)
+            self.assert_(created)
+            self.assertEqual(element.get(new_document, element_selector), element_str)
+
+    def test_nested_same_name(self):
+        # the baseline took the end tag of the parent for that of the last child,
+        # and inserted the new element after the parent
+        self.check_insert('<root><c><c/></c></root>', '/root/c/c[@id="1"]', '<c id="1"/>',
+                          '<root><c><c/><c id="1"/></c></root>')
+        self.check_insert('<root><c><c></c></c></root>', '/root/c/c[@id="1"]', '<c id="1"/>',
+                          '<root><c><c></c><c id="1"/></c></root>')
+        self.check_insert('<root><c><c/><c/></c></root>', '/root/c/c[@id="1"]', '<c id="1"/>',
+                          '<root><c><c/><c/><c id="1"/></c></root>')
+
+    def test_nested_list(self):
+        document = '<resource-lists xmlns="%s">  <list name="friends"><list name="work"/></list></resource-lists>' % resource_lists_ns
+        expected = '<resource-lists xmlns="%s">  <list name="friends"><list name="work"/><list name="family"/></list></resource-lists>' % resource_lists_ns
+        self.check_insert(document, '/resource-lists/list[@name="friends"]/list[@name="family"]', '<list name="family"/>',
+                          expected, resource_lists_ns)
+
+    def test_root_position(self):
+        # the baseline raised AttributeError for a position on the root step
+        document = '<root><a/></root>'
+        self.check_insert(document, '/root[1]/b', '<b/>', '<root><a/><b/></root>')
+        for selector in ('/root[2]/a', '/root[2]/b'):
+            element_selector = parse_node_selector(selector)[0]
+            self.assertEqual(element.put(document, element_selector, '<b/>'), None)
+            self.assertEqual(element.put_element(document, element_selector, '<b/>'), None)
+
+    def test_replace_nested_same_name(self):
+        document = '<root><c><c id="1"/></c></root>'
+        element_selector = parse_node_selector('/root/c/c[@id="1"]')[0]
+        self.assertEqual(element.put_element(document, element_selector, '<c id="1">x</c>'),
+                         ('<root><c><c id="1">x</c></c></root>', False))
+        self.assertEqual(element.delete(document, element_selector), '<root><c></c></root>')
+
+    def test_previous_sibling(self):
+        document = '<root><a/><b><a/></b><!-- c --></root>'
+        for selector, element_str, previous in [('/root/a[@id="1"]', '<a id="1"/>', (None, 'a')),
+                                                ('/root/b[@id="1"]', '<b id="1"/>', (None, 'b')),
+                                                ('/root/c', '<c/>', (None, 'b')),
+                                                ('/root/b/c', '<c/>', (None, 'a')),
+                                                ('/root/a[1]', '<a id="1"/>', None)]:
+            context = {}
+            element.put_element(document, parse_node_selector(selector)[0], element_str, context)
+            self.assertEqual(context['previous'], previous, selector)
+        context = {}
+        element.put_element('<root><b></b></root>', parse_node_selector('/root/b/c')[0], '<c/>', context)
+        self.assertEqual(context['previous'], None)
+
+    def test_replaced(self):
+        document = '<root><a/><b xmlns="urn:b"/></root>'
+        for selector, element_str, replaced in [('/root/*[1]', '<b/>', (None, 'a')),
+                                                ('/root/*[2]', '<a/>', ('urn:b', 'b')),
+                                                ('/root/c', '<c/>', None)]:
+            context = {}
+            element.put_element(document, parse_node_selector(selector)[0], element_str, context)
+            self.assertEqual(context['replaced'], replaced, selector)
+
+
+class EndTagTest(unittest.TestCase):
+    """The element ends with its own end tag, which may have whitespace before
+    the '>', and an empty element tag ends with the '/>'."""
+
+    def check(self, document, selector, element_str, deleted):
+        element_selector = parse_node_selector(selector)[0]
+        self.assertEqual(element.get(document, element_selector), element_str)
+        self.assertEqual(element.delete(document, element_selector), deleted)
+
+    def test_whitespace(self):
+        # the baseline left out the end tag, returning '<a><b/>' and '<root></a ></root>'
+        self.check('<root><a><b/></a ></root>', '/root/a', '<a><b/></a >', '<root></root>')
+        self.check('<root><a>x</a\n></root>', '/root/a', '<a>x</a\n>', '<root></root>')
+
+    def test_empty_element(self):
+        # the baseline found the end tag in the comment, returning '<a/><!-- </a>'
+        self.check('<root><a/><!-- </a> --><b/></root>', '/root/a', '<a/>', '<root><!-- </a> --><b/></root>')
+        self.check('<root><a/>text</root>', '/root/a', '<a/>', '<root>text</root>')
+
+
+labels_xml = """<?xml version="1.0" encoding="iso-8859-1"?>
+<labels>
+  <label added="2003-06-20">
+    <quote>
+      <emph>Midwinter Spring</emph> is its own season&#8230;
+    </quote>
+    <name>Thomas Eliot</name>
+    <address>
+      <street>3 Prufrock Lane</street>
+      <city>Stamford</city>
+      <state>CT</state>
+    </address>
+  </label>
+  <comment>hello</comment>
+  <first>
+    <second>hi!</second>
+  </first>
+  <label added="2003-06-10">
+    <name>Ezra Pound</name>
+    <address>
+      <street>45 Usura Place</street>
+      <city>Hailey</city>
+      <state>ID</state>
+    </address>
+  </label>
+  <label added="yesterday"/>
+  <label added="&quot;quoted&quot;"/>
+  <comment>world</comment>
+</labels>
+"""
+
+root_xml = """<?xml version="1.0"?>
+    <root>
+     <el1 att="first"/>
+     <el1 att="second"/>
+     <!-- comment -->
+     <el2 att="first"/>
+    </root>"""
+
+root_xml_end_tags = """<?xml version="1.0"?>
+    <root>
+     <el1 att="first"></el1>
+     <el1 att="second"></el1>
+     <!-- comment -->
+     <el2 att="first"></el2>
+    </root>"""
+
+nested_xml = """<?xml version="1.0"?>
+    <root>
+     <el1><el1 att="first"/><el1></el1></el1>
+     <el1 att="second"><x/></el1 >
+     <el2 att="first"><el1 att="first"/></el2>
+    </root>"""
+
+rls_services_xml = """<?xml version="1.0" encoding="UTF-8"?>
+   <rls-services xmlns="urn:ietf:params:xml:ns:rls-services"
+      xmlns:rl="urn:ietf:params:xml:ns:resource-lists"
+      xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+    <service uri="sip:mybuddies@example.com">
+     <resource-list>http://xcap.example.com/resource-lists/users/sip:joe@example.com/index/~~/resource-lists/list%5b@name=%22l1%22%5d</resource-list>
+     <packages>
+      <package>presence</package>
+     </packages>
+    </service>
+    <service uri="sip:marketing@example.com">
+      <list name="marketing">
+        <rl:entry uri="sip:joe@example.com"/>
+        <rl:entry uri="sip:sudhir@example.com"/>
+      </list>
+      <packages>
+        <package>presence</package>
+      </packages>
+    </service>
+   </rls-services>"""
+
+
+def reference_put(document, element_selector, element_str):
+    """put with the GET(PUT(x))==x check done by parsing the new document"""
+    try:
+        result = element.put(document, element_selector, element_str)
+    except element.SelectorError, ex:
+        return ex.__class__
+    if result is not None:
+        try:
+            if element.get(result[0], element_selector) != element_str.strip():
+                return element.InvariantError
+        except element.SelectorError:
+            return element.InvariantError
+    return result
+
+def single_pass_put(document, element_selector, element_str, context=None):
+    try:
+        return element.put_element(document, element_selector, element_str, context)
+    except (element.SelectorError, element.InvariantError), ex:
+        return ex.__class__
+
+
+class PutElementTest(unittest.TestCase):
+    """put_element must give the same results as put followed by a GET of the
+    new element, and the ancestors it reports must be those of the new element."""
+
+    root_selectors = ['/root/el1[@att="third"]', '/root/el1[3][@att="third"]', '/root/*[3][@att="third"]',
+                      '/root/el3', '/root/el2[@att="2"]', '/root/el2[2][@att="2"]', '/root/*[2][@att="2"]',
+                      '/root/el2[1][@att="2"]', '/root/*[@att="2"]', '/root/el1[2]', '/root/el1[4]', '/root/el1',
+                      '/root/*', '/root/*[1]', '/root/el1[@att="first"]', '/root[1]/el2', '/root/el1[1]/el1',
+                      '/root/el1[1]/el1[2]', '/root/el1[1]/el1[@att="third"]', '/root/el2/el1', '/root/el1/x',
+                      '/root', '/root[2]/el1']
+    root_elements = ['<el1 att="third"/>', '<el2 att="2"/>', ' <el2 att="2"/> ', '<el3 att="first"/>',
+                     '<el1 att="first">x</el1>', '<el1/><!-- c -->', '<el1 xmlns="urn:other"/>', '<el1></el1>',
+                     '<root/>']
+    labels_selectors = ['/labels/label[@added="2008-08-21"]', '/labels/label[2]', '/labels/label[5]',
+                        '/labels/*[2]', '/labels/first/second', '/labels/first/third', '/labels/comment[2]',
+                        '/labels/label[1]/address/city', '/labels/label/address/city']
+    labels_elements = ['<label added="2008-08-21"/>', '<label added="2003-06-10"><name/></label>',
+                       '<comment>!</comment>', '<second>hi!</second>', '<city>Paris</city>', '<third/>']
+    rls_selectors = ['/rls-services/service[2]/list/rl:entry[1]', '/rls-services/service[2]/list/rl:entry[3]',
+                     '/rls-services/service[2]/list/rl:entry[@uri="sip:new@example.com"]',
+                     '/rls-services/service[2]/list/rl:entry[@uri="sip:joe@example.com"]',
+                     '/rls-services/service[@uri="sip:new@example.com"]']
+    rls_elements = ['<rl:entry uri="sip:first@example.com"/>', '<rl:entry uri="sip:new@example.com"/>',
+                    '<entry xmlns="urn:ietf:params:xml:ns:resource-lists" uri="sip:new@example.com"/>',
+                    '<x:entry xmlns:x="urn:ietf:params:xml:ns:resource-lists" uri="sip:joe@example.com"/>',
+                    '<entry uri="sip:new@example.com"/>', '<service uri="sip:new@example.com"/>']
+
+    def check(self, document, selectors, elements, namespace=None, namespaces={}):
+        for selector in selectors:
+            for element_str in elements:
+                element_selector = parse_node_selector(selector, namespace, namespaces)[0].fix_star(element_str)
+                description = '%s %r' % (selector, element_str)
+                expected = reference_put(document, element_selector, element_str)
+                context = {}
+                result = single_pass_put(document, element_selector, element_str, context)
+                self.assertEqual(result, expected, description)
+                if isinstance(result, tuple):
+                    new_document = result[0]
+                    start = element.find(new_document, element_selector)[0]
+                    self.assertEqual(new_document[context['start']:].find(element_str), 0, description)
+                    self.assertEqual(context['ancestors'], element.ElementIndex(new_document).ancestors(start), description)
+
+    def test_root(self):
+        for document in (root_xml, root_xml_end_tags, nested_xml):
+            self.check(document, self.root_selectors, self.root_elements)
+
+    def test_labels(self):
+        self.check(labels_xml, self.labels_selectors, self.labels_elements)
+
+    def test_rls_services(self):
+        self.check(rls_services_xml, self.rls_selectors, self.rls_elements,
+                   'urn:ietf:params:xml:ns:rls-services', {'rl': resource_lists_ns})
+
+
+class ElementIndexTest(unittest.TestCase):
+    """ElementIndex must locate the same elements as find"""
+
+    documents = [labels_xml, root_xml, root_xml_end_tags, nested_xml,
+                 '<?xml version="1.0"?><el1><el1></el1></el1>', '<?xml version="1.0"?><el1><el1/></el1>',
+                 '<a><b id="1"><b/></b ><b id="2">/></b><b id="3"/></a>']
+    selectors = ['/labels/first/second', '/labels/label', '/labels/label/quote/emph', '/labels/label[1]/name',
+                 '/labels/label[@added="2003-06-10"]/name', '/labels/*[4]/name', '/labels/*[5]', '/labels/*',
+                 '/labels[1]', '/labels[2]', '/*', '/*[1]/comment[2]', '/el1/el1', '/el1/el1[1]', '/el1/*/el1',
+                 '/root/el1[2]', '/root/el1[@att="second"]', '/root/*[3]', '/root/el2[@att="first"]',
+                 '/root/el1[1]/el1[2]', '/a/b[@id="1"]', '/a/b[@id="1"]/b', '/a/b[2]', '/a/b[@id="3"]', '/a/b/b',
+                 '/a/*[@id="2"]']
+
+    def test_find(self):
+        answered = 0
+        for document in self.documents:
+            index = element.ElementIndex(document)
+            for selector in self.selectors:
+                element_selector = parse_node_selector(selector)[0]
+                try:
+                    expected = element.find(document, element_selector)
+                except element.SelectorError, ex:
+                    expected = ex.__class__
+                try:
+                    result = index.find(element_selector)
+                except element.SelectorError, ex:
+                    result = ex.__class__
+                except element.NotIndexed:
+                    # the index may decline a selector, but must never answer it wrongly
+                    continue
+                self.assertEqual(result, expected, '%s in %r' % (selector, document[:40]))
+                answered += 1
+        self.assert_(answered > 0)
+
+    def test_ancestors(self):
+        document = '<a><b id="1"><b/></b ><b id="2"><c/></b></a>'
+        index = element.ElementIndex(document)
+        self.assertEqual(index.ancestors(document.index('<c/>')), [0, document.index('<b id="2">')])
+        self.assertEqual(index.ancestors(0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Tests of the cross-node cache invalidation bus, with the servers simulated
+by buses sharing a loopback transport."""
+
+import os
+import sys
+import time
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xcap.interfaces.invalidation import InvalidationBus, LoopbackTransport
+
+
+class InvalidationBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buses = []
+        self.received = []
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.stop()
+
+    def new_bus(self, channel='test'):
+        bus = InvalidationBus(LoopbackTransport(channel))
+        self.buses.append(bus)
+        return bus
+
+    def record(self, *key):
+        self.received.append(key)
+
+    def test_publish(self):
+        bus = self.new_bus()
+        other_bus = self.new_bus()
+        bus.subscribe('document', self.record)
+        other_bus.subscribe('document', self.record)
+        bus.publish('document', 'alice@example.com', 'resource-lists')
+        # the server that published the change doesn't receive it
+        self.assertEqual(self.received, [('alice@example.com', 'resource-lists')])
+        self.assertEqual(bus.statistics['sent'], 1)
+        self.assertEqual(bus.statistics['received'], 0)
+        self.assertEqual(other_bus.statistics['received'], 1)
+
+    def test_kinds(self):
+        bus = self.new_bus()
+        other_bus = self.new_bus()
+        other_bus.subscribe('user', self.record)
+        bus.publish('document', 'alice@example.com', 'resource-lists')
+        self.assertEqual(self.received, [])
+        bus.publish('user', 'alice@example.com')
+        bus.publish('user', '*')
+        self.assertEqual(self.received, [('alice@example.com', ), ('*', )])
+
+    def test_channels(self):
+        bus = self.new_bus('test')
+        other_bus = self.new_bus('other')
+        other_bus.subscribe('document', self.record)
+        bus.publish('document', 'alice@example.com', 'resource-lists')
+        self.assertEqual(self.received, [])
+
+    def test_stop(self):
+        bus = self.new_bus()
+        other_bus = InvalidationBus(LoopbackTransport('test'))
+        other_bus.subscribe('document', self.record)
+        other_bus.stop()
+        bus.publish('document', 'alice@example.com', 'resource-lists')
+        self.assertEqual(self.received, [])
+
+    def test_failing_subscriber(self):
+        bus = self.new_bus()
+        other_bus = self.new_bus()
+        def fail(*key):
+            raise RuntimeError('failed')
+        other_bus.subscribe('document', fail)
+        other_bus.subscribe('document', self.record)
+        bus.publish('document', 'alice@example.com', 'resource-lists')
+        self.assertEqual(self.received, [('alice@example.com', 'resource-lists')])
+
+    def test_invalid_messages(self):
+        bus = self.new_bus()
+        bus.subscribe('document', self.record)
+        for data in ['', 'XXX1\tnode\t0\tdocument\tx', 'OXI1\tnode\tnot a time\tdocument\tx', 'OXI1\tnode\t0']:
+            bus.receive(data)
+        self.assertEqual(self.received, [])
+        self.assertEqual(bus.statistics['errors'], 4)
+        self.assertEqual(bus.statistics['received'], 0)
+
+    def test_lag(self):
+        bus = self.new_bus()
+        self.assertEqual(bus.average_lag, 0.0)
+        bus.receive('OXI1\tnode\t%.6f\tdocument\tx' % (time.time() - 10))
+        bus.receive('OXI1\tnode\t%.6f\tdocument\tx' % (time.time() + 10))
+        # a message from a server with a clock ahead has no lag
+        self.assertEqual(bus.statistics['received'], 2)
+        self.assert_(10 <= bus.statistics['lag_max'] < 11, bus.statistics)
+        self.assert_(5 <= bus.average_lag < 5.5, bus.average_lag)
+
+
+if __name__ == '__main__':
+    unittest.main()
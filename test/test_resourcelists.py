@@ -127,5 +127,39 @@ class DocumentTest(XCAPTest):
 #        # check body for <contstraint-failure>
 
 
+resource_lists_xml_extension = """<?xml version="1.0" encoding="UTF-8"?>
+   <resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists">
+    <list name="a"><display-name>x</display-name><foo:ext xmlns:foo="urn:foo"/></list>
+   </resource-lists>"""
+
+
+class ElementTest(XCAPTest):
+
+    def test_put_after_extension(self):
+        # an entry can't follow the extension elements of its list; adding one
+        # where no other entry is must have the whole document validated
+        self.put('resource-lists', resource_lists_xml_extension)
+        self.put_new('resource-lists', '<entry uri="sip:y@example.com"/>',
+                     '/resource-lists/list[@name="a"]/entry[@uri="sip:y@example.com"]', status=409)
+        self.assertDocument('resource-lists', resource_lists_xml_extension)
+
+    def test_put_after_entry(self):
+        document = resource_lists_xml_extension.replace('</display-name>', '</display-name><entry uri="sip:x@example.com"/>')
+        self.put('resource-lists', document)
+        self.put_new('resource-lists', '<entry uri="sip:y@example.com"/>',
+                     '/resource-lists/list[@name="a"]/entry[@uri="sip:y@example.com"]')
+        self.assertDocument('resource-lists', document.replace('/>', '/><entry uri="sip:y@example.com"/>', 1))
+
+    def test_replace_with_other_kind(self):
+        # the display-name of a list can't follow its entries, replacing the
+        # extension element with one must have the whole document validated
+        document = resource_lists_xml_extension.replace('</display-name>', '</display-name><entry uri="sip:x@example.com"/>')
+        self.put('resource-lists', document)
+        r = self.put('resource-lists', '<display-name>y</display-name>', '/resource-lists/list[@name="a"]/*[3]', status=409)
+        self.assertInBody(r, '<schema-validation-error')
+        self.assertDocument('resource-lists', document)
+        self.put('resource-lists', '<foo:ext xmlns:foo="urn:foo">y</foo:ext>', '/resource-lists/list[@name="a"]/*[3]', status=200)
+
+
 if __name__ == '__main__':
     runSuiteFromModule()
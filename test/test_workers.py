@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Tests of the statistics kept for the work done by the pools of workers"""
+
+import os
+import sys
+import threading
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xcap import errors
+from xcap import workers
+from xcap.workers import StageStatistics
+
+
+class StageStatisticsTest(unittest.TestCase):
+
+    def test_add(self):
+        statistics = StageStatistics('test')
+        def add():
+            for i in xrange(1000):
+                statistics.add('parse', 0.001)
+        threads = [threading.Thread(target=add) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        statistics.add('parse', 0.5)
+        [(stage, parse)] = statistics.items()
+        self.assertEqual((stage, parse['count'], parse['max_time']), ('parse', 4001, 0.5))
+        self.assertAlmostEqual(parse['time'], 4.5)
+
+    def test_process_stages(self):
+        statistics = StageStatistics('test')
+        def validate(document):
+            statistics.add('parse', 0.25)
+            if document is None:
+                raise errors.NotWellFormedError()
+            statistics.add('constraints', 0.5)
+            return document
+        result = workers._run_in_process(validate, ('<root/>', ))
+        self.assertEqual(result[:2], (True, '<root/>'))
+        self.assertEqual(result[-1], [('test', 'parse', 0.25), ('test', 'constraints', 0.5)])
+        result = workers._run_in_process(validate, (None, ))
+        self.assertEqual((result[0], result[1][0]), (False, 409))
+        self.assertEqual(result[-1], [('test', 'parse', 0.25)])
+        # the times are only counted once they are sent back to the server
+        self.assertEqual(statistics.items(), [])
+        StageStatistics.add_stages(result[-1] + [('unknown', 'parse', 1.0)])
+        self.assertEqual(statistics.items(), [('parse', dict(count=1, time=0.25, max_time=0.25))])
+
+
+if __name__ == '__main__':
+    unittest.main()
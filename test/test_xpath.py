@@ -11,6 +11,7 @@ import sys
 sys.path = ['../..'] + sys.path
 import xcap.xpath
 from xcap.uri import XCAPUri
+from lxml import _elementpath as ElementPath
 
 
 default_namespaces = {'org.openxcap.watchers': 'http://openxcap.org/ns/watchers',
@@ -80,6 +81,23 @@ class XPathTest(unittest.TestCase):
         self.assertEqual(xcap.xpath.NamespaceSelector, type(u.node_selector.terminal_selector))
 
 
+class XPathTokenizerTest(unittest.TestCase):
+
+    def test_same_as_lxml(self):
+        # without a namespace prefix, the tokens are those of lxml's ElementPath tokenizer
+        for selector in ['resource-lists', 'list[@name="friends"]', "entry[@uri='sip:a@example.org']",
+                         '/labels/label[2]/address', '*[3][@att="x"]', '{urn:x}list/entry', 'a/b[1]/@c']:
+            self.assertEqual(xcap.xpath._xpath_tokenizer_re.findall(selector), list(ElementPath.xpath_tokenizer(selector)))
+
+    def test_prefix(self):
+        # lxml raises SyntaxError for a prefix missing from its prefix map
+        # and resolves prefix:name to {namespace}name otherwise
+        self.assertEqual(xcap.xpath.XPathTokenizer.tokens('rl:entry[@uri="sip:a@example.org"]'),
+                         ['rl', ':', 'entry', '[', '@', 'uri', '=', 'sip:a@example.org', ']'])
+        self.assertEqual(xcap.xpath.XPathTokenizer.tokens('cp:rule[@cp:id="1"]'),
+                         ['cp', ':', 'rule', '[', '@', 'cp', ':', 'id', '=', '1', ']'])
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -6,18 +6,26 @@
 
 import os
 import sys
+import threading
+import time
 
 from cStringIO import StringIO
 from lxml import etree
+from twisted.internet import defer, reactor, task
 
 from application.configuration import ConfigSection, ConfigSetting
 from application.configuration.datatypes import StringList
 from application import log
+from application.python.types import Singleton
 
 import xcap
 from xcap import errors
 from xcap import element
+from xcap.cache import CachingStorage, ParsedDocument, get_parsed_document_cache, get_validation_cache, Config as CacheConfig
+from xcap.interfaces.invalidation import get_invalidation_bus
 from xcap.interfaces.backend import StatusResponse
+from xcap.logutil import Logging as LoggingConfig
+from xcap.workers import StageStatistics, defer_to_workers, get_worker_pool, Config as WorkersConfig
 
 
 class Backend(object):
@@ -42,9 +50,60 @@ class ServerConfig(ConfigSection):
     disabled_applications = ConfigSetting(type=StringList, value=[])
     document_validation = True
 
-if ServerConfig.backend is None:
-    log.fatal("OpenXCAP needs a backend to be specified in order to run")
-    sys.exit(1)
+
+class EverythingIsValid(object):
+    def __call__(self, *args, **kw):
+        return True
+    def validate(self, *args, **kw):
+        return True
+
+everything_is_valid = EverythingIsValid()
+
+def _tag_name(tag):
+    """Return the (namespace, name) of the tag of an lxml element"""
+    if tag.startswith('{'):
+        return tuple(tag[1:].split('}', 1))
+    return (None, tag)
+
+
+class SchemaRegistry(object):
+    """The XML schemas of the applications, shared by all of them. Each schema
+    is compiled once per process, when it is first used or by warmup."""
+    __metaclass__ = Singleton
+
+    directory = os.path.join(os.path.dirname(__file__), 'xml-schemas')
+
+    def __init__(self):
+        self.schemas = {}
+        self._lock = threading.Lock()
+
+    def get(self, schema_file):
+        try:
+            return self.schemas[schema_file]
+        except KeyError:
+            pass
+        self._lock.acquire()
+        try:
+            schema = self.schemas.get(schema_file)
+            if schema is None:
+                schema = self.schemas[schema_file] = etree.XMLSchema(etree.parse(os.path.join(self.directory, schema_file)))
+            return schema
+        finally:
+            self._lock.release()
+
+    def warmup(self, schema_files, background=True):
+        """Compile the given schemas, in a thread of their own if background is True"""
+        def compile_schemas():
+            start = time.time()
+            for schema_file in schema_files:
+                self.get(schema_file)
+            log.msg("Compiled %d XML schemas in %.3f seconds" % (len(schema_files), time.time() - start))
+        if background:
+            thread = threading.Thread(target=compile_schemas, name='schema-warmup')
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            compile_schemas()
 
 
 class ApplicationUsage(object):
@@ -54,20 +113,26 @@ class ApplicationUsage(object):
     mime_type = None         ## the MIME type
     schema_file = None       ## filename of the schema for the application
 
+    ## if True, the validity of a document doesn't depend on identity constraints
+    ## between its elements (xs:unique, xs:key, xs:ID), so the element changed by
+    ## an element or attribute PUT can be validated on its own (see _validate_element)
+    incremental_validation = False
+    ## the children that the schema allows any number of times next to each other:
+    ## {parent (namespace, name): set of child (namespace, name)}
+    repeated_elements = {}
+
     def __init__(self, storage):
-        ## the XML schema that defines valid documents for this application
-        if self.schema_file:
-            xml_schema_doc = etree.parse(open(os.path.join(os.path.dirname(__file__), 'xml-schemas', self.schema_file), 'r'))
-            self.xml_schema = etree.XMLSchema(xml_schema_doc)
-        else:
-            class EverythingIsValid(object):
-                def __call__(self, *args, **kw):
-                    return True
-                def validate(self, *args, **kw):
-                    return True
-            self.xml_schema = EverythingIsValid()
         if storage is not None:
             self.storage = storage
+        ## the time spent in each stage of the validation pipeline
+        self.validation_statistics = StageStatistics(self.id)
+
+    @property
+    def xml_schema(self):
+        """The XML schema that defines valid documents for this application"""
+        if self.schema_file:
+            return SchemaRegistry().get(self.schema_file)
+        return everything_is_valid
 
     ## Validation
 
@@ -81,26 +146,107 @@ class ApplicationUsage(object):
         if not self.xml_schema(xml_doc):
             raise errors.SchemaValidationError(comment=self.xml_schema.error_log)
 
-    def _check_additional_constraints(self, xml_doc):
+    def _check_additional_constraints(self, xml_doc, uri=None):
         """Check additional validations constraints for this XCAP document. Should be
            overriden in subclasses if specified by the application usage, and raise
-           a ConstraintFailureError if needed."""
+           a ConstraintFailureError if needed. uri is the XCAPUri the document is
+           stored at, or None when the document is validated on its own (as when
+           an archive is imported)."""
 
-    def validate_document(self, xcap_doc):
-        """Check if a document is valid for this application."""
+    def _parse(self, xcap_doc, parser=None):
         try:
-            xml_doc = etree.parse(StringIO(xcap_doc))
-            # XXX do not use TreeBuilder here
+            return etree.parse(StringIO(xcap_doc), parser)
         except etree.XMLSyntaxError, ex:
             ex.http_error = errors.NotWellFormedError(comment=str(ex))
             raise
         except Exception, ex:
             ex.http_error = errors.NotWellFormedError()
             raise
-        self._check_UTF8_encoding(xml_doc)
-        if ServerConfig.document_validation:
+
+    def _parse_and_validate(self, xcap_doc):
+        """Parse the document, validating it against the application's schema
+        during the parse if document validation is enabled."""
+        if not ServerConfig.document_validation or not isinstance(self.xml_schema, etree.XMLSchema):
+            return self._parse(xcap_doc)
+        try:
+            return self._parse(xcap_doc, etree.XMLParser(schema=self.xml_schema))
+        except etree.XMLSyntaxError, ex:
+            # the schema errors are reported as soon as they are found, before
+            # the syntax and encoding errors of the document, so parse it again
+            # without the schema to report the errors in the usual order
+            xml_doc = self._parse(xcap_doc)
+            self._check_UTF8_encoding(xml_doc)
             self._check_schema_validation(xml_doc)
-        self._check_additional_constraints(xml_doc)
+            ex.http_error = errors.SchemaValidationError(comment=str(ex))
+            raise
+
+    def _run_stage(self, stage, function, *args):
+        """Run a stage of the validation pipeline and add its time to the statistics"""
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.validation_statistics.add(stage, time.time() - start)
+
+    def _check_element_constraints(self, elem, uri, element_selector, attribute=None):
+        """Check the additional constraints for elem, an element changed by an
+           element PUT (or by the PUT of attribute) with element_selector, in a
+           document made of elem and its ancestors only. Return False if they
+           can only be checked in the whole document."""
+        return True
+
+    def _validate_element(self, uri, document, ancestors, element_str, element_selector, attribute=None, created=False, previous=None, replaced=None):
+        """Validate element_str, an element which an element or attribute PUT
+        put in document, inside copies of its ancestors instead of validating the
+        whole document. created is True if the element was added by an element
+        PUT, right after an element whose (namespace, name) is previous, else it
+        replaced an element whose (namespace, name) is replaced. Return False if
+        the whole document needs to be validated, because the application
+        doesn't allow it, the element wasn't added right after one of its kind
+        which may be repeated, it replaced an element of another kind, or it
+        isn't valid in this context (the error of the whole document is
+        reported then)."""
+        if not self.incremental_validation or not ancestors:
+            return False
+        if created:
+            name = element_selector[-1].name
+            if previous != name:
+                # the first element of its kind in the parent, or added after
+                # an element of another kind, which may not be followed by it
+                return False
+            if name not in self.repeated_elements.get(element_selector[-2].name, ()):
+                return False
+        try:
+            xml_doc = self._run_stage('element', self._parse_and_validate, element.wrap_element(document, ancestors, element_str))
+        except Exception:
+            return False
+        elem = xml_doc.getroot()
+        for i in xrange(len(ancestors)):
+            elem = [child for child in elem if isinstance(child.tag, basestring)][0]
+        if not created and attribute is None and _tag_name(elem.tag) != replaced:
+            # its siblings may not allow an element of this kind at its position
+            return False
+        for child in elem.iter():
+            if '{%s}id' % element.XML_NAMESPACE in child.attrib:
+                # xml:id must be unique in the whole document
+                return False
+        return self._run_stage('element constraints', self._check_element_constraints, elem, uri, element_selector, attribute)
+
+    def _validation_key(self, uri):
+        """Return what the outcome of validate_document for a document PUT at uri
+           depends on, besides the document, as the key of the validation cache.
+           Applications whose additional constraints look at uri must add the
+           parts of it they use."""
+        return (self.id, ServerConfig.document_validation)
+
+    def validate_document(self, xcap_doc, uri=None):
+        """Check if a document is valid for this application and return its
+        lxml tree. The document is parsed once and the tree is passed through
+        the encoding check and the additional constraints of the application."""
+        xml_doc = self._run_stage('parse', self._parse_and_validate, xcap_doc)
+        self._run_stage('encoding', self._check_UTF8_encoding, xml_doc)
+        self._run_stage('constraints', self._check_additional_constraints, xml_doc, uri)
+        return xml_doc
 
     ## Authorization policy
 
@@ -132,51 +278,100 @@ class ApplicationUsage(object):
         return self.storage.get_document(uri, check_etag)
 
     def put_document(self, uri, document, check_etag):
-        self.validate_document(document)
-        return self.storage.put_document(uri, document, check_etag)
+        cache = get_validation_cache()
+        if cache is None:
+            d = defer_to_workers(len(document), _validate_document, self.id, document, uri)
+        else:
+            key = cache.key(self._validation_key(uri), document)
+            result = cache.get(key)
+            if result is True:
+                d = defer.succeed(None)
+            elif result is not None:
+                d = defer.fail(result)
+            else:
+                d = defer_to_workers(len(document), _validate_document, self.id, document, uri)
+                d.addCallbacks(self._cb_validated, self._eb_validated, callbackArgs=(cache, key), errbackArgs=(cache, key))
+        d.addCallback(lambda result: self.storage.put_document(uri, document, check_etag))
+        return d
+
+    def _cb_validated(self, result, cache, key):
+        cache.set(key, True)
+        return result
+
+    def _eb_validated(self, failure, cache, key):
+        # the errors the document is rejected with are remembered, not the unexpected ones
+        if isinstance(failure.value, errors.XCAPError) or getattr(failure.value, 'http_error', None) is not None:
+            cache.set(key, failure.value)
+        return failure
 
     def delete_document(self, uri, check_etag):
         return self.storage.delete_document(uri, check_etag)
 
+    def store_document(self, uri, document, check_etag, validated=False):
+        """Store document with put_document or, if it was validated already,
+        directly in the storage. When the elements of the documents are indexed,
+        the index of the new document is built by the first element request
+        that needs it."""
+        if validated:
+            return self.storage.put_document(uri, document, check_etag)
+        else:
+            return self.put_document(uri, document, check_etag)
+
+    def _parsed_document(self, uri, response):
+        """Return the ParsedDocument for the document in response, cached by its etag"""
+        cache = get_parsed_document_cache()
+        if cache is None or response.etag is None:
+            return ParsedDocument(response.data)
+        return cache.get((str(uri.user), self.id, uri.doc_selector.document_path), response.etag, response.data)
+
     ## Element management
 
     def _cb_put_element(self, response, uri, element_body, check_etag):
         """This is called when the document that relates to the element is retrieved."""
         if response.code == 404:          ### XXX let the storate raise
             raise errors.NoParentError    ### catch error in errback and attach http_error
+        d = defer_to_workers(len(response.data), _put_element, self.id, uri, response.data, element_body)
+        d.addCallback(self._cb_store_element, uri, check_etag)
+        return d
 
+    def _put_element(self, uri, document, element_body):
+        """Return (new_document, created, validated) for the PUT of element_body
+        in document, validated being True if the new element was validated."""
         fixed_element_selector = uri.node_selector.element_selector.fix_star(element_body)
 
+        context = {}
         try:
-            result = element.put(response.data, fixed_element_selector, element_body)
+            result = element.put_element(document, fixed_element_selector, element_body, context)
         except element.SelectorError, ex:
             ex.http_error = errors.NoParentError(comment=str(ex))
             raise
+        except element.InvariantError, ex:
+            raise errors.CannotInsertError(str(ex))
 
         if result is None:
             raise errors.NoParentError
 
         new_document, created = result
-        get_result = element.get(new_document, uri.node_selector.element_selector)
-
-        if get_result != element_body.strip():
-            raise errors.CannotInsertError('PUT request failed GET(PUT(x))==x invariant')
-
-        d = self.put_document(uri, new_document, check_etag)
 
-        def set_201_code(response):
-            try:
-                if response.code==200:
-                    response.code = 201
-            except AttributeError:
-                pass
-            return response
+        validated = self._validate_element(uri, new_document, context['ancestors'], element_body, fixed_element_selector,
+                                           created=created, previous=context['previous'], replaced=context['replaced'])
+        return new_document, created, validated
 
+    def _cb_store_element(self, result, uri, check_etag):
+        new_document, created, validated = result
+        d = self.store_document(uri, new_document, check_etag, validated)
         if created:
-            d.addCallback(set_201_code)
-
+            d.addCallback(self._set_201_code)
         return d
 
+    def _set_201_code(self, response):
+        try:
+            if response.code==200:
+                response.code = 201
+        except AttributeError:
+            pass
+        return response
+
     def put_element(self, uri, element_body, check_etag):
         try:
             element.check_xml_fragment(element_body)
@@ -193,7 +388,8 @@ class ApplicationUsage(object):
         """This is called when the document related to the element is retrieved."""
         if response.code == 404:     ## XXX why not let the storage raise?
             raise errors.ResourceNotFound("The requested document %s was not found on this server" % uri.doc_selector)
-        result = element.get(response.data, uri.node_selector.element_selector)
+        location = self._parsed_document(uri, response).find(uri.node_selector.element_selector)
+        result = location and response.data[location[0]:location[1]]
         if not result:
             msg = "The requested element %s was not found in the document %s" % (uri.node_selector, uri.doc_selector)
             raise errors.ResourceNotFound(msg)
@@ -206,13 +402,13 @@ class ApplicationUsage(object):
     def _cb_delete_element(self, response, uri, check_etag):
         if response.code == 404:
             raise errors.ResourceNotFound("The requested document %s was not found on this server" % uri.doc_selector)
-        new_document = element.delete(response.data, uri.node_selector.element_selector)
+        location = self._parsed_document(uri, response).find(uri.node_selector.element_selector)
+        new_document = location and response.data[:location[0]] + response.data[location[1]:]
         if not new_document:
             raise errors.ResourceNotFound
-        get_result = element.find(new_document, uri.node_selector.element_selector)
-        if get_result:
-            raise errors.CannotDeleteError('DELETE request failed GET(DELETE(x))==404 invariant')
-        return self.put_document(uri, new_document, check_etag)
+        d = defer_to_workers(len(new_document), _check_deleted_element, new_document, uri.node_selector.element_selector)
+        d.addCallback(lambda result: self.store_document(uri, new_document, check_etag))
+        return d
 
     def delete_element(self, uri, check_etag):
         d = self.get_document(uri, check_etag)
@@ -223,8 +419,7 @@ class ApplicationUsage(object):
         """This is called when the document that relates to the attribute is retrieved."""
         if response.code == 404:
             raise errors.ResourceNotFound
-        document = response.data
-        xml_doc = etree.parse(StringIO(document))
+        xml_doc = self._parsed_document(uri, response).tree
         application = getApplicationForURI(uri)
         ns_dict = uri.node_selector.get_ns_bindings(application.default_ns)
         try:
@@ -249,27 +444,24 @@ class ApplicationUsage(object):
     def _cb_delete_attribute(self, response, uri, check_etag):
         if response.code == 404:
             raise errors.ResourceNotFound
-        document = response.data
-        xml_doc = etree.parse(StringIO(document))
+        element_selector = uri.node_selector.element_selector
         application = getApplicationForURI(uri)
         ns_dict = uri.node_selector.get_ns_bindings(application.default_ns)
         try:
-            elem = xml_doc.xpath(uri.node_selector.replace_default_prefix(append_terminal=False),namespaces=ns_dict)
+            start = self._parsed_document(uri, response).find_start(element_selector,
+                        uri.node_selector.replace_default_prefix(append_terminal=False), ns_dict)
+        except element.SelectorError:
+            raise errors.ResourceNotFound('XPATH expression is ambiguous')
         except Exception, ex:
             ex.http_error = errors.ResourceNotFound()
             raise
-        if not elem:
+        if start is None:
             raise errors.ResourceNotFound
-        if len(elem) != 1:
-            raise errors.ResourceNotFound('XPATH expression is ambiguous')
-        elem = elem[0]
         attribute = uri.node_selector.terminal_selector.attribute
-        if elem.get(attribute):  ## check if the attribute exists XXX use KeyError instead
-            del elem.attrib[attribute]
-        else:
+        new_document = element.delete_attribute(response.data, element_selector, attribute, start)
+        if new_document is None:
             raise errors.ResourceNotFound
-        new_document = etree.tostring(xml_doc, encoding='UTF-8', xml_declaration=True)
-        return self.put_document(uri, new_document, check_etag)
+        return self.store_document(uri, new_document, check_etag)
 
     def delete_attribute(self, uri, check_etag):
         d = self.get_document(uri, check_etag)
@@ -279,27 +471,42 @@ class ApplicationUsage(object):
         """This is called when the document that relates to the element is retrieved."""
         if response.code == 404:
             raise errors.NoParentError
-        document = response.data
-        xml_doc = etree.parse(StringIO(document))
+        element_selector = uri.node_selector.element_selector
         application = getApplicationForURI(uri)
         ns_dict = uri.node_selector.get_ns_bindings(application.default_ns)
+        ancestors = []
         try:
-            elem = xml_doc.xpath(uri.node_selector.replace_default_prefix(append_terminal=False),namespaces=ns_dict)
+            start = self._parsed_document(uri, response).find_start(element_selector,
+                        uri.node_selector.replace_default_prefix(append_terminal=False), ns_dict, ancestors)
+        except element.SelectorError:
+            raise errors.NoParentError('XPATH expression is ambiguous')
         except Exception, ex:
             ex.http_error = errors.NoParentError()
             raise
-        if not elem:
+        if start is None:
             raise errors.NoParentError
-        if len(elem) != 1:
-            raise errors.NoParentError('XPATH expression is ambiguous')
-        elem = elem[0]
         attr_name = uri.node_selector.terminal_selector.attribute
-        elem.set(attr_name, attribute)
-        new_document = etree.tostring(xml_doc, encoding='UTF-8', xml_declaration=True)
-        return self.put_document(uri, new_document, check_etag)
+        try:
+            new_document, created = element.put_attribute(response.data, element_selector, attr_name, attribute, start)
+        except element.InvariantError, ex:
+            raise errors.CannotInsertError(str(ex))
+        validated = False
+        if ':' not in attr_name:
+            # the element, without its content which didn't change
+            start_tag = new_document[start:element.start_tag_end(new_document, start)]
+            if not start_tag.endswith('/>'):
+                start_tag = start_tag[:-1] + '/>'
+            validated = self._validate_element(uri, new_document, ancestors, start_tag, element_selector, attribute=attr_name)
+        d = self.store_document(uri, new_document, check_etag, validated)
+        if created:
+            d.addCallback(self._set_201_code)
+        return d
 
     def put_attribute(self, uri, attribute, check_etag):
-        ## TODO verify if the attribute is valid
+        try:
+            attribute.decode('utf-8')
+        except UnicodeDecodeError:
+            raise errors.NotXMLAtrributeValueError(comment='the attribute value is not UTF-8 encoded')
         d = self.get_document(uri, check_etag)
         return d.addCallbacks(self._cb_put_attribute, callbackArgs=(uri, attribute, check_etag))
 
@@ -308,8 +515,7 @@ class ApplicationUsage(object):
         """This is called when the document that relates to the element is retrieved."""
         if response.code == 404:
             raise errors.ResourceNotFound
-        document = response.data
-        xml_doc = etree.parse(StringIO(document))
+        xml_doc = self._parsed_document(uri, response).tree
         application = getApplicationForURI(uri)
         ns_dict = uri.node_selector.get_ns_bindings(application.default_ns)
         try:
@@ -345,35 +551,108 @@ from xcap.appusage.rlsservices import RLSServicesApplication
 from xcap.appusage.test import TestApplication
 from xcap.appusage.watchers import WatchersApplication
 
-storage = ServerConfig.backend.Storage()
-
-applications = {
-                DialogRulesApplication.id:          DialogRulesApplication(storage),
-                PIDFManipulationApplication.id:     PIDFManipulationApplication(storage),
-                PresenceRulesApplication.id:        PresenceRulesApplication(storage),
-                PresenceRulesApplication.oma_id:    PresenceRulesApplication(storage),
-                PurgeApplication.id:                PurgeApplication(storage),
-                ResourceListsApplication.id:        ResourceListsApplication(storage),
-                RLSServicesApplication.id:          RLSServicesApplication(storage),
-                TestApplication.id:                 TestApplication(storage),
-                WatchersApplication.id:             WatchersApplication(storage),
-                XCAPCapabilitiesApplication.id:     XCAPCapabilitiesApplication(),
-                XCAPDirectoryApplication.id:        XCAPDirectoryApplication(storage)
+## the application usages by AUID
+application_classes = {
+                DialogRulesApplication.id:          DialogRulesApplication,
+                PIDFManipulationApplication.id:     PIDFManipulationApplication,
+                PresenceRulesApplication.id:        PresenceRulesApplication,
+                PresenceRulesApplication.oma_id:    PresenceRulesApplication,
+                PurgeApplication.id:                PurgeApplication,
+                ResourceListsApplication.id:        ResourceListsApplication,
+                RLSServicesApplication.id:          RLSServicesApplication,
+                TestApplication.id:                 TestApplication,
+                WatchersApplication.id:             WatchersApplication,
+                XCAPCapabilitiesApplication.id:     XCAPCapabilitiesApplication,
+                XCAPDirectoryApplication.id:        XCAPDirectoryApplication,
+                PresContentApplication.id:          PresContentApplication
                 }
 
-# public GET applications (GET is not challenged for auth)
-public_get_applications = {PresContentApplication.id: PresContentApplication(storage)}
-applications.update(public_get_applications)
+def create_applications(storage=None):
+    """Return the enabled application usages by AUID, with storage as their
+    backend. Without a storage they can only validate documents."""
+    applications = {}
+    for (application_id, application_class) in application_classes.items():
+        if application_id in ServerConfig.disabled_applications:
+            continue
+        # an application usage with several AUIDs (pres-rules) has a single instance
+        for application in applications.itervalues():
+            if application.__class__ is application_class:
+                break
+        else:
+            if application_class is XCAPCapabilitiesApplication:
+                application = application_class()
+            else:
+                application = application_class(storage)
+        applications[application_id] = application
+    return applications
 
-for application in ServerConfig.disabled_applications:
-    applications.pop(application, None)
+## the application usages of the server, created by setup_applications
+applications = {}
 
-namespaces = dict((k, v.default_ns) for (k, v) in applications.items())
+# public GET applications (GET is not challenged for auth)
+public_get_applications = {}
+
+namespaces = {}
+
+def setup_applications():
+    """Create the storage and the application usages of the server, compile
+    their schemas and start the worker processes. Importing this package has
+    no such side effects, so that the tools which only validate documents can
+    use the application usages returned by create_applications."""
+    if applications:
+        return
+    if ServerConfig.backend is None:
+        log.fatal("OpenXCAP needs a backend to be specified in order to run")
+        sys.exit(1)
+    storage = ServerConfig.backend.Storage()
+    if CacheConfig.document_cache_size or get_invalidation_bus() is not None:
+        # with an invalidation bus the wrapper is needed to publish the changes
+        # made through this server, even if it doesn't cache documents itself
+        storage = CachingStorage(storage, CacheConfig.document_cache_size, CacheConfig.document_max_age, get_invalidation_bus())
+    applications.update(create_applications(storage))
+    public_get_applications.update((application_id, applications[application_id]) for application_id in [PresContentApplication.id] if application_id in applications)
+    namespaces.update((k, v.default_ns) for (k, v) in applications.items())
+    # the schemas are compiled before the worker processes are started, which
+    # then share them, or in the background once the server runs
+    schema_files = sorted(set(application.schema_file for application in applications.values() if application.schema_file))
+    if WorkersConfig.count and WorkersConfig.type.lower() == 'process':
+        SchemaRegistry().warmup(schema_files, background=False)
+    else:
+        reactor.callWhenRunning(SchemaRegistry().warmup, schema_files)
+    # the worker processes are started once the applications exist, before
+    # the backend starts its threads, and get a copy of them
+    get_worker_pool()
+    if LoggingConfig.statistics_interval:
+        reactor.callWhenRunning(task.LoopingCall(log_statistics).start, LoggingConfig.statistics_interval, now=False)
+
+def log_statistics():
+    """Log the time spent in each stage of the validation by the applications
+    and the statistics of the worker pool"""
+    for application in set(applications.itervalues()):
+        for stage, statistics in application.validation_statistics.items():
+            log.msg("Validation of %s, %s: %d times, %.2fms average, %.2fms max" % (application.id, stage, statistics['count'],
+                                                                                  statistics['time']*1000/statistics['count'], statistics['max_time']*1000))
+    pool = get_worker_pool()
+    if pool is not None:
+        pool.log_statistics()
 
 def getApplicationForURI(xcap_uri):
     return applications.get(xcap_uri.application_id, None)
 
+## The work done by the workers, with arguments and results that can be sent to worker processes
+
+def _validate_document(application_id, document, uri):
+    applications[application_id].validate_document(document, uri)
+
+def _put_element(application_id, uri, document, element_body):
+    return applications[application_id]._put_element(uri, document, element_body)
+
+def _check_deleted_element(document, element_selector):
+    if element.find(document, element_selector):
+        raise errors.CannotDeleteError('DELETE request failed GET(DELETE(x))==404 invariant')
+
 
-__all__ = ['applications', 'namespaces', 'public_get_applications', 'getApplicationForURI', 'ApplicationUsage', 'Backend']
+__all__ = ['applications', 'namespaces', 'public_get_applications', 'getApplicationForURI', 'create_applications', 'setup_applications', 'log_statistics',
+           'ApplicationUsage', 'Backend', 'SchemaRegistry']
 
 
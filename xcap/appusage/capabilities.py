@@ -16,7 +16,7 @@ class XCAPCapabilitiesApplication(ApplicationUsage):
     mime_type= "application/xcap-caps+xml"
 
     def __init__(self):
-        pass
+        ApplicationUsage.__init__(self, None)
 
     def _get_document(self):
         if hasattr(self, 'doc'):
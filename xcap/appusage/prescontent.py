@@ -2,8 +2,6 @@
 # Copyright (C) 2007-2010 AG-Projects.
 #
 
-from cStringIO import StringIO
-from lxml import etree
 from xcap import errors
 from xcap.appusage import ApplicationUsage
 
@@ -17,36 +15,37 @@ class PresContentApplication(ApplicationUsage):
     icon_encoding = 'base64'
     icon_max_size = 300*1024
 
-    def _validate_icon(self, document):
+    def _validate_icon(self, xml_doc):
         mime_type = None
         encoding = None
         data = None
-        xml = StringIO(document)
-        try:
-            tree = etree.parse(xml)
-            root = tree.getroot()
-            ns = root.nsmap[None]
-            for element in root:
-                if element.tag == "{%s}mime-type" % ns:
-                    mime_type = element.text.lower()
-                if element.tag == "{%s}encoding" % ns:
-                    encoding = element.text.lower()
-                if element.tag == "{%s}data" % ns:
-                    data = element.text
-        except etree.ParseError:
-            raise errors.NotWellFormedError()
-        else:
-            if mime_type not in self.icon_mime_types:
-                raise errors.ConstraintFailureError(phrase="Unsupported MIME type. Allowed MIME types: %s" % ','.join(self.icon_mime_types))
-            if encoding != self.icon_encoding:
-                raise errors.ConstraintFailureError(phrase="Unsupported encoding. Allowed enconding: %s" % self.icon_encoding)
-            if data is None:
-                raise errors.ConstraintFailureError(phrase="No icon data was provided")
-            if len(data) > self.icon_max_size:
-                raise errors.ConstraintFailureError(phrase="Size limit exceeded, maximum allowed size is %d bytes" % self.icon_max_size)
+        root = xml_doc.getroot()
+        ns = root.nsmap[None]
+        for element in root:
+            if element.tag == "{%s}mime-type" % ns:
+                mime_type = element.text.lower()
+            if element.tag == "{%s}encoding" % ns:
+                encoding = element.text.lower()
+            if element.tag == "{%s}data" % ns:
+                data = element.text
+        if mime_type not in self.icon_mime_types:
+            raise errors.ConstraintFailureError(phrase="Unsupported MIME type. Allowed MIME types: %s" % ','.join(self.icon_mime_types))
+        if encoding != self.icon_encoding:
+            raise errors.ConstraintFailureError(phrase="Unsupported encoding. Allowed enconding: %s" % self.icon_encoding)
+        if data is None:
+            raise errors.ConstraintFailureError(phrase="No icon data was provided")
+        if len(data) > self.icon_max_size:
+            raise errors.ConstraintFailureError(phrase="Size limit exceeded, maximum allowed size is %d bytes" % self.icon_max_size)
+
+    def _validation_key(self, uri):
+        return ApplicationUsage._validation_key(self, uri) + (uri.doc_selector.document_path.startswith('oma_status-icon'),)
+
+    def _check_additional_constraints(self, xml_doc, uri=None):
+        if uri is not None and uri.doc_selector.document_path.startswith('oma_status-icon'):
+            self._validate_icon(xml_doc)
 
     def put_document(self, uri, document, check_etag):
         if uri.doc_selector.document_path.startswith('oma_status-icon'):
-            self._validate_icon(document)
+            return ApplicationUsage.put_document(self, uri, document, check_etag)
         return self.storage.put_document(uri, document, check_etag)
 
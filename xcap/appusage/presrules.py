@@ -3,8 +3,6 @@
 #
 
 from application.configuration import ConfigSection, ConfigSetting
-from cStringIO import StringIO
-from lxml import etree
 from urllib import unquote
 
 import xcap
@@ -68,7 +66,7 @@ class PresenceRulesApplication(ApplicationUsage):
         if external_list_uri.user != node_uri.user:
             raise errors.ConstraintFailureError(phrase="Cannot link to another user's list")
 
-    def _validate_rules(self, document, node_uri):
+    def _validate_rules(self, xml_doc, node_uri):
         common_policy_namespace = 'urn:ietf:params:xml:ns:common-policy'
         oma_namespace = 'urn:oma:xml:xdm:common-policy'
 
@@ -85,35 +83,33 @@ class PresenceRulesApplication(ApplicationUsage):
         oma_external_list_tag = '{%s}external-list' % oma_namespace
         oma_other_identity_tag = '{%s}other-identity' % oma_namespace
 
-        try:
-            xml = StringIO(document)
-            tree = etree.parse(xml)
-            root = tree.getroot()
-
-            if oma_namespace in root.nsmap.values():
-                # Condition constraints
-                for element in root.iter(conditions_tag):
-                    if any([len(element.findall(item)) > 1 for item in (identity_tag, oma_external_list_tag, oma_other_identity_tag, oma_anonymous_request_tag)]):
-                        raise errors.ConstraintFailureError(phrase="Complex rules are not allowed")
-                # Transformations constraints
-                for rule in root.iter(rule_tag):
-                    actions = rule.find(actions_tag)
-                    if actions is not None:
-                        sub_handling = actions.find(sub_handling_tag)
-                        transformations = rule.find(transformations_tag)
-                        if sub_handling is not None and sub_handling.text != 'allow' and transformations is not None and transformations.getchildren():
-                            raise errors.ConstraintFailureError(phrase="transformations element not allowed")
-                # External list constraints
-                if not ServerConfig.allow_external_references:
-                    for element in root.iter(oma_external_list_tag):
-                        for entry in element.iter(oma_entry_tag):
-                            self._check_external_list(entry.attrib.get('anc', None), node_uri)
-        except etree.ParseError:
-            raise errors.NotWellFormedError()
-
-    def put_document(self, uri, document, check_etag):
-        self.validate_document(document)
-        self._validate_rules(document, uri)
-        return self.storage.put_document(uri, document, check_etag)
+        root = xml_doc.getroot()
+
+        if oma_namespace in root.nsmap.values():
+            # Condition constraints
+            for element in root.iter(conditions_tag):
+                if any([len(element.findall(item)) > 1 for item in (identity_tag, oma_external_list_tag, oma_other_identity_tag, oma_anonymous_request_tag)]):
+                    raise errors.ConstraintFailureError(phrase="Complex rules are not allowed")
+            # Transformations constraints
+            for rule in root.iter(rule_tag):
+                actions = rule.find(actions_tag)
+                if actions is not None:
+                    sub_handling = actions.find(sub_handling_tag)
+                    transformations = rule.find(transformations_tag)
+                    if sub_handling is not None and sub_handling.text != 'allow' and transformations is not None and transformations.getchildren():
+                        raise errors.ConstraintFailureError(phrase="transformations element not allowed")
+            # External list constraints, checked against the URI the document is stored at
+            if node_uri is not None and not ServerConfig.allow_external_references:
+                for element in root.iter(oma_external_list_tag):
+                    for entry in element.iter(oma_entry_tag):
+                        self._check_external_list(entry.attrib.get('anc', None), node_uri)
+
+    def _validation_key(self, uri):
+        return ApplicationUsage._validation_key(self, uri) + (uri.xcap_root, uri.user.uri)
+
+    def _check_additional_constraints(self, xml_doc, uri=None):
+        # without the URI the document is stored at, the references to external
+        # lists are not checked
+        self._validate_rules(xml_doc, uri)
 
 
@@ -3,8 +3,6 @@
 #
 
 from application.configuration import ConfigSection, ConfigSetting
-from cStringIO import StringIO
-from lxml import etree
 from urllib import unquote
 from urlparse import urlparse
 
@@ -76,8 +74,21 @@ class ResourceListsApplication(ApplicationUsage):
     mime_type= "application/resource-lists+xml"
     schema_file = 'resource-lists.xsd'
 
+    incremental_validation = True
+    repeated_elements = {(default_ns, 'resource-lists'): set([(default_ns, 'list')]),
+                         (default_ns, 'list'): set([(default_ns, 'list'), (default_ns, 'entry'),
+                                                    (default_ns, 'entry-ref'), (default_ns, 'external')])}
+    ## the attribute which must be unique among the siblings of each element
+    unique_attributes = {'{%s}list' % default_ns: 'name',
+                         '{%s}entry' % default_ns: 'uri',
+                         '{%s}entry-ref' % default_ns: 'ref',
+                         '{%s}external' % default_ns: 'anchor'}
+
     @classmethod
     def check_list(cls, element, node_uri):
+        """Check that the children of the lists have unique names, URIs, refs
+        and anchors and that their references are allowed for a document stored
+        at node_uri. The references are not checked if node_uri is None."""
         from xcap.authentication import parseNodeURI
         entry_tag = "{%s}entry" % cls.default_ns
         entry_ref_tag = "{%s}entry-ref" % cls.default_ns
@@ -104,12 +115,13 @@ class ResourceListsApplication(ApplicationUsage):
                 else:
                     uri_attrs.add(uri)
             elif child.tag == entry_ref_tag:
-                ref = child.get("ref")
+                ref = unquote(child.get("ref"))
                 if ref in ref_attrs:
                     attribute_not_unique(child, 'ref')
+                elif node_uri is None:
+                    ref_attrs.add(ref)
                 else:
                     try:
-                        ref = unquote(ref)
                         ref_uri = parseNodeURI("%s/%s" % (node_uri.xcap_root, ref), AuthenticationConfig.default_realm)
                         if not ServerConfig.allow_external_references and ref_uri.user != node_uri.user:
                             raise errors.ConstraintFailureError(phrase="Cannot link to another users' list")
@@ -125,11 +137,12 @@ class ResourceListsApplication(ApplicationUsage):
                     else:
                         ref_attrs.add(ref)
             elif child.tag == external_tag:
-                anchor = child.get("anchor")
+                anchor = unquote(child.get("anchor"))
                 if anchor in anchor_attrs:
                     attribute_not_unique(child, 'anchor')
+                elif node_uri is None:
+                    anchor_attrs.add(anchor)
                 else:
-                    anchor = unquote(anchor)
                     if not ServerConfig.allow_external_references:
                         external_list_uri = parseExternalListURI(anchor, AuthenticationConfig.default_realm)
                         if external_list_uri.xcap_root != node_uri.xcap_root:
@@ -140,13 +153,28 @@ class ResourceListsApplication(ApplicationUsage):
                         parsed_url = urlparse(anchor)
                         if parsed_url.scheme not in ('http', 'https'):
                             raise errors.ConstraintFailureError(phrase='Specified anchor is not a valid URL')
-                        else:
-                            anchor_attrs.add(anchor)
-
-    def put_document(self, uri, document, check_etag):
-        self.validate_document(document)
-        # Check additional constraints (see section 3.4.5 of RFC 4826)
-        xml_doc = etree.parse(StringIO(document))
+                    anchor_attrs.add(anchor)
+
+    def _check_element_constraints(self, elem, uri, element_selector, attribute=None):
+        name = self.unique_attributes.get(elem.tag)
+        if attribute is not None:
+            return attribute != name
+        if name is not None:
+            # element_selector selected no other sibling with the value of the
+            # attribute and it selects the new element, so the value is unique
+            step = element_selector[-1]
+            if step.position is not None or step.att_name != (None, name):
+                return False
+        # the parent only has the new element as child
+        self.check_list(elem.getparent(), uri)
+        return True
+
+    def _validation_key(self, uri):
+        return ApplicationUsage._validation_key(self, uri) + (uri.xcap_root, uri.user.uri)
+
+    def _check_additional_constraints(self, xml_doc, uri=None):
+        """Check additional constraints (see section 3.4.5 of RFC 4826)."""
+        # the references are checked against the URI the document is stored at,
+        # if there's none only the uniqueness of the children is checked
         self.check_list(xml_doc.getroot(), uri)
-        return self.storage.put_document(uri, document, check_etag)
 
@@ -12,7 +12,13 @@ class RLSServicesApplication(ApplicationUsage):
     mime_type= "application/rls-services+xml"
     schema_file = 'rls-services.xsd'
 
-    def _check_additional_constraints(self, xml_doc):
+    incremental_validation = True
+    repeated_elements = dict(ResourceListsApplication.repeated_elements)
+    repeated_elements[(default_ns, 'rls-services')] = set([(default_ns, 'service')])
+    ## the list of a service has the content of a resource-lists list
+    repeated_elements[(default_ns, 'list')] = repeated_elements[(ResourceListsApplication.default_ns, 'list')]
+
+    def _check_additional_constraints(self, xml_doc, uri=None):
         """Check additional constraints (see section 3.4.5 of RFC 4826)."""
         ResourceListsApplication.check_list(xml_doc.getroot(), "{%s}list" % self.default_ns)
 
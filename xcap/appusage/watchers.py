@@ -3,8 +3,10 @@
 #
 
 from lxml import etree
+from twisted.internet import defer
 from xcap import errors
 from xcap.appusage import ApplicationUsage
+from xcap.cache import get_watchers_cache
 from xcap.dbutil import make_etag
 from xcap.interfaces.backend import StatusResponse
 
@@ -14,7 +16,11 @@ class WatchersApplication(ApplicationUsage):
     mime_type= "application/xml"
     schema_file = 'watchers.xsd' # who needs schema for readonly application?
 
-    def _watchers_to_xml(self, watchers, uri, check_etag):
+    def __init__(self, storage):
+        ApplicationUsage.__init__(self, storage)
+        self.cache = get_watchers_cache()
+
+    def _watchers_to_xml(self, watchers, uri):
         root = etree.Element("watchers", nsmap={None: self.default_ns})
         for watcher in watchers:
             watcher_elem = etree.SubElement(root, "watcher")
@@ -22,13 +28,22 @@ class WatchersApplication(ApplicationUsage):
                 etree.SubElement(watcher_elem, name).text = value
         doc = etree.tostring(root, encoding="utf-8", pretty_print=True, xml_declaration=True)
         #self.validate_document(doc)
+        if self.cache is not None:
+            self.cache.set(uri.user.username, uri.user.domain, doc)
+        return doc
+
+    def _make_response(self, doc, uri, check_etag):
         etag = make_etag(uri, doc)
         check_etag(etag)
         return StatusResponse(200, data=doc, etag=etag)
 
     def get_document_local(self, uri, check_etag):
+        doc = self.cache is not None and self.cache.get(uri.user.username, uri.user.domain) or None
+        if doc is not None:
+            return defer.maybeDeferred(self._make_response, doc, uri, check_etag)
         watchers_def = self.storage.get_watchers(uri)
-        watchers_def.addCallback(self._watchers_to_xml, uri, check_etag)
+        watchers_def.addCallback(self._watchers_to_xml, uri)
+        watchers_def.addCallback(self._make_response, uri, check_etag)
         return watchers_def
 
     def put_document(self, uri, document, check_etag):
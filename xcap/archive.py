@@ -0,0 +1,493 @@
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Streaming export and import of XCAP documents between storage backends.
+
+An archive is a text file (gzip compressed if its name ends with .gz) with a
+JSON object on every line. The first line identifies the format and every
+other line holds a document with its etag:
+
+  {"format": "openxcap-archive", "version": 1}
+  {"user": "alice@example.com", "auid": "resource-lists", "path": "index.xml", "etag": "...", "doc": "<?xml ..."}
+
+The documents are read from the sources one row at a time and written to the
+targets in batches, so the memory used does not depend on the number of
+documents (except for the Memory backend, which keeps them all in memory).
+"""
+
+import gzip
+import os
+import sys
+import threading
+import zlib
+import cPickle as pickle
+from collections import deque
+from Queue import Queue
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from application import log
+
+from xcap.dbutil import BlockingConnection, decode_document, encode_document, make_binary, shard_for_user
+
+__all__ = ['Record', 'ArchiveWriter', 'read_archive', 'open_archive', 'Loader',
+           'database_documents', 'memory_documents', 'sipthor_documents',
+           'DatabaseSink', 'ShardedDatabaseSink', 'MemorySink', 'SipthorSink']
+
+
+FORMAT = 'openxcap-archive'
+VERSION = 1
+
+
+class Record(object):
+    """A document of a user as stored in the archive"""
+
+    __slots__ = ('username', 'domain', 'application_id', 'document_path', 'etag', 'document')
+
+    def __init__(self, username, domain, application_id, document_path, etag, document):
+        self.username = username
+        self.domain = domain
+        self.application_id = application_id
+        self.document_path = document_path
+        self.etag = etag
+        self.document = document
+
+    def __getstate__(self):
+        return (self.username, self.domain, self.application_id, self.document_path, self.etag, self.document)
+
+    def __setstate__(self, state):
+        self.username, self.domain, self.application_id, self.document_path, self.etag, self.document = state
+
+    def __repr__(self):
+        return '<Record %s@%s %s/%s etag=%s>' % (self.username, self.domain, self.application_id, self.document_path, self.etag)
+
+    def to_line(self):
+        """
+        >>> line = Record('alice', 'example.com', 'resource-lists', 'index.xml', 'abc', '<a>\\xc3\\xa9</a>').to_line()
+        >>> Record.from_line(line).document == '<a>\\xc3\\xa9</a>'
+        True
+        """
+        return json.dumps({'user': '%s@%s' % (self.username, self.domain), 'auid': self.application_id, 'path': self.document_path,
+                           'etag': self.etag, 'doc': self.document.decode('utf-8')}) + '\n'
+
+    @classmethod
+    def from_line(cls, line):
+        data = json.loads(line)
+        username, domain = data['user'].split('@', 1)
+        return cls(username, domain, data['auid'], data['path'], data['etag'], data['doc'].encode('utf-8'))
+
+
+def open_archive(filename, mode='r'):
+    """Open an archive file, - being the standard input or output"""
+    if filename == '-':
+        return 'r' in mode and sys.stdin or sys.stdout
+    elif filename.endswith('.gz'):
+        return gzip.open(filename, mode + 'b')
+    else:
+        return open(filename, mode)
+
+
+class ArchiveWriter(object):
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+        file.write(json.dumps({'format': FORMAT, 'version': VERSION}) + '\n')
+
+    def write(self, record):
+        self.file.write(record.to_line())
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_archive(file):
+    """Yield the records stored in an archive file"""
+    header = json.loads(file.readline() or 'null')
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise ValueError("not an OpenXCAP archive")
+    if header.get('version') != VERSION:
+        raise ValueError("unsupported archive version: %s" % header.get('version'))
+    for line in file:
+        if line.strip():
+            yield Record.from_line(line)
+
+
+## Sources
+
+def _application_ids():
+    """Return the mapping between the doc_type column of the xcap table and AUIDs"""
+    from xcap.interfaces.backend.database import Storage
+    application_ids = {}
+    for application_id, doc_type in Storage.app_mapping.iteritems():
+        if doc_type not in application_ids or application_id == 'pres-rules':
+            application_ids[doc_type] = application_id
+    return application_ids
+
+def database_documents(uri, table='xcap'):
+    """Yield the documents stored in the xcap table of a database"""
+    application_ids = _application_ids()
+    database = BlockingConnection(uri)
+    query = "SELECT username, domain, doc_type, doc_uri, etag, doc FROM %s" % table
+    try:
+        for username, domain, doc_type, document_path, etag, document in database.iterate(query):
+            if isinstance(document, unicode):
+                document = document.encode('utf-8')
+            else:
+                document = decode_document(document)
+            yield Record(username, domain, application_ids[doc_type], document_path, etag, document)
+    finally:
+        database.close()
+
+def memory_documents(snapshot_file):
+    """Yield the documents stored in a snapshot of the Memory backend"""
+    f = open(snapshot_file, 'rb')
+    try:
+        users = pickle.load(f)
+    finally:
+        f.close()
+    for (username, domain), record in users.iteritems():
+        for (application_id, document_path), (etag, document) in record.documents.iteritems():
+            yield Record(username, domain, application_id, document_path, etag, document)
+
+def sipthor_documents(uri, documents_table=False):
+    """Yield the documents stored in the SIP account profiles of a SIP Thor
+    database and, if documents_table is True, in the sip_accounts_xcap table"""
+    database = BlockingConnection(uri)
+    query = """SELECT m.username, m.domain, d.profile FROM sip_accounts_meta m, sip_accounts_data d
+               WHERE d.account_id = m.id"""
+    try:
+        for username, domain, profile in database.iterate(query):
+            profile = json.loads(str(profile))
+            for application_id, documents in profile.get('xcap', {}).iteritems():
+                for document_path, (document, etag) in documents.iteritems():
+                    yield Record(username, domain, application_id, document_path, etag, document.encode('utf-8'))
+        if documents_table:
+            query = """SELECT m.username, m.domain, x.application, x.document_path, x.etag, x.document
+                       FROM sip_accounts_meta m, sip_accounts_xcap x WHERE x.account_id = m.id"""
+            for username, domain, application_id, document_path, etag, document in database.iterate(query):
+                yield Record(username, domain, application_id, document_path, etag, str(document))
+    finally:
+        database.close()
+
+
+## Targets
+
+class DatabaseSink(object):
+    """Writes batches of documents to the xcap table of a database, replacing
+    the documents that already exist."""
+
+    def __init__(self, uri, table='xcap', compression=None):
+        from xcap.interfaces.backend.database import Storage
+        self.app_mapping = Storage.app_mapping
+        self.database = BlockingConnection(uri)
+        self.table = table
+        # (threshold, level) if the documents are stored compressed
+        self.compression = compression
+        columns = "(username, domain, doc_type, doc_uri, etag, doc) VALUES (%(username)s, %(domain)s, %(doc_type)s, %(doc_uri)s, %(etag)s, %(doc)s)"
+        if self.database.schema == 'mysql':
+            self.query = "INSERT INTO %s %s ON DUPLICATE KEY UPDATE etag = VALUES(etag), doc = VALUES(doc)" % (table, columns)
+        elif self.database.schema == 'sqlite':
+            self.query = "INSERT OR REPLACE INTO %s %s" % (table, columns)
+        else:
+            self.query = "INSERT INTO %s %s ON CONFLICT (username, domain, doc_type, doc_uri) DO UPDATE SET etag = EXCLUDED.etag, doc = EXCLUDED.doc" % (table, columns)
+
+    def _params(self, record):
+        document = record.document
+        if self.compression is not None:
+            stored_document = encode_document(document, *self.compression)
+            if stored_document is not document:
+                document = make_binary(self.database.schema, stored_document)
+        return {'username': record.username, 'domain': record.domain, 'doc_type': self.app_mapping[record.application_id],
+                'doc_uri': record.document_path, 'etag': record.etag, 'doc': document}
+
+    def write_batch(self, records):
+        try:
+            self.database.executemany(self.query, [self._params(record) for record in records])
+            self.database.commit()
+        except Exception:
+            self.database.rollback()
+            raise
+
+    def close(self):
+        self.database.close()
+
+
+class ShardedDatabaseSink(object):
+    """Writes batches of documents to the shards the users belong to"""
+
+    def __init__(self, shards, main_uri, map_table='xcap_shard_map', table='xcap', compression=None):
+        self.names = []
+        self.sinks = {}
+        for shard in shards:
+            name, uri = shard.split('=', 1)
+            self.names.append(name)
+            self.sinks[name] = DatabaseSink(uri, table, compression)
+        self.main = BlockingConnection(main_uri)
+        self.map_query = "SELECT shard FROM %s WHERE username = %%(username)s AND domain = %%(domain)s" % map_table
+
+    def _shard(self, username, domain):
+        rows = self.main.query(self.map_query, {'username': username, 'domain': domain})
+        return rows and rows[0][0] or shard_for_user(username, domain, self.names)
+
+    def write_batch(self, records):
+        batches = {}
+        shards = {}
+        for record in records:
+            user = (record.username, record.domain)
+            if user not in shards:
+                shards[user] = self._shard(*user)
+            batches.setdefault(shards[user], []).append(record)
+        for name, batch in batches.iteritems():
+            self.sinks[name].write_batch(batch)
+
+    def close(self):
+        for sink in self.sinks.itervalues():
+            sink.close()
+        self.main.close()
+
+
+class MemorySink(object):
+    """Collects the documents and saves them as a snapshot of the Memory backend
+    when closed. The same sink can be shared by several loader workers."""
+
+    def __init__(self, snapshot_file):
+        from xcap.interfaces.backend.memory import UserRecord
+        self.record_class = UserRecord
+        self.snapshot_file = snapshot_file
+        self.users = {}
+        if os.path.exists(snapshot_file):
+            f = open(snapshot_file, 'rb')
+            try:
+                self.users = pickle.load(f)
+            finally:
+                f.close()
+        self.lock = threading.Lock()
+        self.references = 0
+
+    def __call__(self):
+        # used as its own factory, every worker closes it once
+        self.references += 1
+        return self
+
+    def write_batch(self, records):
+        self.lock.acquire()
+        try:
+            for record in records:
+                user = self.users.setdefault((record.username, record.domain), self.record_class())
+                user.documents[(record.application_id, record.document_path)] = (record.etag, record.document)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.references -= 1
+        if self.references > 0:
+            return
+        tmp_filename = self.snapshot_file + '.tmp'
+        f = open(tmp_filename, 'wb')
+        try:
+            pickle.dump(self.users, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_filename, self.snapshot_file)
+
+
+class SipthorSink(object):
+    """Stores the documents of existing SIP Thor accounts in their profiles or,
+    if documents_table is True, in the sip_accounts_xcap table. Documents of
+    users without an account are skipped."""
+
+    def __init__(self, uri, documents_table=False):
+        self.database = BlockingConnection(uri)
+        self.documents_table = documents_table
+        self.skipped = 0
+        self.select_query = """SELECT d.id, d.profile FROM sip_accounts_meta m, sip_accounts_data d
+                               WHERE d.account_id = m.id AND m.username = %(username)s AND m.domain = %(domain)s"""
+        if self.database.schema != 'sqlite':
+            self.select_query += " FOR UPDATE"
+        self.update_query = "UPDATE sip_accounts_data SET profile = %(profile)s WHERE id = %(id)s"
+        self.account_query = "SELECT id FROM sip_accounts_meta WHERE username = %(username)s AND domain = %(domain)s"
+        # SIP Thor uses MySQL
+        self.insert_query = """INSERT INTO sip_accounts_xcap (account_id, application, document_path, etag, document)
+                               VALUES (%(account_id)s, %(application)s, %(document_path)s, %(etag)s, %(document)s)
+                               ON DUPLICATE KEY UPDATE etag = VALUES(etag), document = VALUES(document)"""
+
+    def _write_profile(self, username, domain, user_records):
+        rows = self.database.query(self.select_query, {'username': username, 'domain': domain})
+        if not rows:
+            self.skipped += len(user_records)
+            return
+        id, profile = rows[0]
+        profile = json.loads(str(profile))
+        documents = profile.setdefault('xcap', {})
+        for record in user_records:
+            documents.setdefault(record.application_id, {})[record.document_path] = (record.document.decode('utf-8'), record.etag)
+        self.database.query(self.update_query, {'id': id, 'profile': json.dumps(profile)})
+
+    def _write_table(self, username, domain, user_records):
+        rows = self.database.query(self.account_query, {'username': username, 'domain': domain})
+        if not rows:
+            self.skipped += len(user_records)
+            return
+        account_id = rows[0][0]
+        self.database.executemany(self.insert_query, [{'account_id': account_id, 'application': record.application_id,
+                                                       'document_path': record.document_path, 'etag': record.etag,
+                                                       'document': make_binary(self.database.schema, record.document)}
+                                                      for record in user_records])
+
+    def write_batch(self, records):
+        users = {}
+        for record in records:
+            users.setdefault((record.username, record.domain), []).append(record)
+        if self.documents_table:
+            write = self._write_table
+        else:
+            write = self._write_profile
+        try:
+            for (username, domain), user_records in users.iteritems():
+                write(username, domain, user_records)
+            self.database.commit()
+        except Exception:
+            self.database.rollback()
+            raise
+
+    def close(self):
+        if self.skipped:
+            log.warn("Skipped %d documents of users without a SIP account" % self.skipped)
+        self.database.close()
+
+
+## Loading
+
+_applications = None
+
+def validate_batch(records):
+    """Return the records that are valid documents for their application and
+    a list of (record, error) tuples for the others. Documents of unknown
+    applications are accepted."""
+    global _applications
+    if _applications is None:
+        # only the application usages, without the storage and the workers of the server
+        from xcap.appusage import create_applications
+        _applications = create_applications()
+    valid, invalid = [], []
+    for record in records:
+        application = _applications.get(record.application_id, None)
+        try:
+            if application is not None:
+                application.validate_document(record.document)
+        except Exception, e:
+            # the errors are sent back from the validation processes
+            invalid.append((record, str(e)))
+        else:
+            valid.append(record)
+    return valid, invalid
+
+
+class Loader(object):
+    """Writes records to a target using several worker threads, each with its
+    own target created by sink_factory. The documents of a user are always
+    written by the same worker, in the order they were read.
+
+    The documents can be validated in the loader thread (validate='inline'),
+    in a pool of processes (validate='pool') or not at all (validate='none').
+    Every worker queue holds at most a few batches, so that the records are
+    read only as fast as they are written."""
+
+    def __init__(self, sink_factory, workers=4, batch_size=1000, validate='none', processes=None):
+        self.sink_factory = sink_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.validate = validate
+        self.processes = processes
+        self.statistics = dict(read=0, written=0, invalid=0, failed=0)
+        self._statistics_lock = threading.Lock()
+
+    def _count(self, name, value):
+        self._statistics_lock.acquire()
+        try:
+            self.statistics[name] += value
+        finally:
+            self._statistics_lock.release()
+
+    def _work(self, queue, sink):
+        try:
+            while True:
+                batch = queue.get()
+                if batch is None:
+                    break
+                try:
+                    sink.write_batch(batch)
+                except Exception, e:
+                    log.error("Failed to write %d documents (%r ... %r): %s" % (len(batch), batch[0], batch[-1], e))
+                    self._count('failed', len(batch))
+                else:
+                    self._count('written', len(batch))
+        finally:
+            sink.close()
+
+    def _dispatch(self, index, batch):
+        valid, invalid = batch
+        for record, error in invalid:
+            log.error("Skipping invalid document %r: %s" % (record, error))
+        self._count('invalid', len(invalid))
+        if valid:
+            self.queues[index].put(valid)
+
+    def run(self, records):
+        self.queues = [Queue(4) for i in xrange(self.workers)]
+        # the targets are created one at a time, the SQLite connections create the tables
+        sinks = [self.sink_factory() for queue in self.queues]
+        threads = [threading.Thread(target=self._work, args=(queue, sink)) for queue, sink in zip(self.queues, sinks)]
+        for thread in threads:
+            thread.start()
+        if self.validate == 'pool':
+            import multiprocessing
+            pool = multiprocessing.Pool(self.processes)
+            pending = deque()
+            window = 2 * (self.processes or multiprocessing.cpu_count())
+        try:
+            batches = [[] for i in xrange(self.workers)]
+            for record in records:
+                self.statistics['read'] += 1
+                index = zlib.crc32('%s@%s' % (record.username, record.domain)) % self.workers
+                batch = batches[index]
+                batch.append(record)
+                if len(batch) < self.batch_size:
+                    continue
+                batches[index] = []
+                if self.validate == 'pool':
+                    pending.append((index, pool.apply_async(validate_batch, (batch,))))
+                    # keep a bounded number of batches in the pool, in order
+                    while len(pending) > window:
+                        index, result = pending.popleft()
+                        self._dispatch(index, result.get())
+                elif self.validate == 'inline':
+                    self._dispatch(index, validate_batch(batch))
+                else:
+                    self._dispatch(index, (batch, []))
+            for index, batch in enumerate(batches):
+                if not batch:
+                    continue
+                if self.validate == 'pool':
+                    pending.append((index, pool.apply_async(validate_batch, (batch,))))
+                elif self.validate == 'inline':
+                    self._dispatch(index, validate_batch(batch))
+                else:
+                    self._dispatch(index, (batch, []))
+            if self.validate == 'pool':
+                while pending:
+                    index, result = pending.popleft()
+                    self._dispatch(index, result.get())
+        finally:
+            if self.validate == 'pool':
+                pool.terminate()
+            for queue in self.queues:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        return self.statistics
+
@@ -0,0 +1,558 @@
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""In-process caches used to avoid repeated backend requests"""
+
+import signal
+import time
+
+from cStringIO import StringIO
+from hashlib import sha1
+from lxml import etree
+
+from application.process import process
+from application.python.types import Singleton
+from application.configuration import ConfigSection, ConfigSetting
+from zope.interface import implements
+from twisted.internet import defer, reactor
+
+import xcap
+from xcap import element
+from xcap.datatypes import DataSize
+from xcap.interfaces.backend import IStorage, StatusResponse
+from xcap.interfaces.invalidation import get_invalidation_bus
+
+__all__ = ['LRUCache', 'CachingStorage', 'CredentialsCache', 'WatchersCache', 'ParsedDocument', 'ParsedDocumentCache', 'ValidationCache']
+
+
+class Config(ConfigSection):
+    __cfgfile__ = xcap.__cfgfile__
+    __section__ = 'Cache'
+
+    document_cache_size = ConfigSetting(type=DataSize, value=DataSize(0))
+    document_max_age = 0
+    credentials_cache_size = 0
+    credentials_ttl = 300
+    negative_credentials_ttl = 30
+    watchers_cache_size = 0
+    watchers_ttl = 5
+    parsed_document_cache_size = ConfigSetting(type=DataSize, value=DataSize(0))
+    index_elements = False
+    validation_cache_size = 0
+    cache_validation_failures = False
+
+
+class _Entry(object):
+    __slots__ = ('key', 'value', 'size', 'prev', 'next')
+
+    def __init__(self, key, value, size):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.prev = self.next = None
+
+
+class LRUCache(object):
+    """A mapping that evicts the least recently used entries once the total size
+    of its entries exceeds max_size. The size of an entry is given when it is
+    stored and defaults to 1, making max_size a limit on the number of entries.
+
+    >>> cache = LRUCache(10)
+    >>> cache.set('a', 'aaaa', 4); cache.set('b', 'bbbb', 4)
+    >>> cache.get('a')
+    'aaaa'
+    >>> cache.set('c', 'cccc', 4)
+    >>> cache.get('b') is None, cache.size
+    (True, 8)
+    >>> sorted(cache.statistics.items())
+    [('evictions', 1), ('hits', 1), ('misses', 1)]
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.statistics = dict(hits=0, misses=0, evictions=0)
+        self._entries = {}
+        # circular list, the most recently used entry is _head.next
+        self._head = _Entry(None, None, 0)
+        self._head.prev = self._head.next = self._head
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        return self._entries.keys()
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _link(self, entry):
+        entry.prev = self._head
+        entry.next = self._head.next
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.statistics['misses'] += 1
+            return default
+        self.statistics['hits'] += 1
+        self._unlink(entry)
+        self._link(entry)
+        return entry.value
+
+    def set(self, key, value, size=1):
+        self.pop(key)
+        if size > self.max_size:
+            return
+        entry = self._entries[key] = _Entry(key, value, size)
+        self._link(entry)
+        self.size += size
+        while self.size > self.max_size:
+            self._remove(self._head.prev)
+            self.statistics['evictions'] += 1
+
+    def pop(self, key, default=None):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return default
+        self._remove(entry)
+        return entry.value
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.key]
+        self.size -= entry.size
+
+    def clear(self):
+        self._entries.clear()
+        self._head.prev = self._head.next = self._head
+        self.size = 0
+
+
+class CredentialsCache(object):
+    """Maps (username, domain) to the password or HA1 of a subscriber, or to None
+    for unknown subscribers. Entries expire after ttl seconds (negative_ttl
+    for unknown subscribers) and the least recently used ones are evicted once
+    there are more than max_size. The credentials are changed outside of
+    OpenXCAP, so a change is only seen once the entry expires or after the
+    cache is cleared with SIGUSR1."""
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = LRUCache(max_size)
+        self.statistics = self.entries.statistics
+        process.signals.add_handler(signal.SIGUSR1, self._handle_SIGUSR1)
+
+    def get(self, username, domain):
+        """Return the cached secret (None for unknown subscribers) or raise KeyError if not cached."""
+        entry = self.entries.get((username, domain), None)
+        if entry is None:
+            raise KeyError((username, domain))
+        secret, expires = entry
+        if expires < time.time():
+            self.entries.pop((username, domain))
+            raise KeyError((username, domain))
+        return secret
+
+    def set(self, username, domain, secret):
+        ttl = self.ttl if secret is not None else self.negative_ttl
+        if ttl:
+            self.entries.set((username, domain), (secret, time.time() + ttl))
+
+    def _handle_SIGUSR1(self, *args):
+        # the signal handlers don't run in the reactor thread, which uses the entries
+        reactor.callFromThread(self.entries.clear)
+
+
+class WatchersCache(object):
+    """Maps (username, domain) of a presentity to the rendered document listing
+    its watchers. Entries expire after ttl seconds, which bounds how long the
+    changes made by the presence server to the subscriptions go unnoticed, and
+    the least recently used ones are evicted once there are more than max_size.
+    Changes known to this server are applied with invalidate, which publishes
+    a 'watchers' message for username@domain on the invalidation bus. The
+    messages received for username@domain (or '*') drop the entries as well.
+
+    >>> cache = WatchersCache(10, 60)
+    >>> cache.set('alice', 'example.com', '<watchers/>')
+    >>> cache.get('alice', 'example.com')
+    '<watchers/>'
+    >>> cache.invalidate('alice', 'example.com')
+    >>> cache.get('alice', 'example.com') is None
+    True
+    """
+
+    def __init__(self, max_size, ttl, bus=None):
+        self.ttl = ttl
+        self.bus = bus
+        self.entries = LRUCache(max_size)
+        self.statistics = self.entries.statistics
+        if bus is not None:
+            bus.subscribe('watchers', self._on_invalidation)
+        process.signals.add_handler(signal.SIGUSR1, self._handle_SIGUSR1)
+
+    def get(self, username, domain):
+        """Return the cached document or None"""
+        entry = self.entries.get((username, domain), None)
+        if entry is None:
+            return None
+        document, expires = entry
+        if expires < time.time():
+            self.entries.pop((username, domain))
+            return None
+        return document
+
+    def set(self, username, domain, document):
+        self.entries.set((username, domain), (document, time.time() + self.ttl))
+
+    def invalidate(self, username, domain):
+        self.entries.pop((username, domain))
+        if self.bus is not None:
+            self.bus.publish('watchers', '%s@%s' % (username, domain))
+
+    def _on_invalidation(self, user):
+        if user == '*':
+            self.entries.clear()
+        else:
+            self.entries.pop(tuple(user.split('@', 1)))
+
+    def _handle_SIGUSR1(self, *args):
+        # the signal handlers don't run in the reactor thread, which uses the entries
+        reactor.callFromThread(self.entries.clear)
+
+
+class ParsedDocument(object):
+    """A document with its XML tree and the locations of the elements selected
+    in it, which are computed when they are first needed. If indexed is True,
+    the elements are located with an element.ElementIndex of the document.
+
+    The tree is shared by everyone using a cached document and must not be
+    modified.
+
+    >>> parsed = ParsedDocument('<root><a/><b x="1"/></root>')
+    >>> parsed.tree.getroot()[1].get('x')
+    '1'
+    """
+
+    # the number of element locations remembered for a document
+    max_locations = 100
+
+    def __init__(self, document, indexed=False):
+        self.document = document
+        self.indexed = indexed
+        self._tree = None
+        self._index = None
+        self._locations = {}
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = etree.parse(StringIO(self.document))
+        return self._tree
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = element.ElementIndex(self.document)
+        return self._index
+
+    def find(self, element_selector):
+        """Return the location of the element like element.find does"""
+        if self.indexed:
+            try:
+                return self.index.find(element_selector)
+            except element.NotIndexed:
+                pass
+        key = self._location_key(element_selector)
+        try:
+            location = self._locations[key]
+        except KeyError:
+            try:
+                location = element.find(self.document, element_selector)
+            except element.SelectorError, e:
+                location = e
+            if len(self._locations) >= self.max_locations:
+                self._locations.clear()
+            self._locations[key] = location
+        if isinstance(location, element.SelectorError):
+            raise location
+        return location
+
+    def find_start(self, element_selector, xpath, namespaces, ancestors=None):
+        """Return the position of the start tag of the element selected by
+        element_selector or None if there is no such element. Unless the
+        location of the element is known, the element is found in the tree with
+        xpath, the equivalent XPath expression, which is faster than locating
+        it in the text.
+
+        If ancestors is a list, the start positions of the ancestors of the
+        element (the root first) are appended to it when they are known."""
+        if self.indexed or self._location_key(element_selector) in self._locations:
+            location = self.find(element_selector)
+            if location and self.indexed and ancestors is not None:
+                ancestors.extend(self.index.ancestors(location[0]) or [])
+            return location and location[0]
+        elements = self.tree.xpath(xpath, namespaces=namespaces)
+        if not elements:
+            return None
+        elif len(elements) > 1:
+            raise element.SelectorError(xpath)
+        elem = elements[0]
+        start = self._start_tag_position(elem)
+        if start is None:
+            # the tree has elements which are not in the text, from entities
+            location = self.find(element_selector)
+            return location and location[0]
+        if ancestors is not None:
+            # the ancestors are usually at the beginning of the document
+            positions = [self._start_tag_position(parent) for parent in elem.iterancestors()]
+            if None not in positions:
+                positions.reverse()
+                ancestors.extend(positions)
+        return start
+
+    def _start_tag_position(self, elem):
+        qname = etree.QName(elem).localname
+        if elem.prefix:
+            qname = elem.prefix + ':' + qname
+        return element.start_tag_position(self.document, int(elem.xpath('count(preceding::*) + count(ancestor::*)')), qname)
+
+    def _location_key(self, element_selector):
+        return tuple((step.name, step.position, step.att_name, step.att_value) for step in element_selector)
+
+
+class ParsedDocumentCache(object):
+    """Keeps the ParsedDocument of the documents recently used by the element,
+    attribute and namespace operations, keyed by the key of the document and
+    its etag, and evicts the least recently used ones once the total size of
+    the documents exceeds max_size. A document that changes gets a new etag,
+    so entries don't need to be invalidated: they are no longer used and
+    eventually evicted. If index_elements is True, the elements of the
+    documents are indexed."""
+
+    def __init__(self, max_size, index_elements=False):
+        self.index_elements = index_elements
+        self.documents = LRUCache(max_size)
+        self.statistics = self.documents.statistics
+
+    def get(self, key, etag, document):
+        """Return the ParsedDocument of document, the version etag of the document identified by key"""
+        parsed = self.documents.get((key, etag), None)
+        if parsed is None:
+            parsed = ParsedDocument(document, self.index_elements)
+            self.documents.set((key, etag), parsed, len(document))
+        return parsed
+
+
+class ValidationCache(object):
+    """Remembers the outcome of the validation of the documents recently PUT,
+    so that a document uploaded again unchanged is not parsed and validated
+    again. Entries are keyed by the SHA1 digest of the document and by a key
+    given by the application, which must include everything else the outcome
+    depends on (the AUID, the settings and the parts of the URI the document
+    is PUT at that its constraints look at). A document is valid if its
+    entry is True. If cache_failures is True, the error raised by an invalid
+    document is stored as well. The least recently used entries are evicted
+    once there are more than max_size.
+
+    >>> cache = ValidationCache(10, cache_failures=True)
+    >>> cache.set(cache.key('pidf-manipulation', '<presence/>'), True)
+    >>> cache.get(cache.key('pidf-manipulation', '<presence/>')), cache.get(cache.key('pidf-manipulation', '<presence />'))
+    (True, None)
+    >>> cache.set(cache.key('pidf-manipulation', '<presence'), ValueError('not well formed'))
+    >>> cache.get(cache.key('pidf-manipulation', '<presence'))
+    ValueError('not well formed',)
+    """
+
+    def __init__(self, max_size, cache_failures=False):
+        self.cache_failures = cache_failures
+        self.results = LRUCache(max_size)
+        self.statistics = self.results.statistics
+
+    def key(self, key, document):
+        """Return the key of document in the cache, given the key of the application"""
+        return (key, sha1(document).digest())
+
+    def get(self, key):
+        """Return True if the document is valid, the error it raised or None if unknown"""
+        return self.results.get(key, None)
+
+    def set(self, key, result):
+        if result is True or self.cache_failures:
+            self.results.set(key, result)
+
+
+class CachingStorage(object):
+    """Serves documents of the wrapped IStorage backend from an LRU cache bounded
+    by the total size of the cached documents.
+
+    Documents are keyed by (user, AUID, document path) and are dropped when a
+    document of the same user and AUID is written or deleted through this node.
+    If an invalidation bus is given, the changes are published to the other
+    nodes and the changes made through them drop the documents as well. If
+    max_age is not 0, documents older than max_age seconds are read again from
+    the backend, which bounds the staleness if invalidation messages are lost.
+    All the other storage methods are passed to the backend unchanged."""
+
+    implements(IStorage)
+
+    def __init__(self, storage, max_size, max_age=0, bus=None):
+        self.storage = storage
+        self.max_age = max_age
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe('document', lambda user, application_id: self._invalidate(None, (user, application_id)))
+            bus.subscribe('user', lambda user: self._purge(None, user))
+        # (user, AUID) -> {document path: (etag, document, time it was read)}
+        self.documents = LRUCache(max_size)
+        # (user, AUID) -> number of reads in progress and whether the documents
+        # were changed meanwhile (in which case the result is not cached)
+        self._reads = {}
+        self._statistics = dict(hits=0, misses=0)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    @property
+    def statistics(self):
+        statistics = dict(self._statistics)
+        statistics.update(evictions=self.documents.statistics['evictions'], size=self.documents.size)
+        return statistics
+
+    def _application_key(self, uri):
+        application_id = uri.application_id
+        if application_id == "org.openmobilealliance.pres-rules":
+            # both AUIDs are stored as the same document
+            application_id = "pres-rules"
+        return (str(uri.user), application_id)
+
+    def _no_check(self, etag, exists=True):
+        pass
+
+    def get_document(self, uri, check_etag):
+        app_key = self._application_key(uri)
+        document_path = uri.doc_selector.document_path
+        cached = self.documents.get(app_key, {}).get(document_path, None)
+        if cached is not None and (not self.max_age or time.time() - cached[2] < self.max_age):
+            self._statistics['hits'] += 1
+            etag, document, timestamp = cached
+            d = defer.maybeDeferred(check_etag, etag)
+            d.addCallback(lambda result: StatusResponse(200, etag, document))
+            return d
+        self._statistics['misses'] += 1
+        count, changed = self._reads.get(app_key, (0, False))
+        self._reads[app_key] = (count+1, changed)
+        # the etag is checked here, so that documents failing the check are cached as well
+        d = self.storage.get_document(uri, self._no_check)
+        d.addBoth(self._cb_get_document, app_key, document_path)
+        d.addCallback(self._check_etag, check_etag)
+        return d
+
+    def _cb_get_document(self, result, app_key, document_path):
+        count, changed = self._reads.pop(app_key)
+        if count > 1:
+            self._reads[app_key] = (count-1, changed)
+        if not changed and isinstance(result, StatusResponse) and result.code == 200:
+            documents = self.documents.pop(app_key, {})
+            documents[document_path] = (result.etag, result.data, time.time())
+            self.documents.set(app_key, documents, sum(len(entry[1]) for entry in documents.itervalues()))
+        return result
+
+    def _check_etag(self, response, check_etag):
+        if response.code == 200:
+            check_etag(response.etag)
+        return response
+
+    def _invalidate(self, result, app_key):
+        self.documents.pop(app_key)
+        if app_key in self._reads:
+            count, changed = self._reads[app_key]
+            self._reads[app_key] = (count, True)
+        return result
+
+    def _publish(self, result, kind, *key):
+        if self.bus is not None and getattr(result, 'succeed', False):
+            self.bus.publish(kind, *key)
+        return result
+
+    def put_document(self, uri, document, check_etag):
+        app_key = self._application_key(uri)
+        self._invalidate(None, app_key)
+        d = self.storage.put_document(uri, document, check_etag)
+        d.addBoth(self._invalidate, app_key)
+        d.addCallback(self._publish, 'document', *app_key)
+        return d
+
+    def delete_document(self, uri, check_etag):
+        app_key = self._application_key(uri)
+        self._invalidate(None, app_key)
+        d = self.storage.delete_document(uri, check_etag)
+        d.addBoth(self._invalidate, app_key)
+        d.addCallback(self._publish, 'document', *app_key)
+        return d
+
+    def delete_documents(self, uri, *args):
+        user = str(uri.user)
+        self._purge(None, user)
+        d = self.storage.delete_documents(uri, *args)
+        d.addBoth(self._purge, user)
+        d.addCallback(self._publish, 'user', user)
+        return d
+
+    def _purge(self, result, user):
+        for app_key in [app_key for app_key in self.documents.keys() + self._reads.keys() if app_key[0] == user]:
+            self._invalidate(None, app_key)
+        return result
+
+
+def get_credentials_cache():
+    """Return a CredentialsCache configured from the [Cache] section or None if disabled"""
+    if not Config.credentials_cache_size:
+        return None
+    return CredentialsCache(Config.credentials_cache_size, Config.credentials_ttl, Config.negative_credentials_ttl)
+
+class _WatchersCacheHolder(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        if Config.watchers_cache_size and Config.watchers_ttl:
+            self.cache = WatchersCache(Config.watchers_cache_size, Config.watchers_ttl, get_invalidation_bus())
+        else:
+            self.cache = None
+
+def get_watchers_cache():
+    """Return the WatchersCache shared by the watchers application and the backends or None if disabled"""
+    return _WatchersCacheHolder().cache
+
+class _ParsedDocumentCacheHolder(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        if Config.parsed_document_cache_size:
+            self.cache = ParsedDocumentCache(Config.parsed_document_cache_size, Config.index_elements)
+        else:
+            self.cache = None
+
+def get_parsed_document_cache():
+    """Return the ParsedDocumentCache shared by the applications or None if disabled"""
+    return _ParsedDocumentCacheHolder().cache
+
+class _ValidationCacheHolder(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        if Config.validation_cache_size:
+            self.cache = ValidationCache(Config.validation_cache_size, Config.cache_validation_failures)
+        else:
+            self.cache = None
+
+def get_validation_cache():
+    """Return the ValidationCache shared by the applications or None if disabled"""
+    return _ValidationCacheHolder().cache
@@ -67,3 +67,23 @@ class XCAPRootURI(str):
         else:
             raise ValueError("Invalid port specified")
 
+
+class DataSize(int):
+    """A size in bytes, optionally followed by one of the K, M or G multipliers
+
+    >>> DataSize('64M')
+    67108864
+    """
+
+    multipliers = {'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+    def __new__(cls, value):
+        if isinstance(value, basestring):
+            value = value.strip()
+            multiplier = cls.multipliers.get(value[-1:].lower(), None)
+            if multiplier is not None:
+                value = int(value[:-1]) * multiplier
+        value = int(value)
+        if value < 0:
+            raise ValueError("size cannot be negative")
+        return int.__new__(cls, value)
@@ -6,13 +6,19 @@
 
 import time
 import random
+import zlib
 
 from hashlib import md5
+from application import log
 from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall, deferLater
 from twisted.python import reflect
+from twisted.python.failure import Failure
 
 db_modules = {"mysql": "MySQLdb",
-              "postgres":"psycopg2"}
+              "postgres":"psycopg2",
+              "sqlite": "xcap.sqlitedb"}
 
 def make_random_etag(uri):
     return md5("%s%s%s" % (uri, time.time(), random.random())).hexdigest()
@@ -20,6 +26,51 @@ def make_random_etag(uri):
 def make_etag(uri, document):
     return md5("%s%s" % (uri, document)).hexdigest()
 
+# The first byte of a stored document tells how it is encoded. XML documents
+# cannot start with a control character, so documents stored as plain XML
+# (including all the ones stored before the encoding was introduced) are
+# returned as they are.
+ENCODING_ZLIB = '\x01'
+_reserved_encodings = set(chr(i) for i in xrange(2, 9))
+
+def encode_document(document, threshold, level=6):
+    """Return the document compressed with a header byte if it is at least
+    threshold bytes long and compressing it makes it smaller.
+
+    >>> document = '<list>%s</list>' % ('<entry uri="sip:alice@example.com"/>' * 100)
+    >>> data = encode_document(document, 1024)
+    >>> data[0] == ENCODING_ZLIB and len(data) < len(document)
+    True
+    >>> decode_document(data) == document
+    True
+    >>> encode_document('<list/>', 1024)
+    '<list/>'
+    >>> decode_document('<list/>')
+    '<list/>'
+    """
+    if len(document) < threshold:
+        return document
+    data = ENCODING_ZLIB + zlib.compress(document, level)
+    if len(data) >= len(document):
+        return document
+    return data
+
+def decode_document(data):
+    """Return the XML document stored as data by encode_document."""
+    if isinstance(data, buffer):
+        data = str(data)
+    header = data[:1]
+    if header == ENCODING_ZLIB:
+        return zlib.decompress(data[1:])
+    elif header in _reserved_encodings:
+        raise ValueError("unknown document encoding %r" % header)
+    return data
+
+def make_binary(schema, data):
+    """Wrap data with the Binary type of the database driver, so that encoded
+    documents are stored as binary strings."""
+    return reflect.namedModule(db_modules[schema]).Binary(data)
+
 def parseURI(uri):
     schema, rest = uri.split(':', 1)
     assert rest.startswith('//'), "DB URIs must start with scheme:// -- you did not include a / (in %r)" % rest
@@ -53,8 +104,43 @@ def parseURI(uri):
     db = rest
     return schema, user, password, host, port, db
 
+def parseSQLiteURI(uri):
+    """Return the path and the number of reader connections from a sqlite:// URI.
+
+    >>> parseSQLiteURI('sqlite:///var/lib/openxcap/xcap.db')
+    ('/var/lib/openxcap/xcap.db', 4)
+    >>> parseSQLiteURI('sqlite://xcap.db?readers=8')
+    ('xcap.db', 8)
+    """
+    assert uri.startswith('sqlite://'), "SQLite URIs must start with sqlite:// (got %r)" % uri
+    path, readers = uri[9:], 4
+    if '?' in path:
+        path, options = path.split('?', 1)
+        for option in options.split('&'):
+            name, value = option.split('=', 1)
+            if name == 'readers':
+                readers = int(value)
+            else:
+                raise ValueError("Unknown SQLite URI option: %s" % name)
+    if not path:
+        raise ValueError("You MUST specify a database file in the SQLite URI.")
+    return path, readers
+
+def sqliteConnectionForURI(uri):
+    """Return a Twisted adbapi connection pool with a single connection for a
+    SQLite database, which serializes the writes, and a pool of reader
+    connections as its readers attribute."""
+    path, readers = parseSQLiteURI(uri)
+    pool = adbapi.ConnectionPool(db_modules['sqlite'], path, cp_min=1, cp_max=1, cp_noisy=False)
+    pool.schema = 'sqlite'
+    pool.readers = adbapi.ConnectionPool(db_modules['sqlite'], path, cp_min=1, cp_max=readers, cp_noisy=False)
+    pool.readers.schema = 'sqlite'
+    return pool
+
 def connectionForURI(uri):
     """Return a Twisted adbapi connection pool for a given database URI."""
+    if uri.startswith('sqlite:'):
+        return sqliteConnectionForURI(uri)
     schema, user, password, host, port, db = parseURI(uri)
     try:
         module = db_modules[schema]
@@ -98,13 +184,348 @@ def connectionForURI(uri):
     pool.schema = schema
     return pool
 
+
+class Replica(object):
+    def __init__(self, uri, pool, weight=1):
+        self.uri = uri
+        self.pool = pool
+        self.weight = weight
+        self.healthy = True
+        self.lag = None
+
+    def __repr__(self):
+        return '<Replica %s weight=%d healthy=%s lag=%s>' % (self.uri.split('@', 1)[-1], self.weight, self.healthy, self.lag)
+
+
+class ReplicaPool(object):
+    """Distributes read-only interactions among the connection pools of the
+    given read replicas. A replica URI can be followed by ;weight=N to send it
+    N times as many reads as a replica of weight 1.
+
+    The replicas are checked every check_interval seconds and a replica that
+    cannot be queried or that lags more than max_lag seconds behind the primary
+    doesn't receive reads until a later check finds it in sync again. An
+    interaction that fails with a database error of the replica is repeated on
+    the primary, as is one for which stale(result) returns True, result being
+    a Failure if the interaction failed: the replica may be behind.
+    """
+
+    def __init__(self, uris, max_lag=10, check_interval=5, stale=None):
+        self.replicas = []
+        for uri in uris:
+            weight = 1
+            if ';weight=' in uri:
+                uri, weight = uri.rsplit(';weight=', 1)
+                weight = int(weight)
+            self.replicas.append(Replica(uri, connectionForURI(uri), weight))
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.stale = stale or (lambda result: False)
+        self.statistics = dict(replica_reads=0, primary_reads=0, fallbacks=0)
+        self._checker = LoopingCall(self.check_replicas)
+        self._checker.start(check_interval, now=True)
+
+    def choose(self):
+        """Return a healthy replica chosen randomly according to the weights or None"""
+        replicas = [replica for replica in self.replicas if replica.healthy and replica.weight > 0]
+        if not replicas:
+            return None
+        point = random.uniform(0, sum(replica.weight for replica in replicas))
+        for replica in replicas:
+            point -= replica.weight
+            if point < 0:
+                break
+        return replica
+
+    def runInteraction(self, primary, interaction, *args, **kw):
+        """Run the interaction on a replica, falling back to the primary pool."""
+        replica = self.choose()
+        if replica is None:
+            self.statistics['primary_reads'] += 1
+            return primary.runInteraction(interaction, *args, **kw)
+        self.statistics['replica_reads'] += 1
+        d = replica.pool.runInteraction(interaction, *args, **kw)
+        d.addBoth(self._replica_done, replica, primary, interaction, args, kw)
+        return d
+
+    def _replica_done(self, result, replica, primary, interaction, args, kw):
+        if isinstance(result, Failure) and result.check(replica.pool.dbapi.Error):
+            log.error("Read replica %s failed, excluding it until the next check: %s" % (replica.uri.split('@', 1)[-1], result.getErrorMessage()))
+            replica.healthy = False
+        elif not self.stale(result):
+            return result
+        self.statistics['fallbacks'] += 1
+        return primary.runInteraction(interaction, *args, **kw)
+
+    def check_replicas(self):
+        for replica in self.replicas:
+            d = replica.pool.runInteraction(self._get_lag, replica.pool.schema)
+            d.addCallbacks(self._got_lag, self._check_failed, callbackArgs=(replica,), errbackArgs=(replica,))
+
+    def _get_lag(self, trans, schema):
+        if schema == 'mysql':
+            trans.execute("SHOW SLAVE STATUS")
+            row = trans.fetchone()
+            if row is None:
+                # not replicating
+                return 0
+            columns = [column[0] for column in trans.description]
+            # NULL if replication is stopped
+            return row[columns.index('Seconds_Behind_Master')]
+        else:
+            # the replay timestamp only advances when there is something to replay
+            trans.execute("""SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                                         WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                         ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END""")
+            return trans.fetchone()[0]
+
+    def _got_lag(self, lag, replica):
+        replica.lag = lag
+        healthy = lag is not None and lag <= self.max_lag
+        if healthy != replica.healthy:
+            if healthy:
+                log.msg("Read replica %s is back in service (lag %s seconds)" % (replica.uri.split('@', 1)[-1], lag))
+            else:
+                log.error("Read replica %s is lagging (%s seconds), excluding it" % (replica.uri.split('@', 1)[-1], lag))
+        replica.healthy = healthy
+
+    def _check_failed(self, failure, replica):
+        if replica.healthy:
+            log.error("Read replica %s check failed, excluding it: %s" % (replica.uri.split('@', 1)[-1], failure.getErrorMessage()))
+        replica.healthy = False
+        replica.lag = None
+
+    def close(self):
+        if self._checker.running:
+            self._checker.stop()
+        for replica in self.replicas:
+            replica.pool.close()
+
+
+def shard_for_user(username, domain, names):
+    """Return the name of the shard a user belongs to using rendezvous hashing,
+    so that adding or removing a shard only moves the users of that shard.
+
+    >>> shard_for_user('alice', 'example.com', ['a', 'b', 'c']) in ('a', 'b', 'c')
+    True
+    >>> names = ['a', 'b']
+    >>> users = [('user%d' % i, 'example.com') for i in xrange(100)]
+    >>> moved = [u for u in users if shard_for_user(u[0], u[1], names) != shard_for_user(u[0], u[1], names + ['c'])]
+    >>> set(shard_for_user(u[0], u[1], names + ['c']) for u in moved)
+    set(['c'])
+    """
+    user = '%s@%s' % (username, domain)
+    return max(names, key=lambda name: md5('%s/%s' % (user, name)).digest())
+
+
+class ShardedConnectionPool(object):
+    """Routes the interactions of a user to the connection pool of the shard
+    holding the user's documents. The first argument of an interaction must be
+    an XCAP URI, whose user selects the shard.
+
+    The shards are given as name=URI strings. A user belongs to the shard
+    given by shard_for_user, unless the shard map table in the map database
+    says otherwise (used for the users that were moved between shards). The
+    shard map lookups are cached for map_ttl seconds, so after changing the map
+    all the servers route the user to the new shard after map_ttl seconds.
+    """
+
+    def __init__(self, shards, map_pool, map_table='xcap_shard_map', map_ttl=30):
+        self.names = []
+        self.shards = {}
+        for shard in shards:
+            try:
+                name, uri = shard.split('=', 1)
+            except ValueError:
+                raise ValueError("Invalid shard %r, it must be given as name=URI" % shard)
+            self.names.append(name)
+            self.shards[name] = connectionForURI(uri)
+        schemas = set(pool.schema for pool in self.shards.itervalues())
+        if len(schemas) != 1:
+            raise ValueError("All the shards must use the same database type")
+        self.schema = schemas.pop()
+        self.map_pool = map_pool
+        self.map_table = map_table
+        self.map_ttl = map_ttl
+        self.statistics = dict(map_hits=0, map_misses=0)
+        self._map_cache = {}
+        self._next_purge = time.time() + map_ttl
+
+    def get_shard(self, username, domain):
+        """Return a deferred that fires with the name of the shard of a user"""
+        now = time.time()
+        if now > self._next_purge:
+            for key, (name, expires) in self._map_cache.items():
+                if expires < now:
+                    del self._map_cache[key]
+            self._next_purge = now + self.map_ttl
+        try:
+            name, expires = self._map_cache[(username, domain)]
+        except KeyError:
+            pass
+        else:
+            if expires >= now:
+                self.statistics['map_hits'] += 1
+                return defer.succeed(name)
+        self.statistics['map_misses'] += 1
+        query = "SELECT shard FROM %s WHERE username = %%(username)s AND domain = %%(domain)s" % self.map_table
+        d = self.map_pool.runQuery(query, {'username': username, 'domain': domain})
+        d.addCallback(self._got_map_entry, username, domain)
+        return d
+
+    def _got_map_entry(self, rows, username, domain):
+        if rows:
+            name = rows[0][0]
+            if name not in self.shards:
+                raise ValueError("User %s@%s is mapped to unknown shard %r" % (username, domain, name))
+        else:
+            name = shard_for_user(username, domain, self.names)
+        self._map_cache[(username, domain)] = (name, time.time() + self.map_ttl)
+        return name
+
+    def forget(self, username, domain):
+        """Drop the cached shard of a user"""
+        self._map_cache.pop((username, domain), None)
+
+    def runInteraction(self, interaction, uri, *args, **kw):
+        d = self.get_shard(uri.user.username, uri.user.domain)
+        d.addCallback(lambda name: self.shards[name].runInteraction(interaction, uri, *args, **kw))
+        return d
+
+    def close(self):
+        for pool in self.shards.itervalues():
+            pool.close()
+
+
+class BlockingConnection(object):
+    """A blocking DB-API connection for a database URI, used by the maintenance
+    scripts which do not run the reactor."""
+
+    def __init__(self, uri):
+        if uri.startswith('sqlite:'):
+            self.connection = reflect.namedModule(db_modules['sqlite']).connect(parseSQLiteURI(uri)[0])
+            self.schema = 'sqlite'
+            return
+        schema, user, password, host, port, db = parseURI(uri)
+        try:
+            module = reflect.namedModule(db_modules[schema])
+        except KeyError:
+            raise ValueError("Database scheme '%s' is not supported." % schema)
+        if schema == 'mysql':
+            self.connection = module.connect(host=host or 'localhost', port=port or 3306, user=user or '', passwd=password or '', db=db)
+        else:
+            self.connection = module.connect(host=host or 'localhost', port=port or 5432, user=user or '', password=password or '', database=db)
+        self.schema = schema
+
+    def query(self, query, params=None):
+        """Execute a query and return the rows it produced, if any."""
+        cursor = self.connection.cursor()
+        cursor.execute(query, params)
+        if cursor.description is None:
+            return []
+        return cursor.fetchall()
+
+    def iterate(self, query, params=None, size=1000):
+        """Execute a query and yield the rows it produces, fetching them from a
+        server side cursor size rows at a time, so that large results are
+        never held in memory."""
+        if self.schema == 'mysql':
+            import MySQLdb.cursors
+            cursor = self.connection.cursor(MySQLdb.cursors.SSCursor)
+        elif self.schema == 'postgres':
+            cursor = self.connection.cursor(name='openxcap_%d' % id(self))
+            cursor.itersize = size
+        else:
+            # SQLite cursors step through the results as they are fetched
+            cursor = self.connection.cursor()
+        cursor.execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def executemany(self, query, seq_of_params):
+        cursor = self.connection.cursor()
+        cursor.executemany(query, seq_of_params)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+
+class KeyedLock(object):
+    """Serializes the operations on the same key: an operation started with run
+    waits until the previous operations on its key completed. The number of
+    operations that had to wait is counted for each key in contention (for at
+    most max_keys keys) and in total in statistics."""
+
+    def __init__(self, max_keys=1000):
+        self.locks = {}
+        self.contention = {}
+        self.max_keys = max_keys
+        self.statistics = dict(operations=0, waits=0)
+
+    def run(self, key, func, *args, **kwargs):
+        """Call func when the lock for key is available and return a deferred
+        with its result."""
+        self.statistics['operations'] += 1
+        lock = self.locks.get(key, None)
+        if lock is None:
+            lock = self.locks[key] = defer.DeferredLock()
+        elif lock.locked:
+            self.statistics['waits'] += 1
+            if key in self.contention or len(self.contention) < self.max_keys:
+                self.contention[key] = self.contention.get(key, 0) + 1
+        d = lock.run(func, *args, **kwargs)
+        d.addBoth(self._release, key, lock)
+        return d
+
+    def _release(self, result, key, lock):
+        if not lock.locked and not lock.waiting and self.locks.get(key) is lock:
+            del self.locks[key]
+        return result
+
+    def most_contended(self, count=10):
+        """Return the count keys that waited most often as (waits, key) tuples"""
+        return sorted(((waits, key) for key, waits in self.contention.iteritems()), reverse=True)[:count]
+
+
+# Delays used between the attempts of repeat_on_error: a random delay of up to
+# RETRY_INITIAL_DELAY seconds, doubled for every attempt up to RETRY_MAX_DELAY
+RETRY_INITIAL_DELAY = 0.005
+RETRY_MAX_DELAY = 0.5
+
+def retry_delay(attempt):
+    """Return the jittered exponential backoff delay before the given retry
+
+    >>> 0 <= retry_delay(0) <= RETRY_INITIAL_DELAY
+    True
+    >>> 0 <= retry_delay(100) <= RETRY_MAX_DELAY
+    True
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_INITIAL_DELAY * 2 ** min(attempt, 32)))
+
 def repeat_on_error(N, errorinfo, func, *args, **kwargs):
+    """Call func, which returns a deferred, and repeat the call up to N times
+    while it fails with errorinfo, waiting a little longer before every
+    attempt, so that the writers racing for the same row from different
+    servers don't race again immediately."""
     d = func(*args, **kwargs)
     counter = [N]
     def try_again(error):
         if isinstance(error.value, errorinfo) and counter[0]>0:
             counter[0] -= 1
-            d = func(*args, **kwargs)
+            d = deferLater(reactor, retry_delay(N-counter[0]-1), func, *args, **kwargs)
             d.addErrback(try_again)
             return d
         return error
@@ -112,7 +533,8 @@ def repeat_on_error(N, errorinfo, func, *args, **kwargs):
     return d
 
 if __name__=='__main__':
-    from twisted.internet import defer
+    import doctest
+    doctest.testmod()
 
     def s():
         print 's()'
@@ -128,13 +550,17 @@ if __name__=='__main__':
             print '%s errback: %r' % (msg, x)
         return callback, errback
 
+    deferreds = []
+
     # calls s()'s callback
     d = repeat_on_error(1, Exception, s)
     d.addCallbacks(*getcb('s'))
+    deferreds.append(d)
 
     # calls f() for 4 times (1+3), then gives up and calls last f()'s errback
     d = repeat_on_error(3, Exception, f)
     d.addCallbacks(*getcb('f'))
+    deferreds.append(d)
 
     x = Exception()
     x.lst = [f, f, s]
@@ -145,3 +571,7 @@ if __name__=='__main__':
 
     d = repeat_on_error(1, Exception, bad_func)
     d.addCallbacks(*getcb('bad_func'))
+    deferreds.append(d)
+
+    defer.DeferredList(deferreds).addBoth(lambda result: reactor.stop())
+    reactor.run()
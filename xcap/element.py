@@ -18,11 +18,21 @@ element (but will point to the inserted element after PUT).
 For element selectors of type *[@att="value"] insertion point depends on
 the content of a new element. For RFC compliant behavior, fix such requests
 by replacing '*' with the root tag of the new element.
+
+put_element locates the element or the insertion point in a single parse of
+the document and checks the GET(PUT(x))==x invariant without parsing the new
+document. find, get and put are the reference implementation it is tested
+against.
 """
 
+import re
+from bisect import bisect
+from itertools import islice
 from StringIO import StringIO
-from xcap import uri
 from xml import sax
+from xml.sax.saxutils import quoteattr
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
 
 
 def make_parser():
@@ -108,11 +118,12 @@ class ContentHandlerBase(sax.ContentHandler):
         self.end_pos_2 = end_pos_2
 
     def fix_end_pos(self, document):
-        if self.end_tag is not None and self.end_tag in document[self.end_pos:self.end_pos_2]:
-            if self.end_pos_2 is None:
+        # the end tag may have whitespace before '>', as in '</name >'
+        if self.end_tag is not None:
+            tail = document[self.end_pos:self.end_pos_2]
+            tag = self.end_tag[:-1]
+            if tail.startswith(tag) and tail[len(tag):len(tag)+1] in ('>', ' ', '\t', '\r', '\n'):
                 self.end_pos = 1 + document.index('>', self.end_pos)
-            else:
-                self.end_pos = 1 + document.index('>', self.end_pos, self.end_pos_2)
 
     def __repr__(self):
         return '<%s selector=%r state=%r>' % (self.__class__.__name__, self.selector, self.state)
@@ -239,7 +250,9 @@ class InsertPointLocator(ContentHandlerBase):
         #print '<' * (1+len(self.path) + self.skiplevel), name, '/' + '/'.join(map(str, self.path)),
         #print self.curstep, self.skiplevel
 
-        if self.state=='DONE' and self.end_pos_2 is None:
+        # the end of the last child closed is checked up to the next event,
+        # so that the end tag of a parent with the same name isn't taken for its own
+        if self.state in ('DONE', 'CLOSED') and self.end_pos_2 is None:
             self.end_pos_2 = self.pos()
 
         if self.skiplevel>0:
@@ -267,7 +280,11 @@ class InsertPointLocator(ContentHandlerBase):
         is_last_step = len(self.path)+1 == len(self.selector)
 
         if not is_last_step:
-            if curstep.position is not None and curstep.position != parent.position:
+            if parent is None:
+                if curstep.position not in [None, 1]:
+                    self.skiplevel = 1
+                    return
+            elif curstep.position is not None and curstep.position != parent.position:
                 self.skiplevel = 1
                 return
             if curstep.att_name is not None and \
@@ -286,7 +303,7 @@ class InsertPointLocator(ContentHandlerBase):
         #print '>' * (1+len(self.path)+self.skiplevel-1), name, '/' + '/'.join(map(str, self.path)),
         #print self.curstep, self.skiplevel
 
-        if self.state=='DONE' and self.end_pos_2 is None:
+        if self.state in ('DONE', 'CLOSED') and self.end_pos_2 is None:
             self.end_pos_2 = self.pos()
 
         if self.skiplevel>0:
@@ -334,7 +351,7 @@ class LocatorError(ValueError):
         if locator.state == 'LOOKING':
             return None
         elif locator.state == 'MANY':
-            raise SelectorError(element_selector._original_string, locator)
+            raise SelectorError(getattr(element_selector, '_original_selector', element_selector), locator)
         else:
             raise LocatorError('Internal error in %s' % locator.__class__.__name__, locator)
 
@@ -347,6 +364,12 @@ class SelectorError(LocatorError):
         LocatorError.__init__(self, msg, handler)
 
 
+class InvariantError(LocatorError):
+
+    def __init__(self, msg='PUT request failed GET(PUT(x))==x invariant', handler=None):
+        LocatorError.__init__(self, msg, handler)
+
+
 def find(document, element_selector):
     """Return an element as (first index, last index+1)
 
@@ -415,6 +438,602 @@ def put(document, element_selector, element_str):
         created = False
     return (document[:start] + element_str + document[end:], created)
 
+
+class _StopParsing(Exception):
+    pass
+
+
+class PutLocator(sax.ContentHandler):
+    """Run an ElementLocator and an InsertPointLocator over the same parse.
+
+    Parsing stops as soon as neither of them can change its mind: when the
+    selector matched more than one element or when the element matching the
+    leading steps that select at most one element (the root and the positional
+    steps following it) is closed.
+
+    Also collect what is needed to check the GET(PUT(x))==x invariant without
+    parsing the new document: the namespaces in scope of the parent of the
+    located element or insertion point and the start positions of the children
+    of the insertion point's parent that have the name of the last step.
+    The start positions of the ancestors of the element or insertion point, the
+    name of the located element and the start positions and names of all the
+    children of the insertion point's parent are collected as well.
+    """
+
+    def __init__(self, selector):
+        sax.ContentHandler.__init__(self)
+        self.selector = selector
+        self.element_locator = ElementLocator(selector)
+        if len(selector) > 1:
+            self.insert_locator = InsertPointLocator(selector)
+        else:
+            # there's no place for a second root element
+            self.insert_locator = None
+        self.unique_steps = 1
+        for step in selector[1:]:
+            if step.position is None:
+                break
+            self.unique_steps += 1
+
+    def setDocumentLocator(self, locator):
+        self.element_locator.setDocumentLocator(locator)
+        if self.insert_locator is not None:
+            self.insert_locator.setDocumentLocator(locator)
+
+    def startDocument(self):
+        self.element_locator.startDocument()
+        if self.insert_locator is not None:
+            self.insert_locator.startDocument()
+        self.namespaces = [{'xml': XML_NAMESPACE}]
+        self.declarations = {}
+        self.starts = []
+        self.closed = False
+        self.element_namespaces = None
+        self.element_ancestors = None
+        self.element_name = None
+        self.parent_start = None
+        self.parent_namespaces = None
+        self.parent_ancestors = None
+        self.children = None
+        self.siblings = None
+        self.insert_parent_start = None
+        self.insert_namespaces = None
+        self.insert_ancestors = None
+        self.insert_children = None
+        self.insert_siblings = None
+
+    def startPrefixMapping(self, prefix, uri):
+        self.declarations[prefix] = uri
+
+    def startElementNS(self, name, qname, attrs):
+        if self.declarations:
+            namespaces = self.namespaces[-1].copy()
+            namespaces.update(self.declarations)
+            self.declarations = {}
+            self.namespaces.append(namespaces)
+        else:
+            self.namespaces.append(self.namespaces[-1])
+        el = self.element_locator
+        self.starts.append(el.pos())
+        if el.state != 'LOOKING':
+            # once an element was found, the insertion point doesn't matter
+            el.startElementNS(name, qname, attrs)
+            self._check_done()
+            return
+        el.startElementNS(name, qname, attrs)
+        if el.state == 'FOUND':
+            self.element_namespaces = self.namespaces[-2]
+            self.element_ancestors = self.starts[:-1]
+            self.element_name = name
+        ipl = self.insert_locator
+        if ipl is not None:
+            depth = len(ipl.path)
+            if ipl.skiplevel == 0 and depth == len(self.selector) - 1:
+                self.siblings.append((el.pos(), name))
+                step = self.selector[-1]
+                if step.name == '*' or step.name == name:
+                    self.children.append(el.pos())
+            end_pos = ipl.end_pos
+            ipl.startElementNS(name, qname, attrs)
+            if len(ipl.path) == len(self.selector) - 1 > depth:
+                self.parent_start = el.pos()
+                self.parent_namespaces = self.namespaces[-1]
+                self.parent_ancestors = self.starts[:]
+                self.children = []
+                self.siblings = []
+            if ipl.end_pos != end_pos:
+                self._set_insert_parent()
+        if self.closed:
+            self._check_done()
+
+    def endElementNS(self, name, qname):
+        el = self.element_locator
+        if el.skiplevel == 0 and len(el.path) <= self.unique_steps:
+            self.closed = True
+        looking = el.state == 'LOOKING'
+        el.endElementNS(name, qname)
+        ipl = self.insert_locator
+        if looking and ipl is not None:
+            end_pos = ipl.end_pos
+            ipl.endElementNS(name, qname)
+            if ipl.end_pos != end_pos:
+                self._set_insert_parent()
+        self.namespaces.pop()
+        self.starts.pop()
+        if self.closed:
+            self._check_done()
+
+    def _set_insert_parent(self):
+        self.insert_parent_start = self.parent_start
+        self.insert_namespaces = self.parent_namespaces
+        self.insert_ancestors = self.parent_ancestors
+        self.insert_children = self.children
+        self.insert_siblings = self.siblings
+
+    def _check_done(self):
+        el = self.element_locator
+        if el.state == 'MANY':
+            raise _StopParsing
+        if not self.closed:
+            return
+        if el.state == 'DONE':
+            if el.end_pos_2 is None:
+                return
+        elif self.insert_locator is not None and self.insert_locator.state == 'DONE':
+            if self.insert_locator.end_pos_2 is None:
+                return
+        raise _StopParsing
+
+
+_EMPTY_ELEMENT_TAG = re.compile(r'''<[^\s/>]+(?:\s+[^\s=]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*/>''')
+
+def _is_empty_element_tag(document, start):
+    return _EMPTY_ELEMENT_TAG.match(document, start) is not None
+
+
+class _FragmentRoot(sax.ContentHandler):
+    """Record the name, attributes and extent of the root element of a fragment"""
+
+    def setDocumentLocator(self, locator):
+        self.locator = locator
+
+    def startDocument(self):
+        self.depth = 0
+        self.name = None
+        self.attrs = None
+        self.start = self.end = None
+
+    def startElement(self, name, attrs):
+        if self.depth == 0:
+            self.name = name
+            self.attrs = dict(attrs.items())
+            self.start = self.locator._ref._parser.CurrentByteIndex
+        self.depth += 1
+
+    def endElement(self, name):
+        self.depth -= 1
+        if self.depth == 0:
+            self.end = self.locator._ref._parser.CurrentByteIndex
+
+
+def _resolve_qname(qname, namespaces, default):
+    if ':' in qname:
+        prefix, name = qname.split(':', 1)
+        # an unbound prefix makes the new document not well-formed; the name
+        # of its element must not match anything
+        return (namespaces.get(prefix, _resolve_qname), name)
+    return (default, qname)
+
+def _check_invariant(element_str, step, namespaces, position):
+    """Check that the element in element_str, put in a place where the namespaces
+    are in scope and where it is the position-th child matching the name of step,
+    is what step selects."""
+    fragment = element_str.strip()
+    root = _FragmentRoot()
+    parser = sax.make_parser(['xcap.sax.expatreader'])
+    parser.setFeature(sax.handler.feature_namespaces, 0)
+    parser.setFeature(sax.handler.feature_namespace_prefixes, 0)
+    parser.setContentHandler(root)
+    parser.parse(StringIO(fragment))
+    # GET only returns the element, not the comments or processing instructions around it
+    end = root.end
+    if fragment.startswith('</', end):
+        end = fragment.index('>', end) + 1
+    if root.start != 0 or end != len(fragment):
+        raise InvariantError
+    namespaces = dict(namespaces)
+    attrs = {}
+    for qname, value in root.attrs.iteritems():
+        if qname == 'xmlns':
+            namespaces[None] = value
+        elif qname.startswith('xmlns:'):
+            namespaces[qname[6:]] = value
+    for qname, value in root.attrs.iteritems():
+        if qname != 'xmlns' and not qname.startswith('xmlns:'):
+            attrs[_resolve_qname(qname, namespaces, None)] = value
+    if step.name != '*' and step.name != _resolve_qname(root.name, namespaces, namespaces.get(None) or None):
+        raise InvariantError
+    if step.att_name is not None and attrs.get(step.att_name) != step.att_value:
+        raise InvariantError
+    if step.position is not None and position is not None and position != step.position:
+        raise InvariantError
+
+def put_element(document, element_selector, element_str, context=None):
+    """Return a 2-items tuple: (new_document, created), like put.
+
+    The element or the insertion point are located in a single parse of the
+    document, which stops as soon as the result is known, and the new document
+    is not parsed again to check that element_selector selects element_str in
+    it (GET(PUT(x))==x): InvariantError is raised if it doesn't.
+
+    If context is a dict, the position of the new element is stored in it as
+    'start' and the start positions of its ancestors (the root first) as
+    'ancestors'. The ancestors are at the same positions in both documents.
+    The (namespace, name) of the element right before a new element, in the
+    same parent, is stored as 'previous' (None if it's the first child or if
+    an element was replaced) and the (namespace, name) of the replaced element
+    as 'replaced' (None if the element was added).
+
+    If it's impossible to insert at this location, return None.
+    If element_selector matches more than one element or more than one possible
+    place to insert, raise SelectorError.
+    """
+    locator = PutLocator(element_selector)
+    parser = make_parser()
+    parser.setContentHandler(locator)
+    try:
+        parser.parse(StringIO(document))
+    except _StopParsing:
+        pass
+    el = locator.element_locator
+    ipl = locator.insert_locator
+    if el.state == 'DONE':
+        el.fix_end_pos(document)
+        start, end = el.start_pos, el.end_pos
+        created = False
+        # the replaced element had the same position
+        namespaces, position = locator.element_namespaces, None
+        parents = locator.element_ancestors
+        previous = None
+        replaced = locator.element_name
+    elif el.state == 'LOOKING' and ipl is not None:
+        if ipl.state != 'DONE':
+            return LocatorError.generate_error(ipl, element_selector)
+        ipl.fix_end_pos(document)
+        start = end = ipl.end_pos
+        created = True
+        if _is_empty_element_tag(document, locator.insert_parent_start):
+            # the insertion point is right after <parent/>, not inside it
+            raise InvariantError
+        namespaces = locator.insert_namespaces
+        position = len([child for child in locator.insert_children if child < start]) + 1
+        parents = locator.insert_ancestors
+        previous = [name for pos, name in locator.insert_siblings if pos < start]
+        previous = previous and previous[-1] or None
+        replaced = None
+    else:
+        return LocatorError.generate_error(el, element_selector)
+    _check_invariant(element_str, element_selector[-1], namespaces, position)
+    if context is not None:
+        context['start'] = start
+        context['ancestors'] = parents
+        context['previous'] = previous
+        context['replaced'] = replaced
+    return (document[:start] + element_str + document[end:], created)
+
+
+_TAG_NAME = re.compile(r'<[^\s/>]+')
+_ATTRIBUTE = re.compile(r'''\s+([^\s=/>]+)\s*=\s*(?:"[^"]*"|'[^']*')''')
+
+def _find_attribute(document, start, name):
+    """Return the span of the attribute name (with the whitespace before it)
+    in the start tag at start and the end of the last attribute"""
+    pos = _TAG_NAME.match(document, start).end()
+    while True:
+        m = _ATTRIBUTE.match(document, pos)
+        if m is None:
+            return None, pos
+        if m.group(1) == name:
+            return (m.start(), m.end()), pos
+        pos = m.end()
+
+_START_TAG_END = re.compile(r'\s*/?>')
+
+def start_tag_end(document, start):
+    """Return the position right after the start tag at start"""
+    return _START_TAG_END.match(document, _find_attribute(document, start, None)[1]).end()
+
+def wrap_element(document, ancestors, element_str):
+    """Return a document made of element_str inside copies of the start tags
+    of its ancestors, whose start positions in document are given (the root
+    first), with the namespace declarations and attributes they have.
+
+    >>> document = '<a xmlns="urn:a" x="1"><b y=">"><c/></b><d/></a>'
+    >>> wrap_element(document, [0, 23], '<e/>')
+    '<a xmlns="urn:a" x="1"><b y=">"><e/></b></a>'
+    """
+    start_tags = []
+    end_tags = []
+    for start in ancestors:
+        start_tags.append(document[start:start_tag_end(document, start)])
+        end_tags.append('</%s>' % _TAG_NAME.match(document, start).group()[1:])
+    end_tags.reverse()
+    return ''.join(start_tags) + element_str + ''.join(end_tags)
+
+# the beginning of a start tag, in documents without comments, CDATA sections,
+# processing instructions (other than the XML declaration) and DOCTYPE
+_START_TAG = re.compile(r'<(?=[^!?/])')
+
+# the markup which isn't a start tag, or the beginning of a start tag
+_MARKUP = re.compile(r'(<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<!DOCTYPE(?:[^\[>]|\[.*?\])*>)|<(?=[^!?/])', re.S)
+
+def start_tag_position(document, index, qname):
+    """Return the position of the start tag of the index-th element of document
+    (in document order, starting from 0) or None if it isn't a qname element.
+
+    >>> document = '<?xml version="1.0"?><a><!-- <x> --><b><![CDATA[<y>]]></b><c/></a>'
+    >>> start_tag_position(document, 2, 'c')
+    58
+    >>> start_tag_position(document, 2, 'x') is None
+    True
+    >>> start_tag_position('<?xml version="1.0"?><a><b>x</b><c/></a>', 2, 'c')
+    32
+    >>> start_tag_position('<a><b/></a>', 2, 'c') is None
+    True
+    """
+    if document.find('<!') == -1 and document.find('<?', 1) == -1:
+        # the common case, skip the preceding start tags without a python loop
+        try:
+            m = islice(_START_TAG.finditer(document), index, None).next()
+        except StopIteration:
+            return None
+        if _TAG_NAME.match(document, m.start()).group() == '<' + qname:
+            return m.start()
+        return None
+    count = 0
+    for m in _MARKUP.finditer(document):
+        if m.group(1) is None:
+            if count == index:
+                if _TAG_NAME.match(document, m.start()).group() == '<' + qname:
+                    return m.start()
+                return None
+            count += 1
+    return None
+
+def put_attribute(document, element_selector, name, value, start=None):
+    """Return a 2-items tuple: (new_document, created).
+    new_document is a copy of document where the attribute name of the element
+    selected by element_selector (whose start tag is at start, if given) is set to value
+    by replacing the attribute or adding it after the last one in the start tag.
+    The rest of the document is left as is.
+
+    If the element couldn't be found, return None.
+    If element_selector matches more than one element, raise SelectorError.
+    If element_selector wouldn't select the element anymore, raise InvariantError.
+
+    >>> from xcap.xpath import parse_node_selector
+    >>> selector = parse_node_selector('/root/el[@id="1"]')[0]
+    >>> put_attribute('<root><el id="1" a = "b"/></root>', selector, 'a', 'x<y')
+    ('<root><el id="1" a="x&lt;y"/></root>', False)
+    >>> new_document, created = put_attribute("<root>\\n  <el  id='1'>text</el>\\n</root>", selector, 'a', 'b')
+    >>> print new_document, created
+    <root>
+      <el  id='1' a="b">text</el>
+    </root> True
+    >>> put_attribute('<root><el id="1"/></root>', selector, 'id', '2')
+    Traceback (most recent call last):
+     ...
+    InvariantError: PUT request failed GET(PUT(x))==x invariant
+    """
+    step = element_selector[-1]
+    if step.att_name == (None, name) and step.att_value != value:
+        raise InvariantError
+    if start is None:
+        location = find(document, element_selector)
+        if location is None:
+            return None
+        start = location[0]
+    span, end = _find_attribute(document, start, name)
+    attribute = ' %s=%s' % (name, quoteattr(value))
+    if span is None:
+        return (document[:end] + attribute + document[end:], True)
+    return (document[:span[0]] + attribute + document[span[1]:], False)
+
+def delete_attribute(document, element_selector, name, start=None):
+    """Return document with the attribute name of the element selected by
+    element_selector (whose start tag is at start, if given) removed.
+
+    If the element or the attribute couldn't be found, return None.
+    If element_selector matches more than one element, raise SelectorError.
+
+    >>> from xcap.xpath import parse_node_selector
+    >>> selector = parse_node_selector('/root/el')[0]
+    >>> delete_attribute('<root><el a="1" b=\\'>\\'></el></root>', selector, 'b')
+    '<root><el a="1"></el></root>'
+    >>> delete_attribute('<root><el a="1"/></root>', selector, 'b') is None
+    True
+    """
+    if start is None:
+        location = find(document, element_selector)
+        if location is None:
+            return None
+        start = location[0]
+    span, end = _find_attribute(document, start, name)
+    if span is None:
+        return None
+    return document[:span[0]] + document[span[1]:]
+
+
+# attributes commonly used in element selectors to pick an element among its siblings
+KEY_ATTRIBUTES = frozenset([(None, 'name'), (None, 'uri'), (None, 'ref'), (None, 'anchor'), (None, 'id')])
+
+class NotIndexed(Exception):
+    """The element selector uses an attribute which is not indexed"""
+
+
+class _IndexNode(object):
+    __slots__ = ('name', 'start', 'end', 'attrs', 'children', '_by_name', '_by_attr')
+
+    def __init__(self, name, start, attrs):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.attrs = attrs
+        self.children = []
+        self._by_name = None
+        self._by_attr = None
+
+    def named(self, name):
+        if name == '*':
+            return self.children
+        if self._by_name is None:
+            self._by_name = {}
+            for child in self.children:
+                self._by_name.setdefault(child.name, []).append(child)
+        return self._by_name.get(name, [])
+
+    def with_attribute(self, name, att_name, att_value):
+        if self._by_attr is None:
+            self._by_attr = {}
+            for child in self.children:
+                if child.attrs:
+                    for key, value in child.attrs.iteritems():
+                        self._by_attr.setdefault((child.name, key, value), []).append(child)
+                        self._by_attr.setdefault(('*', key, value), []).append(child)
+        return self._by_attr.get((name, att_name, att_value), [])
+
+    def select(self, step):
+        """Return the children matched by step"""
+        if step.position is not None:
+            children = self.named(step.name)
+            if not 0 < step.position <= len(children):
+                return []
+            child = children[step.position-1]
+            if step.att_name is not None and (child.attrs or {}).get(step.att_name) != step.att_value:
+                return []
+            return [child]
+        if step.att_name is not None:
+            return self.with_attribute(step.name, step.att_name, step.att_value)
+        return self.named(step.name)
+
+
+class _IndexBuilder(sax.ContentHandler):
+
+    def __init__(self, document):
+        sax.ContentHandler.__init__(self)
+        self.document = document
+        self.locator = None
+
+    def setDocumentLocator(self, locator):
+        self.locator = locator
+
+    def startDocument(self):
+        self.root = None
+        self.path = []
+
+    def startElementNS(self, name, qname, attrs):
+        key_attrs = None
+        for key, value in attrs.items():
+            if key in KEY_ATTRIBUTES:
+                if key_attrs is None:
+                    key_attrs = {}
+                key_attrs[key] = value
+        node = _IndexNode(name, self.locator._ref._parser.CurrentByteIndex, key_attrs)
+        if self.path:
+            self.path[-1].children.append(node)
+        else:
+            self.root = node
+        self.path.append(node)
+
+    def endElementNS(self, name, qname):
+        node = self.path.pop()
+        document = self.document
+        pos = self.locator._ref._parser.CurrentByteIndex
+        # the position is right after <name/> or at the start of </name>, but
+        # <name/> can be followed by the end tag of the parent
+        if not document.startswith('</', pos):
+            node.end = pos
+        elif not node.children and document.startswith('/>', pos-2) and _is_empty_element_tag(document, node.start):
+            node.end = pos
+        else:
+            node.end = document.index('>', pos) + 1
+
+
+class ElementIndex(object):
+    """The location of every element of a document, which answers the element
+    selectors whose steps only test the name, the position or one of the
+    KEY_ATTRIBUTES of an element without parsing the document again.
+
+    >>> from xcap.xpath import parse_node_selector
+    >>> document = '<lists><list name="a"><entry uri="x"/><entry uri="y"><n>Y</n></entry></list></lists>'
+    >>> index = ElementIndex(document)
+    >>> start, end = index.find(parse_node_selector('/lists/list[@name="a"]/entry[@uri="y"]')[0])
+    >>> document[start:end]
+    '<entry uri="y"><n>Y</n></entry>'
+    >>> start, end = index.find(parse_node_selector('/lists/*[1]/entry[1]')[0])
+    >>> document[start:end]
+    '<entry uri="x"/>'
+    >>> index.find(parse_node_selector('/lists/list/entry[@uri="z"]')[0]) is None
+    True
+    >>> index.find(parse_node_selector('/lists/list/entry')[0])
+    Traceback (most recent call last):
+     ...
+    SelectorError: The requested node selector /lists/list/entry matches more than one element
+    >>> index.find(parse_node_selector('/lists/list/entry[@foo="x"]')[0])
+    Traceback (most recent call last):
+     ...
+    NotIndexed
+    >>> index.ancestors(document.index('<n>'))
+    [0, 7, 38]
+    """
+
+    def __init__(self, document):
+        builder = _IndexBuilder(document)
+        parser = make_parser()
+        parser.setContentHandler(builder)
+        parser.parse(StringIO(document))
+        self.root = builder.root
+
+    def find(self, element_selector):
+        """Return an element as (first index, last index+1), like find.
+
+        Raise NotIndexed if the element selector cannot be answered from the index.
+        """
+        for step in element_selector:
+            if step.att_name is not None and step.att_name not in KEY_ATTRIBUTES:
+                raise NotIndexed
+        step = element_selector[0]
+        root = self.root
+        if step.name != '*' and step.name != root.name or step.position not in [None, 1]:
+            return None
+        if step.att_name is not None and (root.attrs or {}).get(step.att_name) != step.att_value:
+            return None
+        nodes = [root]
+        for step in element_selector[1:]:
+            if len(nodes) == 1:
+                nodes = nodes[0].select(step)
+            else:
+                nodes = [child for node in nodes for child in node.select(step)]
+            if not nodes:
+                return None
+        if len(nodes) > 1:
+            raise SelectorError(getattr(element_selector, '_original_selector', element_selector))
+        return (nodes[0].start, nodes[0].end)
+
+    def ancestors(self, start):
+        """Return the start positions of the ancestors (the root first) of the
+        element whose start tag is at start or None if there is no such element."""
+        ancestors = []
+        node = self.root
+        while node.start != start:
+            ancestors.append(node.start)
+            children = node.children
+            i = bisect([child.start for child in children], start)
+            if i == 0 or children[i-1].end <= start:
+                return None
+            node = children[i-1]
+        return ancestors
+
 # Q: why create a new parser for every parsing?
 # A: when sax.make_parser() was called once, I've occasionaly encountered an exception like this:
 #
@@ -515,7 +1134,7 @@ class _test(object):
             # where to put namespace?
             r = doc.xpath(xpath_expr, namespaces=namespaces)
         except etree.XPathEvalError:
-            return uri.NodeParsingError
+            return xpath.NodeParsingError
         except Exception, ex:
             traceback.print_exc()
             return ex
@@ -528,9 +1147,9 @@ class _test(object):
     def xcap_get(xpath_expr, source=source1, namespace=None, namespaces={}):
         "Second, use xpath_get_element"
         try:
-            selector = uri.parse_node_selector(xpath_expr, namespace, namespaces)[0]
+            selector = xpath.parse_node_selector(xpath_expr, namespace, namespaces)[0]
             return get(source, selector)
-        except (uri.NodeParsingError, SelectorError), ex :
+        except (xpath.NodeParsingError, SelectorError), ex :
             return ex.__class__
         except Exception, ex:
             traceback.print_exc()
@@ -539,9 +1158,9 @@ class _test(object):
     @staticmethod
     def xcap_put(xpath_expr, element, source=source1, namespace=None, namespaces={}):
         try:
-            selector = uri.parse_node_selector(xpath_expr, namespace, namespaces)[0]
+            selector = xpath.parse_node_selector(xpath_expr, namespace, namespaces)[0]
             return put(source, selector, element)[0]
-        except (uri.NodeParsingError, SelectorError), ex :
+        except (xpath.NodeParsingError, SelectorError), ex :
             return ex.__class__
         except Exception, ex:
             traceback.print_exc()
@@ -579,13 +1198,13 @@ class _test(object):
 
             # there're minor differences between lxml/xpath and this module:
             if xpath_get == cls.lxml_xpath_get:
-                check(uri.NodeParsingError, '/labels\label')
+                check(xpath.NodeParsingError, '/labels\label')
                 check(None, '/')
                 expected1 = '<el1/>'
                 expected2 = None
             else:
                 check(None, '/labels\label')
-                check(uri.NodeParsingError, '/')
+                check(xpath.NodeParsingError, '/')
                 expected1 = '<el1></el1>'
                 expected2 = '<rl:entry uri="sip:joe@example.com"/>'
 
@@ -608,7 +1227,7 @@ class _test(object):
             check(ezra, '/labels/*[4]/name')
             check(ezra, '/labels/*[4][@added="2003-06-10"]/name')
 
-            check(uri.NodeParsingError, '')
+            check(xpath.NodeParsingError, '')
             labels = cls.source1.split('\n', 1)[1].rstrip('\n')
             check(labels, '/labels')
             check(None, '/labels[0]')
@@ -869,6 +1488,7 @@ if __name__ == "__main__":
     doctest.testmod()
     from lxml import etree
     import traceback
+    from xcap import xpath
     _test.test_get()
     _test.test_put0()
     _test.test_put1()
@@ -4,4 +4,4 @@
 
 """Interfaces between OpenXCAP and other components in the system"""
 
-__all__ = ['opensips']
+__all__ = ['invalidation', 'opensips']
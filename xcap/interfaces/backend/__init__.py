@@ -4,8 +4,9 @@
 
 """Interface to the backend subsystem"""
 
-__all__ = ['database', 'opensips']
+__all__ = ['database', 'memory', 'opensips']
 
+from twisted.python.failure import Failure
 from zope.interface import Interface
 
 
@@ -23,6 +24,20 @@ class StatusResponse(object):
 class StorageError(Exception): pass
 
 
+def stale_replica_read(result):
+    """Tell if result, the result of a read run on a read replica (a Failure if
+    it failed), may be due to the replica lagging behind the primary: the
+    document or the documents of the user are missing or an If-Match
+    precondition failed. Anything else, like a 304 for an If-None-Match, is
+    answered by the replica."""
+    if isinstance(result, Failure):
+        response = getattr(result.value, 'response', None)
+        return getattr(response, 'code', None) == 412
+    if isinstance(result, StatusResponse):
+        return result.code == 404
+    return result == {}
+
+
 class IStorage(Interface):
     """Storage interface. It defines the methods an XCAP storage class must implement."""
 
@@ -5,19 +5,25 @@
 """Implementation of a database backend."""
 
 import sys
+import time
+from collections import deque
+
 from application import log
-from application.configuration import ConfigSection
+from application.configuration import ConfigSection, ConfigSetting
+from application.configuration.datatypes import StringList
 from application.python.types import Singleton
 
 from zope.interface import implements
 from twisted.cred import credentials, checkers, error as credError
-from twisted.internet import defer
-
-from _mysql_exceptions import IntegrityError
+from twisted.internet import defer, reactor
+from twisted.python import failure
 
 import xcap
-from xcap.interfaces.backend import IStorage, StatusResponse
-from xcap.dbutil import connectionForURI, repeat_on_error, make_random_etag
+from xcap.cache import get_credentials_cache
+from xcap.interfaces.backend import IStorage, StatusResponse, stale_replica_read
+from xcap.dbutil import connectionForURI, repeat_on_error, make_random_etag, ReplicaPool, ShardedConnectionPool, KeyedLock
+from xcap.dbutil import encode_document, decode_document, make_binary
+from xcap.datatypes import DataSize
 
 class Config(ConfigSection):
     __cfgfile__ = xcap.__cfgfile__
@@ -25,6 +31,18 @@ class Config(ConfigSection):
 
     authentication_db_uri = ''
     storage_db_uri = ''
+    storage_read_db_uris = ConfigSetting(type=StringList, value=[])
+    replica_max_lag = 10
+    replica_check_interval = 5
+    storage_shard_uris = ConfigSetting(type=StringList, value=[])
+    shard_map_table = 'xcap_shard_map'
+    shard_map_ttl = 30
+    compress_documents = False
+    compression_threshold = ConfigSetting(type=DataSize, value=DataSize(4096))
+    compression_level = 6
+    write_batch_delay = 0
+    write_batch_size = 50
+    serialize_writes = True
     subscriber_table = 'subscriber'
     user_col = 'username'
     domain_col = 'domain'
@@ -50,6 +68,10 @@ class PasswordChecker(DBBase):
     credentialInterfaces = (credentials.IUsernamePassword,
         credentials.IUsernameHashedPassword)
 
+    def __init__(self):
+        DBBase.__init__(self)
+        self.cache = get_credentials_cache()
+
     def _db_connect(self):
         self.conn = auth_db_connection(Config.authentication_db_uri)
 
@@ -57,10 +79,17 @@ class PasswordChecker(DBBase):
         raise NotImplementedError
 
     def _got_query_results(self, rows, credentials):
-        if not rows:
+        username, domain = credentials.username.split('@', 1)[0], credentials.realm
+        secret = rows[0][0] if rows else None
+        if self.cache is not None:
+            self.cache.set(username, domain, secret)
+        return self._got_secret(secret, credentials)
+
+    def _got_secret(self, secret, credentials):
+        if secret is None:
             raise credError.UnauthorizedLogin("Unauthorized login")
         else:
-            return self._authenticate_credentials(rows[0][0], credentials)
+            return self._authenticate_credentials(secret, credentials)
 
     def _authenticate_credentials(self, password, credentials):
         raise NotImplementedError
@@ -76,6 +105,13 @@ class PasswordChecker(DBBase):
     def requestAvatarId(self, credentials):
         """Return the avatar ID for the credentials which must have the username
            and realm attributes, or an UnauthorizedLogin in case of a failure."""
+        if self.cache is not None:
+            try:
+                secret = self.cache.get(credentials.username.split('@', 1)[0], credentials.realm)
+            except KeyError:
+                pass
+            else:
+                return defer.maybeDeferred(self._got_secret, secret, credentials)
         d = self._query_credentials(credentials)
         return d
 
@@ -143,22 +179,15 @@ class RaceError(Error):
     """The errors of this type are raised for the requests that failed because
     of concurrent modification of the database by other clients.
 
-    For example, before DELETE we do SELECT first, to check that a document of the
-    right etag exists. The actual check is performed by a function in twisted
-    that is passed as a callback. Then etag from the SELECT request is used in the
-    DELETE request.
-
-    This seems unnecessary convoluted and probably should be changed to
-    'DELETE .. WHERE etag=ETAG'. We still need to find out whether DELETE was
-    actually performed.
+    Writes are performed with a single conditional statement that also returns
+    the etag of the row it replaced, so a race can only be detected (and the
+    request repeated) when a conflicting row appears between the UPDATE and the
+    INSERT issued for a new document on PostgreSQL.
     """
 
 class UpdateFailed(RaceError):
     msg = 'UPDATE request failed'
 
-class DeleteFailed(RaceError):
-    msg = 'DELETE request failed'
-
 class MultipleResultsError(Error):
     """This should never happen. If it did happen. that means either the table
     was corrupted or there's a logic error"""
@@ -166,6 +195,82 @@ class MultipleResultsError(Error):
     def __init__(self, params):
         Exception.__init__(self, 'database request has more than one result: ' + repr(params))
 
+class WriteBatcher(object):
+    """Runs the writes requested within delay seconds of each other, up to
+    max_size of them, in a single transaction. Every write runs in its own
+    savepoint, so a write whose etag check fails is rolled back without
+    affecting the others and each write gets its own result. The writes that
+    failed because of a race, or all of them if the transaction fails, are
+    repeated one by one in their own transactions."""
+
+    def __init__(self, storage, delay, max_size):
+        self.storage = storage
+        self.delay = delay
+        self.max_size = max_size
+        self.queue = []
+        self._timer = None
+
+    def run(self, interaction, uri, *args):
+        d = defer.Deferred()
+        self.queue.append((interaction, uri, args, d))
+        if len(self.queue) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self.delay, self.flush)
+        return d
+
+    def flush(self):
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        entries, self.queue = self.queue, []
+        if not entries:
+            return
+        self.storage.statistics['batches'] += 1
+        self.storage.statistics['batched_writes'] += len(entries)
+        d = self.storage.conn.runInteraction(self._run_batch, entries)
+        d.addCallbacks(self._batch_done, self._batch_failed, callbackArgs=(entries,), errbackArgs=(entries,))
+
+    def _run_batch(self, trans, entries):
+        results = [None] * len(entries)
+        # writing the rows in the same order in all the transactions avoids
+        # deadlocks, the sort is stable so writes of a document keep their order
+        def entry_key(index):
+            uri = entries[index][1]
+            return (uri.user.username, uri.user.domain, uri.application_id, uri.doc_selector.document_path)
+        for index in sorted(xrange(len(entries)), key=entry_key):
+            interaction, uri, args, d = entries[index]
+            self.storage._execute(trans, "SAVEPOINT batch_entry")
+            try:
+                results[index] = interaction(trans, uri, *args)
+            except Exception:
+                results[index] = failure.Failure()
+                self.storage._execute(trans, "ROLLBACK TO SAVEPOINT batch_entry")
+            else:
+                self.storage._execute(trans, "RELEASE SAVEPOINT batch_entry")
+        return results
+
+    def _batch_done(self, results, entries):
+        for (interaction, uri, args, d), result in zip(entries, results):
+            if isinstance(result, failure.Failure):
+                if result.check(RaceError):
+                    self._run_single(interaction, uri, args).chainDeferred(d)
+                else:
+                    d.errback(result)
+            else:
+                d.callback(result)
+
+    def _batch_failed(self, reason, entries):
+        log.error("Batch of %d writes failed, repeating them one by one: %s" % (len(entries), reason.getErrorMessage()))
+        for interaction, uri, args, d in entries:
+            self._run_single(interaction, uri, args).chainDeferred(d)
+
+    def _run_single(self, interaction, uri, args):
+        self.storage.statistics['batch_fallbacks'] += 1
+        return repeat_on_error(10, UpdateFailed, self.storage.conn.runInteraction, interaction, uri, *args)
+
+
 class Storage(DBBase):
     __metaclass__ = Singleton
     implements(IStorage)
@@ -180,7 +285,42 @@ class Storage(DBBase):
                    "test-app"                               : 0}
 
     def _db_connect(self):
-        self.conn = storage_db_connection(Config.storage_db_uri)
+        if Config.storage_shard_uris:
+            # the storage database holds the shard map and the watchers tables
+            self.main_conn = connectionForURI(Config.storage_db_uri)
+            self.conn = ShardedConnectionPool(Config.storage_shard_uris, self.main_conn, Config.shard_map_table, Config.shard_map_ttl)
+            if Config.storage_read_db_uris:
+                log.warn("Read replicas are not supported together with shards, storage_read_db_uris is ignored")
+        else:
+            self.main_conn = self.conn = storage_db_connection(Config.storage_db_uri)
+        # SQLite databases have separate connections for reading, which always
+        # see the committed writes
+        self.primary_read_conn = getattr(self.conn, 'readers', self.conn)
+        if Config.storage_read_db_uris and not Config.storage_shard_uris:
+            self.read_conn = ReplicaPool(Config.storage_read_db_uris, Config.replica_max_lag, Config.replica_check_interval, stale_replica_read)
+        else:
+            self.read_conn = None
+        # users that wrote recently read from the primary to see their own writes
+        # for as long as a replica in service may lag behind the primary
+        self.read_after_write_delay = Config.replica_max_lag + Config.replica_check_interval
+        self._recent_writes = {}
+        self._recent_writes_queue = deque()
+        # write requests, transactions run for them (more than requests if they
+        # had to be repeated), queries executed by those transactions, the size
+        # of the written documents before and after compression and the write
+        # batches, writes run in them and writes repeated outside of them
+        self.statistics = dict(requests=0, transactions=0, queries=0, document_bytes=0, stored_bytes=0,
+                               batches=0, batched_writes=0, batch_fallbacks=0)
+        # writes of the same document made through this server wait for each
+        # other instead of racing in the database
+        self.write_locks = KeyedLock() if Config.serialize_writes else None
+        if not Config.write_batch_delay:
+            self.batcher = None
+        elif self.conn.schema == 'sqlite' or Config.storage_shard_uris:
+            log.warn("Write batching is not supported with SQLite databases or shards, write_batch_delay is ignored")
+            self.batcher = None
+        else:
+            self.batcher = WriteBatcher(self, Config.write_batch_delay / 1000.0, Config.write_batch_size)
 
     def _normalize_document_path(self, uri):
         if uri.application_id in ("pres-rules", "org.openmobilealliance.pres-rules"):
@@ -210,6 +350,9 @@ class Storage(DBBase):
             doc, etag = result[0]
             if isinstance(doc, unicode):
                 doc = doc.encode('utf-8')
+            else:
+                # this runs in a database thread, keeping decompression out of the reactor
+                doc = decode_document(doc)
             check_etag(etag)
             response = StatusResponse(200, etag, doc)
         else:
@@ -217,105 +360,153 @@ class Storage(DBBase):
         return response
 
     def _put_document(self, trans, uri, document, check_etag):
-        username, domain = uri.user.username, uri.user.domain
+        self.statistics['transactions'] += 1
         self._normalize_document_path(uri)
-        doc_type = self.app_mapping[uri.application_id]
-        document_path = uri.doc_selector.document_path
-        query = """SELECT etag FROM %(table)s
-                   WHERE username = %%(username)s AND domain = %%(domain)s
-                   AND doc_type= %%(doc_type)s AND doc_uri=%%(document_path)s""" % {
-            "table":    Config.xcap_table}
-        params = {"username": username,
-                  "domain"  : domain,
-                  "doc_type": doc_type,
-                  "document_path": document_path}
-        trans.execute(query, params)
-        result = trans.fetchall()
-        if len(result) > 1:
-            raise MultipleResultsError(params)
-        elif not result:
-            check_etag(None, False)
-            ## the document doesn't exist, create it
-            etag = make_random_etag(uri)
-            query = """INSERT INTO %(table)s (username, domain, doc_type, etag, doc, doc_uri)
- VALUES (%%(username)s, %%(domain)s, %%(doc_type)s, %%(etag)s, %%(document)s, %%(document_path)s)""" % {
-                "table":    Config.xcap_table }
-            params = {"username": username,
-                      "domain"  : domain,
-                      "doc_type": doc_type,
-                      "etag":     etag,
-                      "document": document,
-                      "document_path": document_path}
-            # may raise IntegrityError here, if the document was created in another connection
-            # will be catched by repeat_on_error
-            trans.execute(query, params)
-            return StatusResponse(201, etag)
+        etag = make_random_etag(uri)
+        if Config.compress_documents:
+            stored_document = encode_document(document, Config.compression_threshold, Config.compression_level)
+        else:
+            stored_document = document
+        self.statistics['document_bytes'] += len(document)
+        self.statistics['stored_bytes'] += len(stored_document)
+        if stored_document is not document:
+            stored_document = make_binary(self.conn.schema, stored_document)
+        params = {"username": uri.user.username,
+                  "domain"  : uri.user.domain,
+                  "doc_type": self.app_mapping[uri.application_id],
+                  "etag":     etag,
+                  "document": stored_document,
+                  "document_path": uri.doc_selector.document_path}
+        if self.conn.schema == 'mysql':
+            found, old_etag = self._upsert_document_mysql(trans, params)
+        elif self.conn.schema == 'sqlite':
+            found, old_etag = self._upsert_document_sqlite(trans, params)
         else:
-            old_etag = result[0][0]
-            ## first check the etag of the existing resource
+            found, old_etag = self._upsert_document_postgres(trans, params)
+        # the write is already done at this point; if the etag check fails it
+        # raises and the transaction is rolled back by runInteraction
+        if found:
             check_etag(old_etag)
-            ## the document exists, replace it
-            etag = make_random_etag(uri)
-            query = """UPDATE %(table)s
-                       SET doc = %%(document)s, etag = %%(etag)s
-                       WHERE username = %%(username)s AND domain = %%(domain)s
-                       AND doc_type = %%(doc_type)s AND etag = %%(old_etag)s
-                       AND doc_uri = %%(document_path)s""" % {
-                "table":    Config.xcap_table }
-            params = {"document": document,
-                      "etag":     etag,
-                      "username": username,
-                      "domain"  : domain,
-                      "doc_type": doc_type,
-                      "old_etag": old_etag,
-                      "document_path": document_path}
-            trans.execute(query, params)
-            # the request may not update anything (e.g. if etag was changed by another connection
-            # after we did SELECT); if so, we should retry
-            updated = getattr(trans._connection, 'affected_rows', lambda : 1)()
-            if not updated:
-                raise UpdateFailed
-            assert updated == 1, updated
             return StatusResponse(200, etag, old_etag=old_etag)
+        else:
+            check_etag(None, False)
+            return StatusResponse(201, etag)
 
-    def _delete_document(self, trans, uri, check_etag):
-        username, domain = uri.user.username, uri.user.domain
-        self._normalize_document_path(uri)
-        doc_type = self.app_mapping[uri.application_id]
-        document_path = uri.doc_selector.document_path
-        query = """SELECT etag FROM %(table)s
+    def _upsert_document_mysql(self, trans, params):
+        """Insert or replace a document with a single statement. The etag of the
+        replaced row is saved in a session variable by the UPDATE clause (the
+        assignments are evaluated left to right, so etag still holds the old
+        value when doc is assigned). Returns a (found, old_etag) tuple."""
+        query = """INSERT INTO %(table)s (username, domain, doc_type, etag, doc, doc_uri)
+                   VALUES (%%(username)s, %%(domain)s, %%(doc_type)s, %%(etag)s, %%(document)s, %%(document_path)s)
+                   ON DUPLICATE KEY UPDATE
+                   doc = IF((@old_etag := etag) IS NULL, VALUES(doc), VALUES(doc)),
+                   etag = VALUES(etag)""" % {
+            "table":    Config.xcap_table}
+        self._execute(trans, query, params)
+        # MySQL reports 1 affected row for an insert and 2 for an update
+        if trans.rowcount == 1:
+            return False, None
+        self._execute(trans, "SELECT @old_etag")
+        return True, trans.fetchall()[0][0]
+
+    def _upsert_document_postgres(self, trans, params):
+        """Replace a document with an UPDATE that returns the etag of the row it
+        replaced, or insert it if there was nothing to replace. If the document
+        is created by another connection between the 2 statements, the UPDATE
+        is repeated in the same transaction. Returns a (found, old_etag) tuple."""
+        update_query = """UPDATE %(table)s SET doc = %%(document)s, etag = %%(etag)s
+                          FROM (SELECT id, etag AS old_etag FROM %(table)s
+                                WHERE username = %%(username)s AND domain = %%(domain)s
+                                AND doc_type = %%(doc_type)s AND doc_uri = %%(document_path)s
+                                FOR UPDATE) AS old
+                          WHERE %(table)s.id = old.id
+                          RETURNING old.old_etag""" % {
+            "table":    Config.xcap_table}
+        insert_query = """INSERT INTO %(table)s (username, domain, doc_type, etag, doc, doc_uri)
+                          VALUES (%%(username)s, %%(domain)s, %%(doc_type)s, %%(etag)s, %%(document)s, %%(document_path)s)
+                          ON CONFLICT (username, domain, doc_type, doc_uri) DO NOTHING
+                          RETURNING id""" % {
+            "table":    Config.xcap_table}
+        for attempt in xrange(2):
+            self._execute(trans, update_query, params)
+            result = trans.fetchall()
+            if len(result) > 1:
+                raise MultipleResultsError(params)
+            elif result:
+                return True, result[0][0]
+            self._execute(trans, insert_query, params)
+            if trans.fetchall():
+                return False, None
+        raise UpdateFailed
+
+    def _upsert_document_sqlite(self, trans, params):
+        """Replace or insert a document. SQLite databases have a single writer
+        connection, so nothing can change between the 2 statements. Returns a
+        (found, old_etag) tuple."""
+        query = """SELECT id, etag FROM %(table)s
                    WHERE username = %%(username)s AND domain = %%(domain)s
-                   AND doc_type= %%(doc_type)s AND doc_uri = %%(document_path)s""" % {
+                   AND doc_type = %%(doc_type)s AND doc_uri = %%(document_path)s""" % {
             "table":    Config.xcap_table}
-        params = {"username": username,
-                  "domain"  : domain,
-                  "doc_type": doc_type,
-                  "document_path": document_path}
-        trans.execute(query, params)
+        self._execute(trans, query, params)
         result = trans.fetchall()
-        if len(result)>1:
+        if len(result) > 1:
             raise MultipleResultsError(params)
         elif result:
-            etag = result[0][0]
-            check_etag(etag)
-            query = """DELETE FROM %(table)s
+            params["id"], old_etag = result[0]
+            query = """UPDATE %(table)s SET doc = %%(document)s, etag = %%(etag)s WHERE id = %%(id)s""" % {
+                "table":    Config.xcap_table}
+            self._execute(trans, query, params)
+            return True, old_etag
+        query = """INSERT INTO %(table)s (username, domain, doc_type, etag, doc, doc_uri)
+                   VALUES (%%(username)s, %%(domain)s, %%(doc_type)s, %%(etag)s, %%(document)s, %%(document_path)s)""" % {
+            "table":    Config.xcap_table}
+        self._execute(trans, query, params)
+        return False, None
+
+    def _delete_document(self, trans, uri, check_etag):
+        self.statistics['transactions'] += 1
+        self._normalize_document_path(uri)
+        params = {"username": uri.user.username,
+                  "domain"  : uri.user.domain,
+                  "doc_type": self.app_mapping[uri.application_id],
+                  "document_path": uri.doc_selector.document_path}
+        if self.conn.schema in ('mysql', 'sqlite'):
+            # MySQL has no DELETE ... RETURNING, lock the row while checking its
+            # etag (SQLite has a single writer connection, so it's not needed)
+            query = """SELECT id, etag FROM %(table)s
                        WHERE username = %%(username)s AND domain = %%(domain)s
-                       AND doc_type= %%(doc_type)s AND doc_uri = %%(document_path)s
-                       AND etag = %%(etag)s""" % {"table" : Config.xcap_table}
-            params = {"username": username,
-                      "domain"  : domain,
-                      "doc_type": doc_type,
-                      "document_path": document_path,
-                      "etag": etag}
-            trans.execute(query, params)
-            deleted = getattr(trans._connection, 'affected_rows', lambda : 1)()
-            if not deleted:
-                # the document was replaced/removed after the SELECT but before the DELETE
-                raise DeleteFailed
-            assert deleted == 1, deleted
-            return StatusResponse(200, old_etag=etag)
+                       AND doc_type = %%(doc_type)s AND doc_uri = %%(document_path)s""" % {"table": Config.xcap_table}
+            if self.conn.schema == 'mysql':
+                query += " FOR UPDATE"
+            self._execute(trans, query, params)
+            result = trans.fetchall()
+            if len(result) > 1:
+                raise MultipleResultsError(params)
+            elif result:
+                params["id"], etag = result[0]
+                query = """DELETE FROM %(table)s WHERE id = %%(id)s""" % {"table": Config.xcap_table}
+                self._execute(trans, query, params)
         else:
+            query = """DELETE FROM %(table)s
+                       WHERE username = %%(username)s AND domain = %%(domain)s
+                       AND doc_type = %%(doc_type)s AND doc_uri = %%(document_path)s
+                       RETURNING etag""" % {"table": Config.xcap_table}
+            self._execute(trans, query, params)
+            result = trans.fetchall()
+            if len(result) > 1:
+                raise MultipleResultsError(params)
+            elif result:
+                etag = result[0][0]
+        if not result:
             return StatusResponse(404)
+        # as with PUT, a failed check rolls back the DELETE
+        check_etag(etag)
+        return StatusResponse(200, old_etag=etag)
+
+    def _execute(self, trans, query, params=None):
+        self.statistics['queries'] += 1
+        trans.execute(query, params)
 
     def _delete_all_documents(self, trans, uri):
         username, domain = uri.user.username, uri.user.domain
@@ -327,17 +518,54 @@ class Storage(DBBase):
         trans.execute(query, params)
         return StatusResponse(200)
 
+    def _run_read(self, uri, interaction, *args):
+        """Run a read-only interaction on a read replica if there are any and the
+        user didn't write recently, otherwise on the primary database."""
+        if self.read_conn is None or self._written_recently(uri):
+            return self.primary_read_conn.runInteraction(interaction, uri, *args)
+        return self.read_conn.runInteraction(self.conn, interaction, uri, *args)
+
+    def _record_write(self, uri):
+        if self.read_conn is None:
+            return
+        now = time.time()
+        key = (uri.user.username, uri.user.domain)
+        self._recent_writes[key] = now
+        self._recent_writes_queue.append((now, key))
+        queue, limit = self._recent_writes_queue, now - self.read_after_write_delay
+        while queue and queue[0][0] < limit:
+            timestamp, key = queue.popleft()
+            if self._recent_writes.get(key) == timestamp:
+                del self._recent_writes[key]
+
+    def _written_recently(self, uri):
+        timestamp = self._recent_writes.get((uri.user.username, uri.user.domain), None)
+        return timestamp is not None and time.time() - timestamp < self.read_after_write_delay
+
     def get_document(self, uri, check_etag):
-        return self.conn.runInteraction(self._get_document, uri, check_etag)
+        return self._run_read(uri, self._get_document, check_etag)
+
+    def _run_write(self, interaction, uri, *args):
+        self.statistics['requests'] += 1
+        self._record_write(uri)
+        if self.batcher is not None:
+            run, run_args = self.batcher.run, (interaction, uri) + args
+        else:
+            run, run_args = repeat_on_error, (10, UpdateFailed, self.conn.runInteraction, interaction, uri) + args
+        if self.write_locks is None:
+            return run(*run_args)
+        self._normalize_document_path(uri)
+        key = (uri.user.username, uri.user.domain, self.app_mapping[uri.application_id], uri.doc_selector.document_path)
+        return self.write_locks.run(key, run, *run_args)
 
     def put_document(self, uri, document, check_etag):
-        return repeat_on_error(10, (UpdateFailed, IntegrityError),
-                               self.conn.runInteraction, self._put_document, uri, document, check_etag)
+        return self._run_write(self._put_document, uri, document, check_etag)
 
     def delete_document(self, uri, check_etag):
-        return repeat_on_error(10, DeleteFailed, self.conn.runInteraction, self._delete_document, uri, check_etag)
+        return self._run_write(self._delete_document, uri, check_etag)
 
     def delete_documents(self, uri, check_etag):
+        self._record_write(uri)
         return self.conn.runInteraction(self._delete_all_documents, uri)
 
     # Application-specific functions
@@ -346,26 +574,22 @@ class Storage(DBBase):
                           2: "confirm",
                           3: "deny"}
         presentity_uri = "sip:%s@%s" % (uri.user.username, uri.user.domain)
-        query = """SELECT watcher_username, watcher_domain, status FROM watchers
-                   WHERE presentity_uri = %(puri)s"""
-        params = {'puri': presentity_uri}
-        trans.execute(query, params)
-        result = trans.fetchall()
-        watchers = [{"id": "%s@%s" % (w_user, w_domain),
-                     "status": status_mapping.get(subs_status, "unknown"),
-                     "online": "false"} for w_user, w_domain, subs_status in result]
-        query = """SELECT watcher_username, watcher_domain FROM active_watchers
-                   WHERE presentity_uri = %(puri)s AND event = 'presence'"""
-        trans.execute(query, params)
-        result = trans.fetchall()
-        active_watchers = set("%s@%s" % pair for pair in result)
-        for watcher in watchers:
-            if watcher["id"] in active_watchers:
-                watcher["online"] = "true"
-        return watchers
+        # a watcher is online if it has an active presence subscription, which
+        # is looked up using the (presentity_uri, event) index of active_watchers
+        query = """SELECT w.watcher_username, w.watcher_domain, w.status,
+                          EXISTS (SELECT 1 FROM active_watchers a
+                                  WHERE a.presentity_uri = w.presentity_uri AND a.event = 'presence'
+                                  AND a.watcher_username = w.watcher_username AND a.watcher_domain = w.watcher_domain)
+                   FROM watchers w WHERE w.presentity_uri = %(puri)s"""
+        trans.execute(query, {'puri': presentity_uri})
+        return [{"id": "%s@%s" % (w_user, w_domain),
+                 "status": status_mapping.get(subs_status, "unknown"),
+                 "online": online and "true" or "false"} for w_user, w_domain, subs_status, online in trans.fetchall()]
 
     def get_watchers(self, uri):
-        return self.conn.runInteraction(self._get_watchers, uri)
+        if self.main_conn is not self.conn:
+            return self.main_conn.runInteraction(self._get_watchers, uri)
+        return self._run_read(uri, self._get_watchers)
 
     def _get_documents_list(self, trans, uri):
         query = """SELECT doc_type, doc_uri, etag FROM %(table)s
@@ -383,14 +607,15 @@ class Storage(DBBase):
         return docs
 
     def get_documents_list(self, uri):
-        return self.conn.runInteraction(self._get_documents_list, uri)
+        return self._run_read(uri, self._get_documents_list)
 
 
 installSignalHandlers = True
 
 def auth_db_connection(uri):
     conn = connectionForURI(uri)
-    return conn
+    # the password checkers only read, keep them off the SQLite writer connection
+    return getattr(conn, 'readers', conn)
 
 def storage_db_connection(uri):
     conn = connectionForURI(uri)
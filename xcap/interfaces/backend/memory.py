@@ -0,0 +1,271 @@
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Implementation of an in-memory backend.
+
+The documents are kept in dictionaries in the server process, so this backend
+measures the overhead of the rest of the server without any database latency
+and can hold ephemeral documents. The subscribers are read from a file with
+one "username@domain password" entry per line. The documents and watchers can
+optionally be saved to a snapshot file, periodically and when the server stops,
+and are reloaded from it when the server starts.
+"""
+
+import os
+import cPickle as pickle
+from hashlib import md5
+
+from application import log
+from application.configuration import ConfigSection
+from application.python.types import Singleton
+
+from zope.interface import implements
+from twisted.cred import credentials, checkers, error as credError
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+import xcap
+from xcap.cache import get_watchers_cache
+from xcap.interfaces.backend import IStorage, StatusResponse
+from xcap.dbutil import make_random_etag
+
+
+class Config(ConfigSection):
+    __cfgfile__ = xcap.__cfgfile__
+    __section__ = 'Memory'
+
+    users_file = ''
+    snapshot_file = ''
+    snapshot_interval = 0
+
+
+class UserRecord(object):
+    """The documents of a user, as {(application id, document path): (etag, document)},
+    and the watchers of the user as a list of dictionaries like the ones
+    returned by get_watchers."""
+
+    __slots__ = ('documents', 'watchers')
+
+    def __init__(self, documents=None, watchers=None):
+        self.documents = documents or {}
+        self.watchers = watchers or []
+
+    def __getstate__(self):
+        return (self.documents, self.watchers)
+
+    def __setstate__(self, state):
+        self.documents, self.watchers = state
+
+
+class Subscribers(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self.passwords = {}
+        if Config.users_file:
+            self.load(Config.users_file)
+
+    def load(self, filename):
+        passwords = {}
+        for line in open(filename):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                user, password = line.split(None, 1)
+                username, domain = user.split('@', 1)
+            except ValueError:
+                log.error("Ignoring invalid line in %s: %s" % (filename, line))
+                continue
+            passwords[(username, domain)] = password
+        self.passwords = passwords
+
+
+class PasswordChecker(object):
+    """A credentials checker against the subscribers read from Memory.users_file."""
+
+    implements(checkers.ICredentialsChecker)
+
+    credentialInterfaces = (credentials.IUsernamePassword,
+        credentials.IUsernameHashedPassword)
+
+    def __init__(self):
+        self.subscribers = Subscribers()
+
+    def _get_secret(self, username, domain, password):
+        raise NotImplementedError
+
+    def _authenticate_credentials(self, secret, credentials):
+        raise NotImplementedError
+
+    def _checkedPassword(self, matched, username, realm):
+        if matched:
+            username = username.split('@', 1)[0]
+            ## this is the avatar ID
+            return "%s@%s" % (username, realm)
+        else:
+            raise credError.UnauthorizedLogin("Unauthorized login")
+
+    def requestAvatarId(self, credentials):
+        """Return the avatar ID for the credentials which must have the username
+           and realm attributes, or an UnauthorizedLogin in case of a failure."""
+        username, domain = credentials.username.split('@', 1)[0], credentials.realm
+        password = self.subscribers.passwords.get((username, domain), None)
+        if password is None:
+            return defer.fail(credError.UnauthorizedLogin("Unauthorized login"))
+        return self._authenticate_credentials(self._get_secret(username, domain, password), credentials)
+
+
+class PlainPasswordChecker(PasswordChecker):
+    """A credentials checker against the subscribers file, using plain text passwords."""
+
+    implements(checkers.ICredentialsChecker)
+
+    def _get_secret(self, username, domain, password):
+        return password
+
+    def _authenticate_credentials(self, password, credentials):
+        return defer.maybeDeferred(
+                credentials.checkPassword, password).addCallback(
+                self._checkedPassword, credentials.username, credentials.realm)
+
+
+class HashPasswordChecker(PasswordChecker):
+    """A credentials checker against the subscribers file, using MD5 hashes of
+       the passwords."""
+
+    implements(checkers.ICredentialsChecker)
+
+    def _get_secret(self, username, domain, password):
+        return md5("%s:%s:%s" % (username, domain, password)).hexdigest()
+
+    def _authenticate_credentials(self, hash, credentials):
+        return defer.maybeDeferred(
+                credentials.checkHash, hash).addCallback(
+                self._checkedPassword, credentials.username, credentials.realm)
+
+
+class Storage(object):
+    __metaclass__ = Singleton
+    implements(IStorage)
+
+    def __init__(self):
+        # (username, domain) -> UserRecord
+        self.users = {}
+        self.statistics = dict(requests=0)
+        if Config.snapshot_file:
+            if os.path.exists(Config.snapshot_file):
+                self.load_snapshot(Config.snapshot_file)
+            if Config.snapshot_interval:
+                self._snapshot_timer = LoopingCall(self.save_snapshot, Config.snapshot_file)
+                self._snapshot_timer.start(Config.snapshot_interval, now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.save_snapshot, Config.snapshot_file)
+
+    def load_snapshot(self, filename):
+        f = open(filename, 'rb')
+        try:
+            self.users = pickle.load(f)
+        finally:
+            f.close()
+        log.msg("Loaded the documents of %d users from %s" % (len(self.users), filename))
+
+    def save_snapshot(self, filename):
+        """Write the documents to a temporary file which then replaces the snapshot"""
+        tmp_filename = filename + '.tmp'
+        try:
+            f = open(tmp_filename, 'wb')
+            try:
+                pickle.dump(self.users, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError), e:
+            log.error("Cannot save the snapshot to %s: %s" % (filename, e))
+
+    def _document_key(self, uri):
+        application_id = uri.application_id
+        if application_id in ("pres-rules", "org.openmobilealliance.pres-rules"):
+            # the presence rules are saved as a single index.xml document for both
+            # AUIDs, like the database backend does
+            return ("pres-rules", "index.xml")
+        return (application_id, uri.doc_selector.document_path)
+
+    def _get_document(self, uri, check_etag):
+        record = self.users.get((uri.user.username, uri.user.domain), None)
+        document = record and record.documents.get(self._document_key(uri), None)
+        if document is None:
+            return StatusResponse(404)
+        etag, data = document
+        check_etag(etag)
+        return StatusResponse(200, etag, data)
+
+    def _put_document(self, uri, document, check_etag):
+        user = (uri.user.username, uri.user.domain)
+        key = self._document_key(uri)
+        record = self.users.get(user, None)
+        old_document = record and record.documents.get(key, None)
+        if old_document is None:
+            check_etag(None, False)
+        else:
+            check_etag(old_document[0])
+        if record is None:
+            record = self.users[user] = UserRecord()
+        etag = make_random_etag(uri)
+        record.documents[key] = (etag, document)
+        if old_document is None:
+            return StatusResponse(201, etag)
+        return StatusResponse(200, etag, old_etag=old_document[0])
+
+    def _delete_document(self, uri, check_etag):
+        user = (uri.user.username, uri.user.domain)
+        key = self._document_key(uri)
+        record = self.users.get(user, None)
+        old_document = record and record.documents.get(key, None)
+        if old_document is None:
+            return StatusResponse(404)
+        check_etag(old_document[0])
+        del record.documents[key]
+        if not record.documents and not record.watchers:
+            del self.users[user]
+        return StatusResponse(200, old_etag=old_document[0])
+
+    def get_document(self, uri, check_etag):
+        return defer.maybeDeferred(self._get_document, uri, check_etag)
+
+    def put_document(self, uri, document, check_etag):
+        self.statistics['requests'] += 1
+        return defer.maybeDeferred(self._put_document, uri, document, check_etag)
+
+    def delete_document(self, uri, check_etag):
+        self.statistics['requests'] += 1
+        return defer.maybeDeferred(self._delete_document, uri, check_etag)
+
+    def delete_documents(self, uri, check_etag=None):
+        record = self.users.get((uri.user.username, uri.user.domain), None)
+        if record is not None:
+            record.documents.clear()
+        return defer.succeed(StatusResponse(200))
+
+    def get_watchers(self, uri):
+        record = self.users.get((uri.user.username, uri.user.domain), None)
+        return defer.succeed(record and [dict(watcher) for watcher in record.watchers] or [])
+
+    def set_watchers(self, username, domain, watchers):
+        """Set the watchers of a user, as a list of dictionaries with the id, status
+        and online keys (used for testing, there is no presence server to provide them)"""
+        record = self.users.setdefault((username, domain), UserRecord())
+        record.watchers = list(watchers)
+        cache = get_watchers_cache()
+        if cache is not None:
+            cache.invalidate(username, domain)
+
+    def get_documents_list(self, uri):
+        record = self.users.get((uri.user.username, uri.user.domain), None)
+        docs = {}
+        if record is not None:
+            for (application_id, document_path), (etag, document) in record.documents.iteritems():
+                docs.setdefault(application_id, []).append((document_path, etag))
+        return defer.succeed(docs)
+
+
+installSignalHandlers = True
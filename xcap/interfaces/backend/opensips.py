@@ -9,6 +9,7 @@ from application import log
 from application.configuration import ConfigSection, ConfigSetting
 
 import xcap
+from xcap.cache import get_watchers_cache
 from xcap.datatypes import XCAPRootURI
 from xcap.interfaces.backend import database
 from xcap.interfaces.opensips import ManagementInterface
@@ -33,6 +34,11 @@ if Config.xmlrpc_url is None:
     log.fatal("the OpenSIPS.xmlrpc_url option is not set")
     sys.exit(1)
 
+if database.Config.compress_documents:
+    # OpenSIPS reads the documents from the xcap table itself
+    log.fatal("Database.compress_documents cannot be used with the OpenSIPS backend")
+    sys.exit(1)
+
 class PlainPasswordChecker(database.PlainPasswordChecker): pass
 class HashPasswordChecker(database.HashPasswordChecker): pass
 
@@ -41,6 +47,7 @@ class BaseStorage(database.Storage):
     def __init__(self):
         database.Storage.__init__(self)
         self._mi = ManagementInterface(Config.xmlrpc_url)
+        self._watchers_cache = get_watchers_cache()
 
     def _notify_watchers(self, response, user_id, event, type):
         def _eb_mi(f):
@@ -51,13 +58,27 @@ class BaseStorage(database.Storage):
         d.addErrback(_eb_mi)
         return d
 
+    def _invalidate_watchers(self, response, user_id):
+        # OpenSIPS updated the status of the watchers according to the new rules
+        if self._watchers_cache is not None:
+            self._watchers_cache.invalidate(user_id.username, user_id.domain)
+        return response
+
     def put_document(self, uri, document, check_etag):
         application_id = uri.application_id
-        d = self.conn.runInteraction(super(BaseStorage, self)._put_document, uri, document, check_etag)
+        d = super(BaseStorage, self).put_document(uri, document, check_etag)
         if application_id in ('pres-rules', 'org.openmobilealliance.pres-rules', 'pidf-manipulation', 'org.openxcap.dialog-rules', 'resource-lists', 'rls-services'):
             type = 1 if application_id == 'pidf-manipulation' else 0
             event = 'dialog' if application_id == 'org.openxcap.dialog-rules' else 'presence'
             d.addCallback(self._notify_watchers, uri.user, event, type)
+        if application_id in ('pres-rules', 'org.openmobilealliance.pres-rules'):
+            d.addCallback(self._invalidate_watchers, uri.user)
+        return d
+
+    def delete_document(self, uri, check_etag):
+        d = super(BaseStorage, self).delete_document(uri, check_etag)
+        if uri.application_id in ('pres-rules', 'org.openmobilealliance.pres-rules'):
+            d.addCallback(self._invalidate_watchers, uri.user)
         return d
 
 class NotifyingStorage(BaseStorage):
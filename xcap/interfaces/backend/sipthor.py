@@ -6,6 +6,8 @@
 
 import re
 import signal
+import threading
+import time
 
 import cjson
 
@@ -21,13 +23,16 @@ from application.configuration import ConfigSection, ConfigSetting
 from application.configuration.datatypes import IPAddress
 
 from sqlobject import sqlhub, connectionForURI, SQLObject, AND
-from sqlobject import StringCol, IntCol, DateTimeCol, SOBLOBCol, Col
-from sqlobject import MultipleJoin, ForeignKey
+from sqlobject import StringCol, IntCol, DateTimeCol, SOBLOBCol, BLOBCol, Col
+from sqlobject import MultipleJoin, ForeignKey, DatabaseIndex
+from sqlobject.dberrors import DuplicateEntryError
+from sqlobject.sqlbuilder import Select
 
 from zope.interface import implements
 from twisted.internet import reactor
 from twisted.internet import defer
 from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.threadpool import ThreadPool
 from twisted.cred.checkers import ICredentialsChecker
 from twisted.cred.credentials import IUsernamePassword, IUsernameHashedPassword
 from twisted.cred.error import UnauthorizedLogin
@@ -44,6 +49,7 @@ from sipsimple.threading import run_in_twisted_thread
 
 import xcap
 from xcap.tls import Certificate, PrivateKey
+from xcap.cache import LRUCache, get_credentials_cache, get_watchers_cache
 from xcap.interfaces.backend import StatusResponse
 from xcap.datatypes import XCAPRootURI
 from xcap.dbutil import make_random_etag
@@ -59,6 +65,8 @@ class ThorNodeConfig(ConfigSection):
     certificate = ConfigSetting(type=Certificate, value=None)
     private_key = ConfigSetting(type=PrivateKey, value=None)
     ca = ConfigSetting(type=Certificate, value=None)
+    lookup_cache_size = 10000
+    notification_delay = 0.2
 
 
 class ServerConfig(ConfigSection):
@@ -69,6 +77,17 @@ class ServerConfig(ConfigSection):
     root = ConfigSetting(type=XCAPRootURI, value=None)
 
 
+class ThorDatabaseConfig(ConfigSection):
+    __cfgfile__ = xcap.__cfgfile__
+    __section__ = 'ThorDatabase'
+
+    use_documents_table = False
+    migrate_profile_documents = False
+    read_threads = 10
+    write_threads = 10
+    max_queued_operations = 1000
+
+
 class JSONValidator(validators.Validator):
 
     def to_python(self, value, state):
@@ -138,6 +157,51 @@ class SipAccountData(SQLObject):
     profile  = JSONCol()
 
 
+class SipAccountDocument(SQLObject):
+    class sqlmeta:
+        table = 'sip_accounts_xcap'
+    account      = ForeignKey('SipAccount', cascade=True)
+    application  = StringCol(length=64)
+    documentPath = StringCol(length=128)
+    etag         = StringCol(length=64)
+    document     = BLOBCol(length=2**24-1)
+    ## indexes
+    documentIndex = DatabaseIndex('account', 'application', 'documentPath', unique=True)
+
+
+def migrate_profile_documents(connection, account_id):
+    """Move the documents of an account from its profile to the documents table,
+    except for the ones already in the table, and return how many were moved.
+    The account row is locked while the documents are moved."""
+    transaction = connection.transaction()
+    try:
+        try:
+            db_account = SipAccount.select(SipAccount.q.id == account_id, connection=transaction, forUpdate=True)[0]
+        except IndexError:
+            raise NotFound()
+        profile = db_account.profile
+        xcap_docs = profile.pop("xcap", None)
+        count = 0
+        if xcap_docs is not None:
+            for application_id, documents in xcap_docs.iteritems():
+                for document_path, (document, etag) in documents.iteritems():
+                    clause = AND(SipAccountDocument.q.accountID == account_id, SipAccountDocument.q.application == application_id,
+                                 SipAccountDocument.q.documentPath == document_path)
+                    if SipAccountDocument.select(clause, connection=transaction).count():
+                        continue
+                    SipAccountDocument(accountID=account_id, application=application_id, documentPath=document_path,
+                                       etag=etag, document=document.encode('utf-8'), connection=transaction)
+                    count += 1
+            db_account.profile = profile
+        transaction.commit(close=True)
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        transaction.cache.clear()
+    return count
+
+
 def sanitize_application_id(application_id):
     if application_id == "org.openmobilealliance.pres-rules":
         return "pres-rules"
@@ -174,16 +238,28 @@ class XCAPProvisioning(EventServiceClient):
         credentials.verify_peer = True
         credentials.session_params.compressions = (COMP_LZO, COMP_DEFLATE, COMP_NULL)
         self.control = ControlLink(credentials)
+        # the sip_proxy node of every account, cleared when the sip_proxy nodes change
+        self._lookup_cache = LRUCache(ThorNodeConfig.lookup_cache_size)
+        # the notifications waiting to be sent, mapped to their account
+        self._pending_notifications = {}
+        self._notification_timer = None
+        self.statistics = dict(notifications=0, coalesced_notifications=0)
         EventServiceClient.__init__(self, ThorNodeConfig.domain, credentials)
         process.signals.add_handler(signal.SIGHUP, self._handle_SIGHUP)
         process.signals.add_handler(signal.SIGINT, self._handle_SIGINT)
         process.signals.add_handler(signal.SIGTERM, self._handle_SIGTERM)
 
     def _disconnect_all(self, result):
+        if self._notification_timer is not None:
+            self._notification_timer.cancel()
+            self._send_notifications()
         self.control.disconnect_all()
         EventServiceClient._disconnect_all(self, result)
 
     def lookup(self, key):
+        node = self._lookup_cache.get(key, None)
+        if node is not None:
+            return node
         network = self.networks.get("sip_proxy", None)
         if network is None:
             return None
@@ -194,15 +270,38 @@ class XCAPProvisioning(EventServiceClient):
         except Exception:
             log.err()
             node = None
+        if node is not None:
+            self._lookup_cache.set(key, node)
         return node
 
     def notify(self, operation, entity_type, entity):
+        """Notify the node responsible for entity. The same notification sent
+        several times within notification_delay seconds is sent only once."""
+        command = "notify %s %s %s" % (operation, entity_type, entity)
+        self.statistics['notifications'] += 1
+        if not ThorNodeConfig.notification_delay:
+            self._send_notification(command, entity)
+        elif command in self._pending_notifications:
+            self.statistics['coalesced_notifications'] += 1
+        else:
+            self._pending_notifications[command] = entity
+            if self._notification_timer is None:
+                self._notification_timer = reactor.callLater(ThorNodeConfig.notification_delay, self._send_notifications)
+
+    def _send_notifications(self):
+        self._notification_timer = None
+        notifications, self._pending_notifications = self._pending_notifications, {}
+        for command, entity in notifications.iteritems():
+            self._send_notification(command, entity)
+
+    def _send_notification(self, command, entity):
+        # the node is looked up when sending, in case the nodes changed meanwhile
         node = self.lookup(entity)
         if node is not None:
             if node.control_port is None:
                 log.error("Could not send notify because node %s has no control port" % node.ip)
                 return
-            self.control.send_request(Notification("notify %s %s %s" % (operation, entity_type, entity)), (node.ip, node.control_port))
+            self.control.send_request(Notification(command), (node.ip, node.control_port))
 
     def get_watchers(self, key):
         node = self.lookup(key)
@@ -242,6 +341,8 @@ class XCAPProvisioning(EventServiceClient):
             ## compute set differences
             added_nodes = new_nodes - old_nodes
             removed_nodes = old_nodes - new_nodes
+            if role == "sip_proxy" and (added_nodes or removed_nodes):
+                self._lookup_cache.clear()
             if removed_nodes:
                 for node in removed_nodes:
                     network.remove_node(node)
@@ -264,47 +365,127 @@ class NoDatabase(Exception):
     pass
 
 
+class ProfileDocumentsFound(Exception):
+    """The documents of the account are still in its profile"""
+
+    def __init__(self, account_id):
+        Exception.__init__(self, account_id)
+        self.account_id = account_id
+
+
+class ServerBusy(Exception):
+    """Too many database operations are waiting for a thread"""
+    http_error = 503
+
+
+class OperationPool(object):
+    """A pool of threads running database operations. At most max_queued
+    operations can wait for a thread (0 means no limit), the ones submitted
+    after that fail with ServerBusy. The statistics count the operations,
+    the rejected ones and the time they waited for a thread."""
+
+    def __init__(self, name, threads, max_queued=0):
+        self.name = name
+        self.max_queued = max_queued
+        self.queued = 0
+        self.statistics = dict(operations=0, rejected=0, max_queued=0, wait_time=0.0, max_wait_time=0.0)
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(minthreads=threads, maxthreads=threads, name=name)
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    @property
+    def average_wait_time(self):
+        operations = self.statistics['operations']
+        return operations and self.statistics['wait_time'] / operations or 0.0
+
+    def run(self, function, *args):
+        """Call function(*args) in a thread of the pool"""
+        self._lock.acquire()
+        try:
+            if self.max_queued and self.queued >= self.max_queued:
+                self.statistics['rejected'] += 1
+                raise ServerBusy("%d %s operations are waiting for a thread" % (self.queued, self.name))
+            self.queued += 1
+            self.statistics['max_queued'] = max(self.statistics['max_queued'], self.queued)
+        finally:
+            self._lock.release()
+        self._pool.callInThread(self._run, time.time(), function, args)
+
+    def _run(self, submitted, function, args):
+        wait_time = time.time() - submitted
+        self._lock.acquire()
+        try:
+            self.queued -= 1
+            self.statistics['operations'] += 1
+            self.statistics['wait_time'] += wait_time
+            self.statistics['max_wait_time'] = max(self.statistics['max_wait_time'], wait_time)
+        finally:
+            self._lock.release()
+        function(*args)
+
+
 class DatabaseConnection(object):
     __metaclass__ = Singleton
 
     def __init__(self):
         self.dburi = None
+        # the accounts whose profiles are known to hold no documents anymore
+        self.migrated_accounts = set()
+        # the reads are not held up by writes waiting for locked profiles
+        self.readers = OperationPool('read', ThorDatabaseConfig.read_threads, ThorDatabaseConfig.max_queued_operations)
+        self.writers = OperationPool('write', ThorDatabaseConfig.write_threads, ThorDatabaseConfig.max_queued_operations)
+
+    @property
+    def statistics(self):
+        return {'read': dict(self.readers.statistics, queued=self.readers.queued),
+                'write': dict(self.writers.statistics, queued=self.writers.queued)}
 
     # Methods to be called from the Twisted thread:
-    def put(self, uri, document, check_etag, new_etag):
+    def _run_in_pool(self, pool, function, *args):
+        """Call function(*args, defer) in a thread of the pool and return the deferred"""
         defer = Deferred()
-        operation = lambda profile: self._put_operation(uri, document, check_etag, new_etag, profile)
-        reactor.callInThread(self.retrieve_profile, uri.user.username, uri.user.domain, operation, True, defer)
+        try:
+            pool.run(function, *(args + (defer,)))
+        except ServerBusy, e:
+            defer.errback(e)
         return defer
 
+    def _run_transaction(self, pool, operation, *args):
+        return self._run_in_pool(pool, self.run_transaction, lambda transaction: operation(transaction, *args))
+
+    def put(self, uri, document, check_etag, new_etag):
+        if ThorDatabaseConfig.use_documents_table:
+            return self._run_transaction(self.writers, self._put_document, uri, document, check_etag, new_etag)
+        operation = lambda profile: self._put_operation(uri, document, check_etag, new_etag, profile)
+        return self._run_in_pool(self.writers, self.retrieve_profile, uri.user.username, uri.user.domain, operation, True)
+
     def delete(self, uri, check_etag):
-        defer = Deferred()
+        if ThorDatabaseConfig.use_documents_table:
+            return self._run_transaction(self.writers, self._delete_document, uri, check_etag)
         operation = lambda profile: self._delete_operation(uri, check_etag, profile)
-        reactor.callInThread(self.retrieve_profile, uri.user.username, uri.user.domain, operation, True, defer)
-        return defer
+        return self._run_in_pool(self.writers, self.retrieve_profile, uri.user.username, uri.user.domain, operation, True)
 
     def delete_all(self, uri):
-        defer = Deferred()
+        if ThorDatabaseConfig.use_documents_table:
+            return self._run_transaction(self.writers, self._delete_all_documents, uri)
         operation = lambda profile: self._delete_all_operation(uri, profile)
-        reactor.callInThread(self.retrieve_profile, uri.user.username, uri.user.domain, operation, True, defer)
-        return defer
+        return self._run_in_pool(self.writers, self.retrieve_profile, uri.user.username, uri.user.domain, operation, True)
 
     def get(self, uri):
-        defer = Deferred()
+        if ThorDatabaseConfig.use_documents_table:
+            return self._run_transaction(self.readers, self._get_document, uri)
         operation = lambda profile: self._get_operation(uri, profile)
-        reactor.callInThread(self.retrieve_profile, uri.user.username, uri.user.domain, operation, False, defer)
-        return defer
+        return self._run_in_pool(self.readers, self.retrieve_profile, uri.user.username, uri.user.domain, operation, False)
 
     def get_profile(self, username, domain):
-        defer = Deferred()
-        reactor.callInThread(self.retrieve_profile, username, domain, lambda profile: profile, False, defer)
-        return defer
+        return self._run_in_pool(self.readers, self.retrieve_profile, username, domain, lambda profile: profile, False)
 
     def get_documents_list(self, uri):
-        defer = Deferred()
+        if ThorDatabaseConfig.use_documents_table:
+            return self._run_transaction(self.readers, self._get_documents_list, uri)
         operation = lambda profile: self._get_documents_list_operation(uri, profile)
-        reactor.callInThread(self.retrieve_profile, uri.user.username, uri.user.domain, operation, False, defer)
-        return defer
+        return self._run_in_pool(self.readers, self.retrieve_profile, uri.user.username, uri.user.domain, operation, False)
 
 
     # Methods to be called in a separate thread:
@@ -380,6 +561,123 @@ class DatabaseConnection(object):
             if transaction:
                 transaction.cache.clear()
 
+    # Methods using the documents table, to be called in a separate thread.
+    # The documents are read without locking anything and only the row of the
+    # document being changed is locked when writing.
+    def run_transaction(self, operation, defer):
+        attempts = 3
+        transaction = None
+        try:
+            if self.dburi is None:
+                raise NoDatabase()
+            while True:
+                attempts -= 1
+                transaction = sqlhub.processConnection.transaction()
+                try:
+                    result = operation(transaction)
+                    transaction.commit(close=True)
+                except (ProfileDocumentsFound, DuplicateEntryError), e:
+                    # the documents must be migrated first or the document was
+                    # inserted meanwhile, either way the operation is run again
+                    transaction.rollback()
+                    if not attempts:
+                        raise
+                    if isinstance(e, ProfileDocumentsFound):
+                        migrate_profile_documents(sqlhub.processConnection, e.account_id)
+                        self.migrated_accounts.add(e.account_id)
+                else:
+                    break
+                transaction.cache.clear()
+                transaction = None
+        except Exception, e:
+            if transaction:
+                transaction.rollback()
+            reactor.callFromThread(defer.errback, e)
+        else:
+            reactor.callFromThread(defer.callback, result)
+        finally:
+            if transaction:
+                transaction.cache.clear()
+
+    def _account_id(self, transaction, uri):
+        query = Select(SipAccount.q.id, where=AND(SipAccount.q.username == uri.user.username, SipAccount.q.domain == uri.user.domain))
+        rows = transaction.queryAll(transaction.sqlrepr(query))
+        if not rows:
+            raise NotFound()
+        return rows[0][0]
+
+    def _check_profile_documents(self, transaction, account_id):
+        """Called when the documents table has no documents for the operation,
+        which may be because they were not migrated from the profile yet. The
+        profiles of an account are only read until they are found to have no
+        documents, as parsing them on every miss is expensive."""
+        if not ThorDatabaseConfig.migrate_profile_documents or account_id in self.migrated_accounts:
+            return
+        for data in SipAccountData.select(SipAccountData.q.accountID == account_id, connection=transaction):
+            if data.profile and "xcap" in data.profile:
+                raise ProfileDocumentsFound(account_id)
+        self.migrated_accounts.add(account_id)
+
+    def _select_document(self, transaction, account_id, uri, for_update=False):
+        application_id = sanitize_application_id(uri.application_id)
+        clause = AND(SipAccountDocument.q.accountID == account_id, SipAccountDocument.q.application == application_id,
+                     SipAccountDocument.q.documentPath == uri.doc_selector.document_path)
+        try:
+            return SipAccountDocument.select(clause, connection=transaction, forUpdate=for_update)[0]
+        except IndexError:
+            self._check_profile_documents(transaction, account_id)
+            return None
+
+    def _put_document(self, transaction, uri, document, check_etag, new_etag):
+        account_id = self._account_id(transaction, uri)
+        db_document = self._select_document(transaction, account_id, uri, for_update=True)
+        if db_document is None:
+            check_etag(None, False)
+            SipAccountDocument(accountID=account_id, application=sanitize_application_id(uri.application_id),
+                               documentPath=uri.doc_selector.document_path, etag=new_etag,
+                               document=document.encode('utf-8'), connection=transaction)
+            return (False, None, new_etag)
+        etag = db_document.etag
+        check_etag(etag)
+        db_document.set(etag=new_etag, document=document.encode('utf-8'))
+        return (True, etag, new_etag)
+
+    def _delete_document(self, transaction, uri, check_etag):
+        account_id = self._account_id(transaction, uri)
+        db_document = self._select_document(transaction, account_id, uri, for_update=True)
+        if db_document is None:
+            raise NotFound()
+        etag = db_document.etag
+        check_etag(etag)
+        db_document.destroySelf()
+        return (etag)
+
+    def _delete_all_documents(self, transaction, uri):
+        account_id = self._account_id(transaction, uri)
+        self._check_profile_documents(transaction, account_id)
+        SipAccountDocument.deleteMany(SipAccountDocument.q.accountID == account_id, connection=transaction)
+        return None
+
+    def _get_document(self, transaction, uri):
+        account_id = self._account_id(transaction, uri)
+        db_document = self._select_document(transaction, account_id, uri)
+        if db_document is None:
+            raise NotFound()
+        return db_document.document.decode('utf-8'), db_document.etag
+
+    def _get_documents_list(self, transaction, uri):
+        account_id = self._account_id(transaction, uri)
+        query = Select([SipAccountDocument.q.application, SipAccountDocument.q.documentPath, SipAccountDocument.q.etag],
+                       where=SipAccountDocument.q.accountID == account_id)
+        rows = transaction.queryAll(transaction.sqlrepr(query))
+        if not rows:
+            self._check_profile_documents(transaction, account_id)
+        # the same structure as profile["xcap"], without loading the documents
+        xcap_docs = {}
+        for application_id, document_path, etag in rows:
+            xcap_docs.setdefault(application_id, {})[document_path] = (None, etag)
+        return xcap_docs
+
     def update_dburi(self, dburi):
         if self.dburi != dburi:
             if self.dburi is not None:
@@ -395,24 +693,38 @@ class SipthorPasswordChecker(object):
     implements(ICredentialsChecker)
     credentialInterfaces = (IUsernamePassword, IUsernameHashedPassword)
 
+    ## the profile entry holding the secret checked by this checker
+    secret_key = None
+
     def __init__(self):
         self._database = DatabaseConnection()
+        self.cache = get_credentials_cache()
 
     def _query_credentials(self, credentials):
         username, domain = credentials.username.split('@', 1)[0], credentials.realm
         result = self._database.get_profile(username, domain)
         result.addCallback(self._got_query_results, credentials)
-        result.addErrback(self._got_unsuccessfull)
+        result.addErrback(self._got_unsuccessfull, credentials)
         return result
 
-    def _got_unsuccessfull(self, failure):
+    def _got_unsuccessfull(self, failure, credentials):
         failure.trap(NotFound)
+        if self.cache is not None:
+            self.cache.set(credentials.username.split('@', 1)[0], credentials.realm, None)
         raise UnauthorizedLogin("Unauthorized login")
 
     def _got_query_results(self, profile, credentials):
-        return self._authenticate_credentials(profile, credentials)
+        secret = profile[self.secret_key]
+        if self.cache is not None:
+            self.cache.set(credentials.username.split('@', 1)[0], credentials.realm, secret)
+        return self._authenticate_credentials(secret, credentials)
+
+    def _got_secret(self, secret, credentials):
+        if secret is None:
+            raise UnauthorizedLogin("Unauthorized login")
+        return self._authenticate_credentials(secret, credentials)
 
-    def _authenticate_credentials(self, profile, credentials):
+    def _authenticate_credentials(self, secret, credentials):
         raise NotImplementedError
 
     def _checkedPassword(self, matched, username, realm):
@@ -426,6 +738,13 @@ class SipthorPasswordChecker(object):
     def requestAvatarId(self, credentials):
         """Return the avatar ID for the credentials which must have the username
            and realm attributes, or an UnauthorizedLogin in case of a failure."""
+        if self.cache is not None:
+            try:
+                secret = self.cache.get(credentials.username.split('@', 1)[0], credentials.realm)
+            except KeyError:
+                pass
+            else:
+                return maybeDeferred(self._got_secret, secret, credentials)
         d = self._query_credentials(credentials)
         return d
 
@@ -436,9 +755,11 @@ class PlainPasswordChecker(SipthorPasswordChecker):
 
     implements(ICredentialsChecker)
 
-    def _authenticate_credentials(self, profile, credentials):
+    secret_key = "password"
+
+    def _authenticate_credentials(self, password, credentials):
         return maybeDeferred(
-                credentials.checkPassword, profile["password"]).addCallback(
+                credentials.checkPassword, password).addCallback(
                 self._checkedPassword, credentials.username, credentials.realm)
 
 
@@ -448,9 +769,11 @@ class HashPasswordChecker(SipthorPasswordChecker):
 
     implements(ICredentialsChecker)
 
-    def _authenticate_credentials(self, profile, credentials):
+    secret_key = "ha1"
+
+    def _authenticate_credentials(self, ha1, credentials):
         return maybeDeferred(
-                credentials.checkHash, profile["ha1"]).addCallback(
+                credentials.checkHash, ha1).addCallback(
                 self._checkedPassword, credentials.username, credentials.realm)
 
 
@@ -506,6 +829,17 @@ class Storage(object):
         self._provisioning = XCAPProvisioning()
         self._sip_notifier = SIPNotifier()
         self._notifier = Notifier(ServerConfig.root, self._sip_notifier.send_publish)
+        self._watchers_cache = get_watchers_cache()
+
+    @property
+    def statistics(self):
+        return self._database.statistics
+
+    def _invalidate_watchers(self, uri):
+        # the SIP proxy updates the status of the watchers when it is notified
+        # about the changed account, so the GetSIPWatchers result is stale
+        if self._watchers_cache is not None and uri.application_id in ("pres-rules", "org.openmobilealliance.pres-rules"):
+            self._watchers_cache.invalidate(uri.user.username, uri.user.domain)
 
     def _normalize_document_path(self, uri):
         if uri.application_id in ("pres-rules", "org.openmobilealliance.pres-rules"):
@@ -545,6 +879,7 @@ class Storage(object):
         else:
             code = 201
         self._provisioning.notify("update", "sip_account", thor_key)
+        self._invalidate_watchers(uri)
         self._notifier.on_change(uri, result[1], result[2])
         return StatusResponse(code, result[2])
 
@@ -556,6 +891,8 @@ class Storage(object):
 
     def _cb_delete_all(self, result, uri, thor_key):
         self._provisioning.notify("update", "sip_account", thor_key)
+        if self._watchers_cache is not None:
+            self._watchers_cache.invalidate(uri.user.username, uri.user.domain)
         return StatusResponse(200)
 
     def delete_document(self, uri, check_etag):
@@ -567,7 +904,8 @@ class Storage(object):
 
     def _cb_delete(self, result, uri, thor_key):
         self._provisioning.notify("update", "sip_account", thor_key)
-        self._notifier.on_change(uri, result[1], None)
+        self._invalidate_watchers(uri)
+        self._notifier.on_change(uri, result, None)
         return StatusResponse(200)
 
     def get_watchers(self, uri):
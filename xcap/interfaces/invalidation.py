@@ -0,0 +1,239 @@
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Cross-node cache invalidation
+
+When several OpenXCAP servers share the same storage, every server caching
+documents or watchers lists must learn about the changes made through the other
+servers. The InvalidationBus publishes such changes to the other servers and
+dispatches the changes published by them to local subscribers:
+
+  >>> def forget_document(user, application):
+  ...     print 'forget', user, application
+  >>> bus = InvalidationBus(LoopbackTransport('example'))
+  >>> other_bus = InvalidationBus(LoopbackTransport('example'))
+  >>> other_bus.subscribe('document', forget_document)
+  >>> bus.publish('document', 'alice@example.com', 'resource-lists')
+  forget alice@example.com resource-lists
+  >>> other_bus.stop(); bus.stop()
+
+A message carries its kind, a key made of strings, the identifier of the server
+that published it and the time it was published at. The latter is used to
+measure the invalidation lag, which is available in InvalidationBus.statistics
+(it includes the clock difference between the servers).
+
+The transport is selected with the [Invalidation] section of the configuration
+file. Messages sent over UDP can be lost, so caches relying on UDP should also
+expire their entries (see [Cache] document_max_age) to bound the staleness.
+"""
+
+import os
+import socket
+import time
+
+from application import log
+from application.configuration import ConfigSection, ConfigSetting
+from application.configuration.datatypes import StringList
+from application.python.types import Singleton
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+
+import xcap
+from xcap.dbutil import connectionForURI, parseURI
+
+__all__ = ['InvalidationBus', 'LoopbackTransport', 'UDPTransport', 'PostgresTransport', 'get_invalidation_bus']
+
+
+class Config(ConfigSection):
+    __cfgfile__ = xcap.__cfgfile__
+    __section__ = 'Invalidation'
+
+    transport = ConfigSetting(type=str, value=None)
+    multicast_group = '239.255.13.37'
+    port = 4790
+    peers = ConfigSetting(type=StringList, value=[])
+    database_uri = ''
+    channel = 'openxcap_invalidation'
+
+
+class InvalidationBus(object):
+    """Publishes invalidation messages through a transport and dispatches the
+    messages received from the other servers to the subscribed callbacks."""
+
+    protocol = 'OXI1'
+
+    def __init__(self, transport):
+        self.node_id = '%s-%d-%d' % (socket.gethostname(), os.getpid(), id(self))
+        self.subscribers = {}
+        self.statistics = dict(sent=0, received=0, errors=0, lag_total=0.0, lag_max=0.0)
+        self.transport = transport
+        transport.start(self)
+
+    @property
+    def average_lag(self):
+        received = self.statistics['received']
+        return received and self.statistics['lag_total'] / received or 0.0
+
+    def subscribe(self, kind, callback):
+        """Call callback(*key) for every message of the given kind published by another server."""
+        self.subscribers.setdefault(kind, []).append(callback)
+
+    def publish(self, kind, *key):
+        data = '\t'.join((self.protocol, self.node_id, '%.6f' % time.time(), kind) + key)
+        self.statistics['sent'] += 1
+        self.transport.send(data)
+
+    def receive(self, data):
+        try:
+            fields = data.split('\t')
+            if len(fields) < 4 or fields[0] != self.protocol:
+                raise ValueError("unknown message format")
+            protocol, node_id, timestamp, kind = fields[:4]
+            key = tuple(fields[4:])
+            lag = max(0.0, time.time() - float(timestamp))
+        except ValueError, e:
+            self.statistics['errors'] += 1
+            log.error("Ignoring invalid invalidation message: %s" % e)
+            return
+        if node_id == self.node_id:
+            return
+        self.statistics['received'] += 1
+        self.statistics['lag_total'] += lag
+        self.statistics['lag_max'] = max(self.statistics['lag_max'], lag)
+        for callback in self.subscribers.get(kind, ()):
+            try:
+                callback(*key)
+            except Exception:
+                log.err()
+
+    def stop(self):
+        self.transport.stop()
+
+
+class LoopbackTransport(object):
+    """Delivers messages to the buses using a loopback transport with the same
+    name in this process. Used for testing without a network."""
+
+    _buses = {}
+
+    def __init__(self, name='loopback'):
+        self.name = name
+
+    def start(self, bus):
+        self.bus = bus
+        self._buses.setdefault(self.name, []).append(bus)
+
+    def send(self, data):
+        for bus in self._buses.get(self.name, ()):
+            bus.receive(data)
+
+    def stop(self):
+        self._buses[self.name].remove(self.bus)
+
+
+class UDPTransport(DatagramProtocol):
+    """Sends messages to a multicast group, or to a list of peers as unicast
+    datagrams if peers are given as host:port strings."""
+
+    def __init__(self, port, multicast_group=None, peers=()):
+        self.port = port
+        self.multicast_group = multicast_group
+        self.peers = []
+        for peer in peers:
+            host, peer_port = (peer.split(':', 1) + [port])[:2]
+            self.peers.append((socket.gethostbyname(host), int(peer_port)))
+
+    def start(self, bus):
+        self.bus = bus
+        if self.peers:
+            self.listening_port = reactor.listenUDP(self.port, self)
+        else:
+            self.listening_port = reactor.listenMulticast(self.port, self, listenMultiple=True)
+            self.listening_port.joinGroup(self.multicast_group)
+
+    def datagramReceived(self, data, address):
+        self.bus.receive(data)
+
+    def send(self, data):
+        if self.transport is None:
+            return
+        for destination in self.peers or [(self.multicast_group, self.port)]:
+            try:
+                self.transport.write(data, destination)
+            except socket.error, e:
+                log.error("Cannot send invalidation message to %s:%d: %s" % (destination + (e,)))
+
+    def stop(self):
+        self.listening_port.stopListening()
+
+
+class PostgresTransport(object):
+    """Uses PostgreSQL LISTEN/NOTIFY on the given channel. Messages are sent
+    through an adbapi connection pool and received on a dedicated connection
+    that is watched by the reactor."""
+
+    def __init__(self, uri, channel):
+        self.uri = uri
+        self.channel = channel
+        self.pool = connectionForURI(uri)
+
+    def start(self, bus):
+        import psycopg2
+        import psycopg2.extensions
+        schema, user, password, host, port, db = parseURI(self.uri)
+        self.bus = bus
+        self.connection = psycopg2.connect(host=host or 'localhost', port=port or 5432, user=user or '', password=password or '', database=db)
+        self.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.connection.cursor().execute('LISTEN "%s"' % self.channel)
+        reactor.addReader(self)
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def doRead(self):
+        self.connection.poll()
+        while self.connection.notifies:
+            notify = self.connection.notifies.pop(0)
+            payload = getattr(notify, 'payload', None)
+            if payload is not None:
+                self.bus.receive(payload)
+
+    def connectionLost(self, reason):
+        log.error("Lost the PostgreSQL connection used for invalidation messages: %s" % reason.getErrorMessage())
+
+    def logPrefix(self):
+        return self.__class__.__name__
+
+    def send(self, data):
+        d = self.pool.runOperation("SELECT pg_notify(%(channel)s, %(payload)s)", {'channel': self.channel, 'payload': data})
+        d.addErrback(lambda failure: log.error("Cannot send invalidation message: %s" % failure.getErrorMessage()))
+
+    def stop(self):
+        reactor.removeReader(self)
+        self.connection.close()
+        self.pool.close()
+
+
+class _InvalidationBusHolder(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        transport = Config.transport and Config.transport.lower()
+        if not transport:
+            self.bus = None
+        elif transport == 'multicast':
+            self.bus = InvalidationBus(UDPTransport(Config.port, multicast_group=Config.multicast_group))
+        elif transport == 'udp':
+            self.bus = InvalidationBus(UDPTransport(Config.port, peers=Config.peers))
+        elif transport == 'postgres':
+            self.bus = InvalidationBus(PostgresTransport(Config.database_uri, Config.channel))
+        elif transport == 'loopback':
+            self.bus = InvalidationBus(LoopbackTransport(Config.channel))
+        else:
+            raise ValueError("Invalid invalidation transport: %r" % Config.transport)
+
+
+def get_invalidation_bus():
+    """Return the invalidation bus configured for this server or None if no transport is configured."""
+    return _InvalidationBusHolder().bus
+
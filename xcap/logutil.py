@@ -78,6 +78,10 @@ class Logging(ConfigSection):
 
     log_stacktrace = ConfigSetting(type=ResponseCodeList, value=[500])
 
+    # seconds between the logs of the validation and worker pool statistics,
+    # 0 to never log them
+    statistics_interval = 0
+
 
 def log_format_request_headers(code, r):
     if matches(Logging.log_request_headers, code):
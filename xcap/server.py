@@ -19,7 +19,7 @@ from twisted.python import failure
 import xcap
 from xcap import authentication
 from xcap.datatypes import XCAPRootURI
-from xcap.appusage import getApplicationForURI, Backend
+from xcap.appusage import getApplicationForURI, setup_applications, Backend
 from xcap.resource import XCAPDocument, XCAPElement, XCAPAttribute, XCAPNamespaceBinding
 from xcap.logutil import log_access, log_error
 from xcap.tls import Certificate, PrivateKey
@@ -177,6 +177,7 @@ class XCAPSite(server.Site):
 class XCAPServer(object):
 
     def __init__(self):
+        setup_applications()
         portal = Portal(authentication.XCAPAuthRealm())
         if AuthenticationConfig.cleartext_passwords:
             http_checker = ServerConfig.backend.PlainPasswordChecker()
@@ -0,0 +1,151 @@
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""DB-API 2.0 module wrapping sqlite3 for use with twisted.enterprise.adbapi.
+
+The queries use the pyformat parameter style of the MySQL and PostgreSQL
+drivers, so the same queries run on all the databases:
+
+  >>> translate("SELECT doc FROM xcap WHERE username = %(username)s AND doc_uri LIKE '%%.xml'")
+  "SELECT doc FROM xcap WHERE username = :username AND doc_uri LIKE '%.xml'"
+
+The connections use the WAL journal, so readers are not blocked by the writer,
+and create the tables used by OpenXCAP if they don't exist yet.
+"""
+
+import re
+import sqlite3
+
+from sqlite3 import Warning, Error, InterfaceError, DatabaseError, DataError, OperationalError
+from sqlite3 import IntegrityError, InternalError, ProgrammingError, NotSupportedError, Binary
+
+__all__ = ['connect', 'translate']
+
+apilevel = '2.0'
+threadsafety = 1
+paramstyle = 'pyformat'
+
+
+# The same tables and indexes as scripts/mysql-create-tables.sql, plus the
+# columns of the OpenSIPS presence tables that are used by the watchers query
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriber (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username VARCHAR(64) NOT NULL DEFAULT '',
+    domain VARCHAR(64) NOT NULL DEFAULT '',
+    password VARCHAR(25) NOT NULL DEFAULT '',
+    ha1 VARCHAR(64) NOT NULL DEFAULT ''
+);
+CREATE UNIQUE INDEX IF NOT EXISTS user_id ON subscriber (username, domain);
+CREATE INDEX IF NOT EXISTS username_id ON subscriber (username);
+
+CREATE TABLE IF NOT EXISTS xcap (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username VARCHAR(66) NOT NULL,
+    domain VARCHAR(128) NOT NULL,
+    doc BLOB NOT NULL,
+    doc_type INTEGER NOT NULL,
+    etag VARCHAR(64) NOT NULL,
+    source INTEGER NOT NULL DEFAULT 0,
+    doc_uri VARCHAR(128) NOT NULL,
+    port INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS udd_xcap ON xcap (username, domain, doc_type, doc_uri);
+
+CREATE TABLE IF NOT EXISTS watchers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    presentity_uri VARCHAR(128) NOT NULL,
+    watcher_username VARCHAR(64) NOT NULL,
+    watcher_domain VARCHAR(64) NOT NULL,
+    event VARCHAR(64) NOT NULL DEFAULT 'presence',
+    status INTEGER NOT NULL,
+    reason VARCHAR(64),
+    inserted_time INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS watcher_idx ON watchers (presentity_uri, watcher_username, watcher_domain, event);
+
+CREATE TABLE IF NOT EXISTS active_watchers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    presentity_uri VARCHAR(128) NOT NULL,
+    watcher_username VARCHAR(64) NOT NULL,
+    watcher_domain VARCHAR(64) NOT NULL,
+    event VARCHAR(64) NOT NULL DEFAULT 'presence',
+    expires INTEGER NOT NULL DEFAULT 0,
+    status INTEGER NOT NULL DEFAULT 2
+);
+CREATE INDEX IF NOT EXISTS active_watchers_presentity ON active_watchers (presentity_uri, event);
+"""
+
+
+_parameter_re = re.compile(r'%\((\w+)\)s|%s|%%')
+_translations = {}
+
+def _replace_parameter(match):
+    token = match.group(0)
+    if token == '%%':
+        return '%'
+    elif token == '%s':
+        return '?'
+    else:
+        return ':' + match.group(1)
+
+def translate(query):
+    """Return the query using the named (or qmark) parameter style of sqlite3"""
+    try:
+        return _translations[query]
+    except KeyError:
+        translation = _translations[query] = _parameter_re.sub(_replace_parameter, query)
+        return translation
+
+
+class Cursor(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, params=None):
+        # like the other drivers, the query is used unchanged when there are no parameters
+        if params is None:
+            self._cursor.execute(query)
+        else:
+            self._cursor.execute(translate(query), params)
+        return self
+
+    def executemany(self, query, seq_of_params):
+        self._cursor.executemany(translate(query), seq_of_params)
+        return self
+
+
+class Connection(object):
+    def __init__(self, database, timeout):
+        # adbapi uses every connection from a single thread, but closes them from the reactor
+        self._connection = sqlite3.connect(database, timeout=timeout, check_same_thread=False)
+        # the documents are UTF-8 encoded byte strings
+        self._connection.text_factory = str
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._connection.commit()
+
+    def cursor(self):
+        return Cursor(self._connection.cursor())
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+
+def connect(database, timeout=30.0):
+    if database == ':memory:':
+        raise ValueError("in-memory SQLite databases cannot be shared between connections")
+    return Connection(database, timeout)
@@ -0,0 +1,266 @@
+
+# Copyright (C) 2007-2010 AG-Projects.
+#
+
+"""Pools of workers that run the CPU bound parts of the requests on large
+documents (parsing, schema validation and locating elements) outside of the
+thread running the reactor, so that the other connections are not held up
+while they run.
+
+The pool is selected with the [Workers] section of the configuration file:
+a pool of threads (lxml releases the GIL while it parses and validates) or a
+pool of processes, for which the functions given to the pool and their
+arguments and results must be picklable. The documents up to size_threshold
+bytes are processed in the reactor thread, where that is cheaper than handing
+them to a worker.
+"""
+
+import os
+import threading
+import time
+
+from application import log
+from application.configuration import ConfigSection, ConfigSetting
+from application.python.types import Singleton
+from twisted.internet import defer, reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from twisted.web2.http import HTTPError
+
+import xcap
+from xcap import errors
+from xcap.datatypes import DataSize
+
+
+class Config(ConfigSection):
+    __cfgfile__ = xcap.__cfgfile__
+    __section__ = 'Workers'
+
+    type = 'thread'
+    count = 0
+    size_threshold = ConfigSetting(type=DataSize, value=DataSize('64K'))
+
+
+class WorkerError(Exception):
+    """An error raised by a function run in a worker process, with the HTTP
+    error it was raised with, if any"""
+
+
+class StageStatistics(object):
+    """The number of times each stage of some work ran and the time it took,
+    which may be added to from any thread. The stages run by a task in a
+    worker process are sent back with its result and added to the statistics
+    of the same name in the server, the ones created last for that name."""
+
+    _instances = {}
+
+    def __init__(self, name):
+        self.name = name
+        self._stages = {}
+        self._lock = threading.Lock()
+        StageStatistics._instances[name] = self
+
+    def add(self, stage, elapsed):
+        if _process_stages is not None:
+            _process_stages.append((self.name, stage, elapsed))
+            return
+        self._lock.acquire()
+        try:
+            statistics = self._stages.get(stage)
+            if statistics is None:
+                statistics = self._stages[stage] = dict(count=0, time=0.0, max_time=0.0)
+            statistics['count'] += 1
+            statistics['time'] += elapsed
+            statistics['max_time'] = max(statistics['max_time'], elapsed)
+        finally:
+            self._lock.release()
+
+    def items(self):
+        """Return a copy of the statistics of each stage, sorted by stage"""
+        self._lock.acquire()
+        try:
+            return sorted((stage, dict(statistics)) for stage, statistics in self._stages.iteritems())
+        finally:
+            self._lock.release()
+
+    @classmethod
+    def add_stages(cls, stages):
+        for name, stage, elapsed in stages:
+            instance = cls._instances.get(name)
+            if instance is not None:
+                instance.add(stage, elapsed)
+
+
+## the stages run by the task of a worker process, None in the server process
+_process_stages = None
+
+def _run_in_process(function, args):
+    """Run function(*args) in a process of the pool and return the result or
+    the error, which may not be picklable, in a form that can be sent back"""
+    global _process_stages
+    _process_stages = []
+    start = time.time()
+    try:
+        result = (True, function(*args))
+    except Exception, e:
+        if isinstance(e, HTTPError):
+            http_error = e
+        else:
+            http_error = getattr(e, 'http_error', None)
+        if isinstance(http_error, errors.XCAPError):
+            result = (False, (http_error.code, http_error.build_xml_output(), str(e)))
+        else:
+            result = (False, (None, None, '%s: %s' % (e.__class__.__name__, e)))
+    stages, _process_stages = _process_stages, None
+    return result + (os.getpid(), time.time() - start, stages)
+
+
+class WorkerPool(object):
+    """Base class of the pools, which keep statistics for the pool (the tasks
+    waiting for a worker and the time they waited) and for each worker (the
+    tasks it ran and the time it spent on them)."""
+
+    def __init__(self, count):
+        self.count = count
+        self.queued = 0
+        self.statistics = dict(tasks=0, max_queued=0, wait_time=0.0, max_wait_time=0.0)
+        self.worker_statistics = {}
+        self._lock = threading.Lock()
+
+    @property
+    def average_wait_time(self):
+        tasks = self.statistics['tasks']
+        return tasks and self.statistics['wait_time'] / tasks or 0.0
+
+    def _submitted(self):
+        self._lock.acquire()
+        try:
+            self.queued += 1
+            self.statistics['max_queued'] = max(self.statistics['max_queued'], self.queued)
+        finally:
+            self._lock.release()
+        return time.time()
+
+    def _started(self, submitted):
+        wait_time = time.time() - submitted
+        self._lock.acquire()
+        try:
+            self.queued -= 1
+            self.statistics['tasks'] += 1
+            self.statistics['wait_time'] += wait_time
+            self.statistics['max_wait_time'] = max(self.statistics['max_wait_time'], wait_time)
+        finally:
+            self._lock.release()
+
+    def _finished(self, worker, run_time):
+        self._lock.acquire()
+        try:
+            statistics = self.worker_statistics.get(worker)
+            if statistics is None:
+                statistics = self.worker_statistics[worker] = dict(tasks=0, time=0.0, max_time=0.0)
+            statistics['tasks'] += 1
+            statistics['time'] += run_time
+            statistics['max_time'] = max(statistics['max_time'], run_time)
+        finally:
+            self._lock.release()
+
+    def log_statistics(self):
+        self._lock.acquire()
+        try:
+            statistics = dict(self.statistics, queued=self.queued)
+            worker_statistics = sorted((worker, dict(statistics)) for worker, statistics in self.worker_statistics.iteritems())
+        finally:
+            self._lock.release()
+        log.msg("Worker pool: %s, average wait %.2fms" % (', '.join('%s=%s' % item for item in sorted(statistics.items())), self.average_wait_time*1000))
+        for worker, statistics in worker_statistics:
+            log.msg("Worker %s: %d tasks, %.1fms average, %.1fms max" % (worker, statistics['tasks'], statistics['time']*1000/statistics['tasks'], statistics['max_time']*1000))
+
+    def run(self, function, *args):
+        """Call function(*args) in a worker and return a Deferred firing with the result"""
+        raise NotImplementedError
+
+
+class ThreadWorkerPool(WorkerPool):
+    """Runs the functions in a pool of threads"""
+
+    def __init__(self, count):
+        WorkerPool.__init__(self, count)
+        self._pool = ThreadPool(minthreads=count, maxthreads=count, name='worker')
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    def run(self, function, *args):
+        return deferToThreadPool(reactor, self._pool, self._run, self._submitted(), function, args)
+
+    def _run(self, submitted, function, args):
+        self._started(submitted)
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self._finished(threading.currentThread().getName(), time.time() - start)
+
+
+class ProcessWorkerPool(WorkerPool):
+    """Runs the functions in a pool of processes. The errors they raise are
+    sent back as WorkerError, with the XCAP error response they had."""
+
+    def __init__(self, count):
+        WorkerPool.__init__(self, count)
+        import multiprocessing
+        self._pool = multiprocessing.Pool(count)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.terminate)
+
+    def run(self, function, *args):
+        d = defer.Deferred()
+        submitted = self._submitted()
+        # the callback is called in a thread of the multiprocessing pool
+        callback = lambda result: reactor.callFromThread(self._done, d, submitted, result)
+        self._pool.apply_async(_run_in_process, (function, args), callback=callback)
+        return d
+
+    def _done(self, d, submitted, result):
+        success, value, pid, run_time, stages = result
+        # the task is only known to have started when it's done
+        self._started(submitted + run_time)
+        self._finished('process-%d' % pid, run_time)
+        StageStatistics.add_stages(stages)
+        if success:
+            d.callback(value)
+        else:
+            code, output, description = value
+            error = WorkerError(description)
+            if code is not None:
+                error.http_error = HTTPError(errors.XMLErrorResponse(code, output))
+            d.errback(error)
+
+
+class _WorkerPoolHolder(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        pool_type = Config.type.lower()
+        if not Config.count:
+            self.pool = None
+        elif pool_type == 'thread':
+            self.pool = ThreadWorkerPool(Config.count)
+        elif pool_type == 'process':
+            self.pool = ProcessWorkerPool(Config.count)
+        else:
+            raise ValueError("Invalid worker pool type: %r" % Config.type)
+
+def get_worker_pool():
+    """Return the pool of workers configured for this server or None if there is none"""
+    return _WorkerPoolHolder().pool
+
+def defer_to_workers(size, function, *args):
+    """Call function(*args) in a worker if the size of the document it processes
+    is over the threshold and there is a pool of workers, otherwise call it right
+    away. Return a Deferred firing with the result."""
+    pool = get_worker_pool()
+    if pool is None or size <= Config.size_threshold:
+        return defer.maybeDeferred(function, *args)
+    return pool.run(function, *args)
+
+
+__all__ = ['WorkerError', 'StageStatistics', 'WorkerPool', 'ThreadWorkerPool', 'ProcessWorkerPool', 'get_worker_pool', 'defer_to_workers']
@@ -7,7 +7,6 @@ import re
 
 from application import log
 from copy import copy
-from lxml import _elementpath as ElementPath
 from xml.sax.saxutils import quoteattr
 
 __all__ = ['parse_node_selector', 'AttributeSelector', 'DocumentSelector', 'ElementSelector', 'NamespaceSelector', 'NodeSelector']
@@ -38,11 +37,16 @@ class Op(str):
 class Tag(str):
     tag = True
 
+# the tokenizer of lxml's ElementPath, without ':' in the names: newer versions
+# of lxml resolve prefix:name themselves and fail if they don't know the prefix
+_xpath_tokenizer_re = re.compile(r"""('[^']*'|"[^"]*"|::|//?|\.\.|\(\)|[/.*:\[\]\(\)@=])|((?:\{[^}]+\})?[^/:\[\]\(\)@=\s]+)|\s+""")
+
 class XPathTokenizer(object):
 
     @classmethod
     def tokens(cls, selector):
         """
+        >>> xpath_tokenizer = XPathTokenizer.tokens
         >>> xpath_tokenizer('resource-lists')
         ['resource-lists']
 
@@ -68,7 +72,7 @@ class XPathTokenizer(object):
 
         tokens = List()
         prev = None
-        for op, tag in ElementPath.xpath_tokenizer(selector):
+        for op, tag in _xpath_tokenizer_re.findall(selector):
             if prev == '=':
                 unq = unquote_attr_value
             else: